@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Time `ndt <command> --help` for each python command in COMMAND_MAPPINGS.
+Parsing the arguments is where commands load the modules they need, so this is
+the fixed cost a script pays for every call. Prints the best of a few runs in
+fresh interpreters and the number of modules that the command loaded on top
+of a bare `ndt`.
+
+Usage: benchmarks/command_import_benchmark.py [command ...]
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from n_utils import COMMAND_MAPPINGS
+
+ROUNDS = 3
+SCRIPT = """import atexit, sys
+atexit.register(lambda: sys.stderr.write("\\nmodules=%d\\n" % len(sys.modules)))
+sys.argv = ["ndt"] + sys.argv[1:]
+from n_utils.ndt import ndt
+ndt()
+"""
+
+
+def run(args):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, "-c", SCRIPT] + args, cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    modules = [line for line in err.decode("utf-8", "replace").splitlines()
+               if line.startswith("modules=")]
+    if not modules:
+        return None, None
+    return best, int(modules[-1].split("=")[1])
+
+
+def main():
+    commands = sys.argv[1:] or sorted([name for name, value in COMMAND_MAPPINGS.items()
+                                       if ":" in value])
+    base, base_modules = run([])
+    print("ndt without a command: %.1f ms, %d modules" % (base * 1000, base_modules))
+    print("%-32s %8s %8s" % ("command", "ms", "modules"))
+    for command in commands:
+        elapsed, modules = run([command, "--help"])
+        if elapsed is None:
+            print("%-32s %8s" % (command, "failed"))
+        else:
+            print("%-32s %8.1f %8d" % (command, elapsed * 1000, modules - base_modules))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Time expand_vars and expand_vars_in_place on generated mappings of growing
+size. Every key and value references parameters, so all keys get rewritten.
+The second in-place pass is what a fixpoint loop pays to find out that
+nothing changes any more.
+
+Usage: benchmarks/expand_vars_benchmark.py [key_count ...]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from n_utils.cf_utils import expand_vars, expand_vars_in_place
+
+PARAMS = OrderedDict([("paramEnvId", "bench"), ("paramOwner", "ops"),
+                      ("paramBucket", "bench-bucket")])
+
+
+def generate(key_count):
+    data = OrderedDict()
+    for i in range(key_count):
+        data["res" + str(i) + "$paramEnvId"] = OrderedDict([
+            ("Type", "AWS::SNS::Topic"),
+            ("Properties", OrderedDict([
+                ("TopicName", "${paramEnvId}-topic-" + str(i)),
+                ("DisplayName", "${paramOwner^^}"),
+                ("Tags", [OrderedDict([("Key", "Owner"), ("Value", "((paramOwner))")])]),
+                ("Policy", OrderedDict([("Fn::Sub", "arn:aws:s3:::((paramBucket))/${AWS::Region}")]))
+            ]))
+        ])
+    return data
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [500, 1000, 2000, 4000, 8000]
+    print("     keys  expand_vars  in_place  fixpoint_check")
+    for size in sizes:
+        data = generate(size)
+        copy = deepcopy(data)
+        pure = timed(lambda: expand_vars(data, PARAMS, None, []))
+        in_place = timed(lambda: expand_vars_in_place(copy, PARAMS, None, []))
+        check = timed(lambda: expand_vars_in_place(copy, PARAMS, None, []))
+        print("%9d  %11.3f  %8.3f  %14.3f" % (size, pure, in_place, check))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Time interpolate_file on a generated configuration file against the
+previous line by line implementation that copied the result into place.
+
+Usage: benchmarks/interpolate_benchmark.py [size_in_megabytes]
+"""
+from __future__ import print_function
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from n_utils import cf_utils
+
+PARAMS = {"paramEnvId": "bench", "paramBucket": "bench-bucket", "paramOwner": "ops"}
+
+LINES = [
+    "# generated configuration line {0} with no references at all\n",
+    "server.name=app-{0}.example.com\n",
+    "bucket.url=s3://${{paramBucket}}/data/{0}\n",
+    "logging.level.com.example.module{0}=INFO\n",
+    "owner=${{paramOwner^^}} env=${{paramEnvId}} unresolved=${{missing}}\n",
+    "jdbc.pool.size.{0}=20\n",
+]
+
+
+def write_file(file_name, size):
+    with io.open(file_name, "w", encoding="utf-8") as out:
+        written = 0
+        i = 0
+        while written < size:
+            line = LINES[i % len(LINES)].format(i)
+            out.write(line)
+            written += len(line)
+            i += 1
+
+
+def line_by_line(file_name, destination):
+    dstfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(destination), delete=False)
+    with io.open(file_name, "r", encoding="utf-8") as _infile:
+        with dstfile as _outfile:
+            for line in _infile:
+                _outfile.write(cf_utils._rescan_line(line, PARAMS, None, []).encode("utf-8"))
+    shutil.copy(dstfile.name, destination)
+    os.unlink(dstfile.name)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, "application.properties")
+        write_file(source, size * 1024 * 1024)
+        start = time.time()
+        line_by_line(source, os.path.join(directory, "line-by-line.properties"))
+        print("line by line  %6.2f s" % (time.time() - start))
+        start = time.time()
+        cf_utils.interpolate_file(source, destination=os.path.join(directory, "chunked.properties"),
+                                  stack_name="bench")
+        print("chunked       %6.2f s" % (time.time() - start))
+        with open(os.path.join(directory, "line-by-line.properties"), "rb") as expected:
+            with open(os.path.join(directory, "chunked.properties"), "rb") as result:
+                print("identical output: " + str(expected.read() == result.read()))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    cf_utils.stack_params_and_outputs = lambda region, stack_name: PARAMS
+    cf_utils.region = lambda: "eu-west-1"
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Time template pre-processing (yaml_to_dict) for generated templates of
+growing size. The time per resource should stay roughly constant.
+
+Usage: benchmarks/preprocess_benchmark.py [resource_count ...]
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("REGION", os.environ["AWS_DEFAULT_REGION"])
+os.environ.setdefault("ACCOUNT_ID", "123456789012")
+os.environ.setdefault("AWS_EC2_METADATA_DISABLED", "true")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from n_utils import aws_infra_util
+
+PARAMETER_COUNT = 40
+
+SNIPPET = """Type: AWS::IAM::Policy
+Properties:
+  PolicyName: ((name))-$paramEnvId
+  PolicyDocument:
+    Statement:
+      - Effect: Allow
+        Action: ["s3:GetObject"]
+        Resource: "arn:aws:s3:::${paramBucket}/((name))/*"
+"""
+
+RESOURCE = """  res{0}:
+    Type: AWS::SNS::Topic
+    Properties:
+      TopicName: ${{paramEnvId}}-topic-{0}
+      DisplayName: ${{param{1}^^}}
+      Tags:
+        - Key: Name
+          Value: $paramEnvId-{0}
+        - Key: Owner
+          Value: ((paramOwner))
+  resPolicy{0}:
+    Fn::ImportYaml: policy.yaml
+    name: policy{0}
+"""
+
+
+def write_template(directory, resource_count):
+    with open(os.path.join(directory, "policy.yaml"), "w") as snippet:
+        snippet.write(SNIPPET)
+    template = os.path.join(directory, "template.yaml")
+    with open(template, "w") as out:
+        out.write("Parameters:\n")
+        out.write("  paramEnvId:\n    Type: String\n    Default: bench\n")
+        out.write("  paramOwner:\n    Type: String\n    Default: ops\n")
+        out.write("  paramBucket:\n    Type: String\n    Default: ${paramEnvId}-bucket\n")
+        for i in range(PARAMETER_COUNT):
+            out.write("  param" + str(i) + ":\n    Type: String\n    Default: value-$paramEnvId-" +
+                      str(i) + "\n")
+        out.write("Resources:\n")
+        for i in range(resource_count):
+            out.write(RESOURCE.format(i, i % PARAMETER_COUNT))
+    return template
+
+
+def run(resource_count):
+    directory = tempfile.mkdtemp()
+    try:
+        template = write_template(directory, resource_count)
+        aws_infra_util.SOURCED_PARAMS = None
+        start = time.time()
+        aws_infra_util.yaml_to_dict(template)
+        return time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [250, 500, 1000, 2000]
+    # warm up imports and the sourced parameters
+    run(10)
+    print("resources  seconds  ms/resource")
+    for size in sizes:
+        elapsed = run(size)
+        print("%9d  %7.2f  %11.3f" % (size, elapsed, elapsed * 1000 / size))
+
+
+if __name__ == "__main__":
+    main()
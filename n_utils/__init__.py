@@ -15,6 +15,8 @@
 """ Main module for nitor-deploy-tools
 """
 
+# points `ndt` to the socket of `ndt serve`
+SERVER_SOCKET_ENV = "NDT_SERVER_SOCKET"
 PATH_COMMANDS = [
     'bin/create-shell-archive.sh',
     'bin/ensure-letsencrypt-certs.sh',
@@ -86,7 +88,9 @@ NDT_ONLY = [
     'profile-expiry-to-env=n_utils.profile_util:profile_expiry_to_env',
     'enable-profile=n_utils.profile_util:cli_enable_profile',
     'list-jobs=n_utils.cli:cli_list_jobs',
-    'list-components=n_utils.cli:cli_list_components'
+    'list-components=n_utils.cli:cli_list_components',
+    'deploy-all=n_utils.cli:cli_deploy_all',
+    'serve=n_utils.ndt_server:serve'
 ]
 NDT_ONLY_SCRIPT = [
     'bake-docker.sh',
@@ -2,10 +2,10 @@ from __future__ import print_function
 from __future__ import absolute_import
 import os
 import boto3
-from time import time, sleep
 from n_utils import cf_utils
 from n_utils import cf_deploy
 from n_utils.ndt import find_include
+from n_utils.waiter import Waiter
 
 def create_account(email, account_name, role_name="OrganizationAccountAccessRole",
                    trust_role="TrustedAccountAccessRole",
@@ -29,18 +29,24 @@ def create_account(email, account_name, role_name="OrganizationAccountAccessRole
                                      RoleName=role_name, IamUserAccessToBilling=access)
     if 'CreateAccountStatus' in response and 'Id' in response['CreateAccountStatus']:
         create_account_id = response['CreateAccountStatus']['Id']
-        startTime = time()
-        status = response['CreateAccountStatus']['State']
-        while time() - startTime < timeout and not status == "SUCCEEDED":
-            if response['CreateAccountStatus']['State'] == "FAILED":
-                raise Exception("Account creation failed: " + response['CreateAccountStatus']['FailureReason'])
+
+        def poll_status():
+            return client.describe_create_account_status(
+                CreateAccountRequestId=create_account_id)['CreateAccountStatus']
+
+        def created(create_status):
+            if create_status['State'] == "FAILED":
+                raise Exception("Account creation failed: " + create_status['FailureReason'])
+            if create_status['State'] == "SUCCEEDED":
+                return True
             print("Waiting for account creation to finish")
-            sleep(2)
-            response = client.describe_create_account_status(CreateAccountRequestId=create_account_id)
-            status = response['CreateAccountStatus']['State']
-        if time() - startTime > timeout and not status == "SUCCEEDED":
-            raise Exception("Timed out waiting to create account " + response['CreateAccountStatus']['State'])
-        account_id = response['CreateAccountStatus']['AccountId']
+            return False
+        create_status = response['CreateAccountStatus']
+        if not created(create_status):
+            create_status = Waiter("account", delay=2, max_delay=15, timeout=timeout,
+                                   timeout_message="Timed out waiting to create account " +
+                                   account_name).wait(poll_status, done=created)
+        account_id = create_status['AccountId']
 
     os.environ['paramManagedAccount'] = account_id
     os.environ['paramManageRole'] = role_name
@@ -19,6 +19,7 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import range
+from builtins import object
 import json
 import os
 import re
@@ -35,11 +36,14 @@ from yaml import ScalarNode, SequenceNode, MappingNode
 from io import StringIO
 from botocore.exceptions import ClientError
 from copy import deepcopy
+from threading import Lock
 from n_utils.cf_utils import stack_params_and_outputs, region, resolve_account, \
-                             expand_vars, get_images, ParamNotAvailable
+                             expand_vars, expand_vars_in_place, get_images, ParamNotAvailable
 from n_utils.git_utils import Git
 from n_utils.ndt import find_include
 from n_utils.ecr_utils import repo_uri
+from n_utils.template_cache import TemplateCache, TemplateDependencies, cache_enabled, \
+    file_digest
 
 stacks = dict()
 CFG_PREFIX = "AWS::CloudFormation::Init_config_files_"
@@ -158,6 +162,7 @@ INTRISINC_FUNCS = {
 }
 
 SOURCED_PARAMS = None
+DEPENDENCIES = None
 
 
 def run_command(command):
@@ -182,33 +187,135 @@ def _resolve_stackref(region, stack_name, stack_param):
     else:
         stack_params = stack_params_and_outputs(region, stack_name)
         stacks[stack_key] = stack_params
-    if stack_param in stack_params:
-        return stack_params[stack_param]
-    return None
-
-def _process_infra_prop_line(line, params, used_params):
+    value = stack_params[stack_param] if stack_param in stack_params else None
+    if DEPENDENCIES:
+        DEPENDENCIES.add_stackref(region, stack_name, stack_param, value)
+    return value
+
+NOT_SET = object()
+
+
+class _TrackedParams(object):
+    """ The parameters a properties file sees while it is parsed: its own
+    assignments over the given parameters over the environment. Records the
+    outside values that the file looked at, so that the result can be reused for
+    any parameters and environment that agree on those, and the StackRef
+    definitions in the file with the values they resolved to.
+    """
+    def __init__(self, params, environ):
+        self.params = params
+        self.environ = environ
+        self.assigned = OrderedDict()
+        self.stackrefs = []
+        self.resolved = []
+        self.param_deps = {}
+        self.environ_deps = {}
+
+    def _outside(self, name):
+        if name not in self.param_deps:
+            if name in self.params:
+                self.param_deps[name] = self.params[name]
+            else:
+                self.param_deps[name] = self.environ.get(name, NOT_SET)
+        return self.param_deps[name]
+
+    def __contains__(self, name):
+        return name in self.assigned or self._outside(name) is not NOT_SET
+
+    def __getitem__(self, name):
+        if name in self.assigned:
+            return self.assigned[name]
+        value = self._outside(name)
+        if value is NOT_SET:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.assigned[name] = value
+
+    def from_environ(self, name):
+        """ Environment variables override values assigned in properties files
+        """
+        if name not in self.environ_deps:
+            self.environ_deps[name] = self.environ.get(name, NOT_SET)
+        return self.environ_deps[name]
+
+
+def _lookup(params, environ, name):
+    if name in params:
+        return params[name]
+    return environ.get(name, NOT_SET)
+
+
+class PropertiesFileCache(object):
+    """ Assignments made by properties files keyed by path, modification time
+    and size. Exported branches live in their own directories, so the path also
+    tells the branches apart. An entry is reused when the parameters and
+    environment variables that the file read still have the same values and
+    its StackRefs still resolve to the same values. StackRefs are looked up
+    through the stacks memo, so clearing that refreshes them.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, filename):
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+    def get(self, filename, params, environ, parser):
+        """ Returns the assignments and the StackRef definitions of the file
+        """
+        key = self._key(filename)
+        for param_deps, environ_deps, assignments, stackrefs, resolved in self.entries.get(key, []):
+            if all(_lookup(params, environ, name) == value for name, value in param_deps.items()) and \
+               all(environ.get(name, NOT_SET) == value for name, value in environ_deps.items()) and \
+               all(_resolve_stackref_from_dict(stackref) == value for stackref, value in resolved):
+                self.hits += 1
+                return assignments, stackrefs
+        tracked = _TrackedParams(params, environ)
+        parser(filename, tracked)
+        assignments = list(tracked.assigned.items())
+        with self.lock:
+            self.misses += 1
+            self.entries.setdefault(key, []).append((tracked.param_deps, tracked.environ_deps,
+                                                     assignments, tracked.stackrefs,
+                                                     tracked.resolved))
+        return assignments, tracked.stackrefs
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return "Properties cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses"
+
+
+def _process_infra_prop_line(line, params):
     key_val = line.split("=", 1)
     if len(key_val) == 2:
         key = re.sub("[^a-zA-Z0-9_]", "", key_val[0].strip())
-        if key in os.environ:
-            value = os.environ[key]
-        else:
+        value = params.from_environ(key)
+        if value is NOT_SET:
             value = key_val[1].strip()
         if value.startswith("\"") and value.endswith("\""):
             value = value[1:-1]
-        value = expand_vars(value, used_params, None, [])
+        value = expand_vars(value, params, None, [])
         if value.strip().startswith("StackRef:"):
             stackref_doc = yaml_load(StringIO(value))
+            params.stackrefs.append(stackref_doc['StackRef'])
             stack_value = _resolve_stackref_from_dict(stackref_doc['StackRef'])
+            params.resolved.append((stackref_doc['StackRef'], stack_value))
             if stack_value:
                 value = stack_value
         params[key] = value
-        used_params[key] = value
 
 
-def import_parameter_file(filename, params):
-    used_params = deepcopy(os.environ)
-    used_params.update(params)
+def _parse_parameter_file(filename, params):
     with open(filename, "r") as propfile:
         prevline = ""
         for line in propfile.readlines():
@@ -220,14 +327,27 @@ def import_parameter_file(filename, params):
             else:
                 line = prevline + line
                 prevline = ""
-                _process_infra_prop_line(line, params, used_params)
+                _process_infra_prop_line(line, params)
         if prevline:
-            _process_infra_prop_line(prevline, params, used_params)
+            _process_infra_prop_line(prevline, params)
+
+PROPERTIES_FILES = PropertiesFileCache()
+
+
+def import_parameter_file(filename, params, environ=None, stackrefs=None):
+    if environ is None:
+        environ = os.environ
+    assignments, file_stackrefs = PROPERTIES_FILES.get(filename, params, environ,
+                                                       _parse_parameter_file)
+    for key, value in assignments:
+        params[key] = value
+    if stackrefs is not None:
+        stackrefs.extend(file_stackrefs)
 
 
-def _add_subcomponent_file(component, branch, type, name, files):
+def _add_subcomponent_file(component, branch, type, name, files, environ):
     if name:
-        os.environ["ORIG_" + type.upper() + "_NAME"] = name
+        environ["ORIG_" + type.upper() + "_NAME"] = name
         files.append(component + os.sep + type + "-" + name + os.sep + "infra.properties")
         files.append(component + os.sep + type + "-" + name + os.sep + "infra-" + branch + ".properties")
 
@@ -301,7 +421,9 @@ def resolve_ami(component_params, component, image, imagebranch, branch, git):
 
 def load_parameters(component=None, stack=None, serverless=None, docker=None, image=None, 
                     cdk=None, terraform=None, branch=None, resolve_images=False,
-                    git=None):
+                    git=None, environ=None, stackrefs=None):
+    if environ is None:
+        environ = os.environ
     if not git:
         git = Git()
     with git:
@@ -324,18 +446,18 @@ def load_parameters(component=None, stack=None, serverless=None, docker=None, im
         if component:
             files.append(prefix + component + os.sep + "infra.properties")
             files.append(prefix + component + os.sep + "infra-" + branch + ".properties")
-            _add_subcomponent_file(prefix + component, branch, "stack", stack, files)
-            _add_subcomponent_file(prefix + component, branch, "serverless", serverless, files)
-            _add_subcomponent_file(prefix + component, branch, "cdk", cdk, files)
-            _add_subcomponent_file(prefix + component, branch, "terraform", terraform, files)
-            _add_subcomponent_file(prefix + component, branch, "docker", docker, files)
-            _add_subcomponent_file(prefix + component, branch, "image", image, files)
+            _add_subcomponent_file(prefix + component, branch, "stack", stack, files, environ)
+            _add_subcomponent_file(prefix + component, branch, "serverless", serverless, files, environ)
+            _add_subcomponent_file(prefix + component, branch, "cdk", cdk, files, environ)
+            _add_subcomponent_file(prefix + component, branch, "terraform", terraform, files, environ)
+            _add_subcomponent_file(prefix + component, branch, "docker", docker, files, environ)
+            _add_subcomponent_file(prefix + component, branch, "image", image, files, environ)
             if (image, six.string_types):
                 files.append(prefix + component + os.sep + "image" + os.sep + "infra.properties")
                 files.append(prefix + component + os.sep + "image" + os.sep + "infra-" + branch + ".properties")
         for file in files:
             if os.path.exists(file):
-                import_parameter_file(file, ret)
+                import_parameter_file(file, ret, environ, stackrefs=stackrefs)
         if (serverless or stack or cdk or terraform) and resolve_images:
             if not "AWS_DEFAULT_REGION" in os.environ:
                 if "REGION" in ret:
@@ -370,14 +492,14 @@ def load_parameters(component=None, stack=None, serverless=None, docker=None, im
             ret["REGION"] = region()
         if "paramEnvId" not in ret:
             ret["paramEnvId"] = branch
-        if "ORIG_STACK_NAME" in os.environ:
-            ret["ORIG_STACK_NAME"] = os.environ["ORIG_STACK_NAME"]
+        if "ORIG_STACK_NAME" in environ:
+            ret["ORIG_STACK_NAME"] = environ["ORIG_STACK_NAME"]
             if "STACK_NAME" not in ret:
                 ret["STACK_NAME"] = component + "-" + ret["ORIG_STACK_NAME"] + "-" + ret["paramEnvId"]
-        for k, v in list(os.environ.items()):
+        for k, v in list(environ.items()):
             if k.startswith("ORIG_") and k.endswith("_NAME"):
                 ret[k] = v
-        if "ORIG_DOCKER_NAME" in os.environ:
+        if "ORIG_DOCKER_NAME" in environ:
             if "DOCKER_NAME" not in ret:
                 ret["DOCKER_NAME"] = component + "/" + ret["paramEnvId"] + "-" + ret["ORIG_DOCKER_NAME"]
         if "JENKINS_JOB_PREFIX" not in ret:
@@ -452,6 +574,41 @@ def import_script(filename):
             arr = arr + next_arr
     return arr
 
+class ParsedFileCache(object):
+    """ Parsed contents of imported files keyed by path and modification time.
+    Callers get a deep copy since pre-processing modifies the documents in place.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, loader):
+        key = (loader.__name__, os.path.abspath(filename))
+        mtime = os.stat(filename).st_mtime
+        if key in self.entries and self.entries[key][0] == mtime:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.entries[key] = (mtime, loader(filename))
+        return deepcopy(self.entries[key][1])
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return "Import cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses"
+
+
+def _load_yaml_file(filename):
+    with open(filename) as yaml_file:
+        return yaml_load(yaml_file)
+
+PARSED_FILES = ParsedFileCache()
+
+
 def do_replace(line, filename):
     arr = []
     result = VAR_DECL_RE.match(line)
@@ -542,10 +699,8 @@ def _add_params(target, source, source_prop, use_value):
                 for k, val in list(list_item.items()):
                     target[k] = val['Default'] if use_value and 'Default' in val else PARAM_NOT_AVAILABLE
 
-def _get_params(data, template):
+def _template_params(data):
     params = OrderedDict()
-
-    # first load defaults for all parameters in "Parameters"
     if 'Parameters' in data:
         _add_params(params, data, 'Parameters', True)
         if 'Fn::Merge' in data['Parameters'] and 'Result' in data['Parameters']['Fn::Merge']:
@@ -559,7 +714,11 @@ def _get_params(data, template):
             _add_params(params, data['resources']['Parameters']['Fn::Merge'], 'Result', True)
         if 'Fn::ImportYaml' in data['resources']['Parameters'] and 'Result' in data['resources']['Parameters']['Fn::ImportYaml']:
             _add_params(params, data['resources']['Parameters']['Fn::ImportYaml'], 'Result', True)
+    return params
+
 
+def _run_params(template):
+    params = OrderedDict()
     params['STACK_NAME'] = PARAM_NOT_AVAILABLE
 
     if 'REGION' not in os.environ:
@@ -594,16 +753,97 @@ def _get_params(data, template):
     params["AWS::AccountId"] = params['ACCOUNT_ID']
     params["AWS::StackName"] = params['STACK_NAME']
 
-    # finally load AWS-provided and "Resources"
+    # finally load AWS-provided
     params["AWS::NotificationARNs"] = PARAM_NOT_AVAILABLE
     params["AWS::NoValue"] = PARAM_NOT_AVAILABLE
     params["AWS::StackId"] = PARAM_NOT_AVAILABLE
+    return params
+
+
+def _resource_params(data):
+    params = OrderedDict()
     _add_params(params, data, 'Resources', False)
     if "resources" in data:
         _add_params(params, data['resources'], 'Resources', False)
     return params
 
 
+def _get_params(data, template):
+    # first load defaults for all parameters in "Parameters"
+    params = _template_params(data)
+    # then values that stay the same for the whole run
+    params.update(_run_params(template))
+    # finally "Resources"
+    params.update(_resource_params(data))
+    return params
+
+
+PARAMETER_PATHS = re.compile(r"^(resources_)?Parameters_")
+RESOURCE_PATHS = re.compile(r"^((resources_)?Resources_|resources_)?/*$")
+
+
+class TemplateParams(OrderedDict):
+    """ Parameters visible to _preprocess_template, kept up to date incrementally.
+
+    The parameters have the same layers as _get_params: parameter defaults,
+    values that stay the same for the whole run and resource logical ids. The
+    run layer is resolved once and the other two are rebuilt only after a node
+    in the part of the template they are read from has been processed.
+    """
+    def __init__(self, root, template):
+        OrderedDict.__init__(self)
+        self.root = root
+        self.rebuilds = 0
+        self._run = _run_params(template)
+        self._template = OrderedDict()
+        self._resources = OrderedDict()
+        self._template_dirty = True
+        self._resources_dirty = True
+        self.refresh()
+
+    def touch(self, path):
+        if PARAMETER_PATHS.match(path):
+            self._template_dirty = True
+        elif RESOURCE_PATHS.match(path):
+            self._template_dirty = True
+            self._resources_dirty = True
+
+    def refresh(self):
+        if not (self._template_dirty or self._resources_dirty):
+            return
+        self.rebuilds += 1
+        if self._template_dirty:
+            self._template = _template_params(self.root)
+        if self._resources_dirty:
+            self._resources = _resource_params(self.root)
+            self.update(self._template)
+            self.update(self._run)
+            self.update(self._resources)
+        else:
+            for key, value in list(self._template.items()):
+                if key not in self._run and key not in self._resources:
+                    self[key] = value
+        self._template_dirty = False
+        self._resources_dirty = False
+
+
+class LocalParams(object):
+    """ Lookup of template parameters with values given next to a function
+    (for example the arguments of Fn::ImportYaml) layered on top
+    """
+    def __init__(self, local_params, params):
+        self.local_params = local_params
+        self.params = params
+
+    def __contains__(self, key):
+        return key in self.local_params or key in self.params
+
+    def __getitem__(self, key):
+        if key in self.local_params:
+            return self.local_params[key]
+        return self.params[key]
+
+
 # Applies recursively source to script inline expression
 
 
@@ -618,21 +858,40 @@ def apply_source(data, filename, optional, default):
             apply_source(k, filename, optional, default)
             apply_source(val, filename, optional, default)
 
+def _expand_to_fixpoint(data, templateParams, param_refresh_callback):
+    # expanded values may change parameters that other values depend on
+    while True:
+        data, changed = expand_vars_in_place(data, templateParams, None, [])
+        if not changed:
+            return data
+        param_refresh_callback()
+
 # returns new data
 
 
 def _preprocess_template(data, root, basefile, path, templateParams):
-    param_refresh_callback = lambda: templateParams.update(_get_params(root, basefile))
-    param_refresh_callback()
+    templateParams.touch(path)
+    templateParams.refresh()
+    data = _preprocess_node(data, root, basefile, path, templateParams)
+    templateParams.touch(path)
+    return data
+
+
+def _preprocess_node(data, root, basefile, path, templateParams):
+    def param_refresh_callback():
+        templateParams.touch(path)
+        templateParams.refresh()
     global gotImportErrors
     if isinstance(data, OrderedDict):
         if 'Fn::ImportFile' in data:
             val = data['Fn::ImportFile']
             file = expand_vars(val, templateParams, None, [])
             script_import = resolve_file(file, basefile)
+            if DEPENDENCIES:
+                DEPENDENCIES.add_import(file, basefile, script_import)
             if script_import:
                 data.clear()
-                contents = import_script(script_import)
+                contents = PARSED_FILES.get(script_import, import_script)
                 data['Fn::Join'] = ["", contents]
             else:
                 print("ERROR: " + val + ": Can't import file \"" + val +
@@ -643,23 +902,16 @@ def _preprocess_template(data, root, basefile, path, templateParams):
             val = data['Fn::ImportYaml']
             file = expand_vars(val, templateParams, None, [])
             yaml_file = resolve_file(file, basefile)
+            if DEPENDENCIES:
+                DEPENDENCIES.add_import(file, basefile, yaml_file)
             del data['Fn::ImportYaml']
             if yaml_file:
-                contents = yaml_load(open(yaml_file))
-                params = OrderedDict(list(templateParams.items()))
-                params.update(data)
-                contents = expand_vars(contents, params, None, [])
+                contents = PARSED_FILES.get(yaml_file, _load_yaml_file)
+                contents, _ = expand_vars_in_place(contents, LocalParams(data, templateParams), None, [])
                 data['Fn::ImportYaml'] = OrderedDict()
                 data['Fn::ImportYaml']['Result'] = contents
                 param_refresh_callback()
-                while True:
-                    expanded_result = expand_vars(contents, templateParams, None, [])
-                    if expanded_result == contents:
-                        break
-                    else:
-                        contents.clear()
-                        contents.update(expanded_result)
-                        param_refresh_callback()
+                contents = _expand_to_fixpoint(contents, templateParams, param_refresh_callback)
                 data.clear()
                 if isinstance(contents, OrderedDict):
                     for k, val in list(contents.items()):
@@ -712,14 +964,7 @@ def _preprocess_template(data, root, basefile, path, templateParams):
                 print("ERROR: " + path + ": Unsupported " + str(type(merge)))
                 gotImportErrors = True
             param_refresh_callback()
-            while True:
-                expanded_result = expand_vars(result, templateParams, None, [])
-                if expanded_result == result:
-                    break
-                else:
-                    result.clear()
-                    result.update(expanded_result)
-                    param_refresh_callback()
+            result = _expand_to_fixpoint(result, templateParams, param_refresh_callback)
             if not merge_list:
                 del data['Fn::Merge']
                 return result
@@ -746,7 +991,9 @@ def _preprocess_template(data, root, basefile, path, templateParams):
                 param_refresh_callback()
             for k, val in list(data.items()):
                 if k != 'Parameters':
-                    data[k] = expand_vars(_preprocess_template(val, root, basefile, path + k + "_", templateParams), templateParams, None, [])
+                    data[k], _ = expand_vars_in_place(
+                        _preprocess_template(val, root, basefile, path + k + "_", templateParams),
+                        templateParams, None, [])
     elif isinstance(data, list):
         for i in range(0, len(data)):
             data[i] = _preprocess_template(data[i], root, basefile, path + str(i) + "_", templateParams)
@@ -803,8 +1050,8 @@ def import_scripts(data, basefile):
     global gotImportErrors
     gotImportErrors = False
 
-    data = expand_vars(data, _get_params(data, basefile), None, [])
-    data = _preprocess_template(data, data, basefile, "", _get_params(data, basefile))
+    data, _ = expand_vars_in_place(data, _get_params(data, basefile), None, [])
+    data = _preprocess_template(data, data, basefile, "", TemplateParams(data, basefile))
     data = _check_refs(data, basefile, "", _get_params(data, basefile), False)
     if gotImportErrors:
         sys.exit(1)
@@ -906,6 +1153,46 @@ def yaml_to_dict(yaml_file_to_convert, merge=[]):
     return data
 
 
+def _dependencies_unchanged(dependencies):
+    for filename, digest in list(dependencies["files"].items()):
+        if file_digest(filename) != digest:
+            return False
+    for filename, basefile, resolved in dependencies["imports"]:
+        if resolve_file(filename, basefile) != resolved:
+            return False
+    for stack_region, stack_name, stack_param, value in dependencies["stackrefs"]:
+        if _resolve_stackref(stack_region, stack_name, stack_param) != value:
+            return False
+    return True
+
+
+def cached_yaml_to_dict(yaml_file_to_convert, merge=[]):
+    """ Same as yaml_to_dict, but reuses the result of an earlier run from the
+    template cache if the template, the files it imports, the resolved parameters
+    and the stack outputs it references are all unchanged. Setting
+    NDT_TEMPLATE_CACHE=false disables the cache.
+    """
+    if not cache_enabled():
+        return yaml_to_dict(yaml_file_to_convert, merge)
+    global DEPENDENCIES
+    merge = list(merge or [])
+    cache = TemplateCache()
+    key = cache.key(yaml_file_to_convert, merge, _run_params(yaml_file_to_convert))
+    data = cache.get(key, _dependencies_unchanged)
+    if data is not None:
+        return data
+    DEPENDENCIES = TemplateDependencies()
+    try:
+        DEPENDENCIES.add_file(yaml_file_to_convert)
+        for merge_file in merge:
+            DEPENDENCIES.add_file(merge_file)
+        data = yaml_to_dict(yaml_file_to_convert, list(merge))
+        cache.put(key, DEPENDENCIES, data)
+    finally:
+        DEPENDENCIES = None
+    return data
+
+
 def yaml_to_json(yaml_file_to_convert, merge=[]):
     data = yaml_to_dict(yaml_file_to_convert, merge)
     return json_save(data)
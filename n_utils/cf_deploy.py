@@ -25,56 +25,131 @@ import sys
 import time
 import six
 from datetime import datetime
+from io import BytesIO
 import boto3
 
 from botocore.exceptions import ClientError
-from pygments import highlight, lexers, formatters
-from pygments.styles import get_style_by_name
 from termcolor import colored
 
 from . import aws_infra_util
 from .cf_utils import get_images
 from .log_events import CloudWatchLogsThread, CloudFormationEvents, fmttime
+from .waiter import Waiter
 
 REDIRECTED = False
-
-
-def log_data(data, output_format="yaml"):
-    if output_format == "yaml":
-        formatted = aws_infra_util.yaml_save(data)
-    else:
-        formatted = aws_infra_util.json_save(data)
+# the stack events end the wait for a stack operation, polling the stack status
+# only covers events that the event thread misses
+STATUS_POLL_INTERVAL = 30
+# dry runs can keep their change sets for deploys of the same template and
+# parameters, which find them by this prefix and the hash in the description
+CHANGE_SET_PREFIX = "ndt-template-hash:"
+# templates in CF_BUCKET are stored once by content
+TEMPLATE_KEY_PREFIX = "ndt-templates/"
+UPLOADED_TEMPLATES = set()
+OUTPUT_ENV = "NDT_DEPLOY_OUTPUT"
+OUTPUT_MODES = ["auto", "highlighted", "plain", "summary"]
+
+
+def output_mode():
+    """ How log_data prints templates and change sets: highlighted, plain or
+    summary. The default is to highlight when stdout is a terminal.
+    """
+    mode = os.environ.get(OUTPUT_ENV, "auto").lower()
+    if mode not in OUTPUT_MODES or mode == "auto":
+        return "highlighted" if os.isatty(1) else "plain"
+    return mode
+
+
+def _highlight(formatted, output_format):
+    from pygments import highlight, lexers, formatters
+    from pygments.styles import get_style_by_name
     lexer = lexers.get_lexer_by_name(output_format)
     formatter = formatters.get_formatter_by_name("256")
     formatter.__init__(style=get_style_by_name('emacs'))
+    return highlight(formatted, lexer, formatter)
+
+
+def _summary(data):
+    lines = []
+    if 'Resources' in data:
+        types = collections.Counter([resource.get('Type', '') for resource
+                                     in data['Resources'].values()
+                                     if isinstance(resource, dict)])
+        lines.append("Resources: " + str(len(data['Resources'])))
+        for res_type, count in sorted(types.items()):
+            lines.append("  %4d %s" % (count, res_type))
+        lines.append("Parameters: " + str(len(data.get('Parameters', {}))))
+        for name, param in data.get('Parameters', {}).items():
+            lines.append("  " + name + " (" + str(param.get('Type', '')) + "): " +
+                         str(param.get('Default', '')))
+        lines.append("Outputs: " + str(len(data.get('Outputs', {}))))
+    elif 'Changes' in data:
+        lines.append("Changes: " + str(len(data['Changes'])))
+        for change in data['Changes']:
+            resource = change.get('ResourceChange', {})
+            line = "  " + " ".join([str(resource.get(key, '')) for key in
+                                    ['Action', 'LogicalResourceId', 'ResourceType']])
+            if resource.get('Replacement'):
+                line += " Replacement: " + resource['Replacement']
+            lines.append(line)
+    else:
+        return None
+    return os.linesep.join(lines)
+
+
+def log_data(data, output_format="yaml", formatted=None):
+    """ Logs data in the output mode. formatted can be given to reuse data
+    already serialized in output_format for plain output.
+    """
+    mode = output_mode()
+    if mode == "summary":
+        summary = _summary(data)
+        if summary is not None:
+            log(os.linesep + summary)
+            return
+    if formatted is None or mode == "highlighted":
+        if output_format == "yaml":
+            formatted = aws_infra_util.yaml_save(data)
+        else:
+            formatted = aws_infra_util.json_save(data)
     if not isinstance(formatted, six.string_types):
         formatted = str(formatted, 'UTF-8')
-    colored_yaml = os.linesep + highlight(formatted, lexer, formatter)
-    log(colored_yaml)
+    if mode == "highlighted":
+        formatted = _highlight(formatted, output_format)
+    log(os.linesep + formatted)
 
 def log(message):
     os.write(1, (colored(fmttime(datetime.now()), 'yellow') + " "
                  + message + os.linesep).encode(locale.getpreferredencoding()))
 
 
-def update_stack(stack_name, template, params, dry_run=False, session=None, tags=None):
+def update_stack(stack_name, template, params, dry_run=False, session=None, tags=None,
+                 keep_change_set=False):
     if session:
         clf = session.client('cloudformation')
     else:
         clf = boto3.client('cloudformation')
     chset_name = stack_name + "-" + time.strftime("%Y%m%d%H%M%S",
                                                   time.gmtime())
-    params = get_template_arguments(stack_name, template, params)
-    params['ChangeSetName'] = chset_name
+    params = get_template_arguments(stack_name, template, params, session=session)
     if tags:
         params["Tags"] = tags
-    chset_id = clf.create_change_set(**params)['Id']
-    chset_data = clf.describe_change_set(ChangeSetName=chset_id)
+    description = CHANGE_SET_PREFIX + template_hash(template, dict([(key, value) for key, value
+                                                                    in params.items() if key not in
+                                                                    ["TemplateURL", "TemplateBody"]]))
+    chset_id = find_change_set(clf, stack_name, description)
+    reused = chset_id is not None
+    if reused:
+        log("Using change set " + chset_id + " kept from a dry run with the same template and " +
+            "parameters")
+    else:
+        params['ChangeSetName'] = chset_name
+        params['Description'] = description
+        chset_id = clf.create_change_set(**params)['Id']
+    chset_data = Waiter("change-set", delay=1, max_delay=10).wait(
+        lambda: clf.describe_change_set(ChangeSetName=chset_id),
+        done=lambda data: "_COMPLETE" in data['Status'] or data['Status'] == "FAILED")
     status = chset_data['Status']
-    while "_COMPLETE" not in status and status != "FAILED":
-        time.sleep(5)
-        chset_data = clf.describe_change_set(ChangeSetName=chset_id)
-        status = chset_data['Status']
     if status == "FAILED":
         clf.delete_change_set(ChangeSetName=chset_id)
         if 'StatusReason' in chset_data \
@@ -97,11 +172,27 @@ def update_stack(stack_name, template, params, dry_run=False, session=None, tags
         log_data(chset_data)
         if not dry_run:
             clf.execute_change_set(ChangeSetName=chset_id)
+        elif keep_change_set or reused:
+            log("Kept change set " + chset_id + " for a deploy with the same template and " +
+                "parameters")
         else:
             clf.delete_change_set(ChangeSetName=chset_id)
     return
 
 
+def find_change_set(clf, stack_name, description):
+    """ The id of a change set of the stack that has the description and can be
+    executed or None
+    """
+    for page in clf.get_paginator('list_change_sets').paginate(StackName=stack_name):
+        for summary in page.get('Summaries', []):
+            if summary.get('Description') == description and \
+               summary.get('Status') == "CREATE_COMPLETE" and \
+               summary.get('ExecutionStatus') == "AVAILABLE":
+                return summary['ChangeSetId']
+    return None
+
+
 def create_stack(stack_name, template, params, session=None, tags=None):
     if session:
         clf = session.client('cloudformation')
@@ -138,15 +229,15 @@ def get_stack_operation(stack_name, session=None):
 def get_end_status(stack_name, session=None):
     logs = CloudWatchLogsThread(log_group_name=stack_name)
     logs.start()
-    cf_events = CloudFormationEvents(log_group_name=stack_name)
+    cf_events = CloudFormationEvents(log_group_name=stack_name, session=session)
     cf_events.start()
     log("Waiting for stack operation to complete:")
     if session:
         clf = session.client('cloudformation')
     else:
         clf = boto3.client('cloudformation')
-    status = "_IN_PROGRESS"
-    while True:
+
+    def poll_status():
         stack_info = clf.describe_stacks(StackName=stack_name)
         status = stack_info['Stacks'][0]['StackStatus']
         if "ROLLBACK" in status:
@@ -154,12 +245,14 @@ def get_end_status(stack_name, session=None):
         else:
             color = "\033[32;1m"
         log(color + "Status: " + status + "\033[m")
-        if not status.endswith("_IN_PROGRESS"):
-            logs.stop()
-            cf_events.stop()
-            break
-        time.sleep(5)
-    return status
+        return status
+    waiter = Waiter("stack-operation", delay=STATUS_POLL_INTERVAL,
+                    max_delay=STATUS_POLL_INTERVAL, sleep=cf_events.wait_stack_end)
+    try:
+        return waiter.wait(poll_status, done=lambda status: not status.endswith("_IN_PROGRESS"))
+    finally:
+        logs.stop()
+        cf_events.stop()
 
 
 def create_or_update_stack(stack_name, json_small, params_doc, session=None, tags=None):
@@ -168,6 +261,37 @@ def create_or_update_stack(stack_name, json_small, params_doc, session=None, tag
     return get_end_status(stack_name, session=session)
 
 
+def template_hash(template, arguments=None):
+    """ md5 of the template and the other arguments of a stack operation
+    """
+    template_md5 = hashlib.md5()
+    template_md5.update(template.encode("utf-8"))
+    if arguments is not None:
+        template_md5.update(aws_infra_util.json_save_small(arguments).encode("utf-8"))
+    return template_md5.hexdigest()
+
+
+def upload_template(s3cli, bucket, template):
+    """ Stores the template in the bucket under a key derived from its content
+    and returns the key. Stacks with identical templates share the object and
+    templates that are already in the bucket are not uploaded again.
+    """
+    key = TEMPLATE_KEY_PREFIX + template_hash(template) + ".json"
+    if (bucket, key) in UPLOADED_TEMPLATES:
+        return key
+    try:
+        s3cli.head_object(Bucket=bucket, Key=key)
+        log("Template already in s3://" + bucket + "/" + key)
+    except ClientError as err:
+        if err.response['Error']['Code'] not in ["404", "NoSuchKey", "NotFound", "403"]:
+            raise
+        # upload_fileobj streams the body and switches to a multipart upload
+        # for large objects
+        s3cli.upload_fileobj(BytesIO(template.encode("utf-8")), bucket, key)
+    UPLOADED_TEMPLATES.add((bucket, key))
+    return key
+
+
 def get_template_arguments(stack_name, template, params, session=None):
     params = {"StackName": stack_name,
               "Parameters": params, "Capabilities": ["CAPABILITY_IAM", "CAPABILITY_NAMED_IAM"]}
@@ -177,11 +301,7 @@ def get_template_arguments(stack_name, template, params, session=None):
             s3cli = session.client('s3')
         else:
             s3cli = boto3.client('s3')
-        template_hash = hashlib.md5()
-        template_hash.update(template)
-        template_hash.update(aws_infra_util.json_save_small(params))
-        key = stack_name + '-' + template_hash.hexdigest()
-        s3cli.put_object(Body=template, Bucket=bucket, Key=key)
+        key = upload_template(s3cli, bucket, template)
         params['TemplateURL'] = "https://s3.amazonaws.com/" + bucket + "/" + key
     else:
         params["TemplateBody"] = template
@@ -195,25 +315,30 @@ def delete(stack_name, regn, session=None):
         clf = session.client('cloudformation')
     else:
         clf = boto3.client('cloudformation')
-    cf_events = CloudFormationEvents(log_group_name=stack_name)
+    cf_events = CloudFormationEvents(log_group_name=stack_name, session=session)
     cf_events.start()
     clf.delete_stack(StackName=stack_name)
-    while True:
+
+    def poll_status():
         try:
             stack_info = clf.describe_stacks(StackName=stack_name)
-            status = stack_info['Stacks'][0]['StackStatus']
-            if not status.endswith("_IN_PROGRESS") and not status.endswith("_COMPLETE"):
-                raise Exception("Delete stack failed: end state " + status)
-            log("Status: \033[32;1m" + status + "\033[m")
-            time.sleep(5)
         except ClientError as err:
-            cf_events.stop()
             if err.response['Error']['Code'] == 'ValidationError' and \
                err.response['Error']['Message'].endswith('does not exist'):
-                log("Status: \033[32;1mDELETE_COMPLETE\033[m")
-                break
-            else:
-                raise
+                return "DELETE_COMPLETE"
+            raise
+        status = stack_info['Stacks'][0]['StackStatus']
+        if not status.endswith("_IN_PROGRESS") and not status.endswith("_COMPLETE"):
+            raise Exception("Delete stack failed: end state " + status)
+        log("Status: \033[32;1m" + status + "\033[m")
+        return status
+    waiter = Waiter("stack-delete", delay=STATUS_POLL_INTERVAL,
+                    max_delay=STATUS_POLL_INTERVAL, sleep=cf_events.wait_stack_end)
+    try:
+        waiter.wait(poll_status, done=lambda status: status == "DELETE_COMPLETE")
+    finally:
+        cf_events.stop()
+    log("Status: \033[32;1mDELETE_COMPLETE\033[m")
 
 
 def resolve_ami(template_doc, session=None):
@@ -249,7 +374,7 @@ def resolve_ami(template_doc, session=None):
     return ami_id, ami_name, ami_created
 
 
-def deploy(stack_name, yaml_template, regn, dry_run=False, session=None):
+def deploy(stack_name, yaml_template, regn, dry_run=False, session=None, keep_change_set=False):
     os.environ['AWS_DEFAULT_REGION'] = regn
     os.environ['REGION'] = regn
     global REDIRECTED
@@ -257,7 +382,7 @@ def deploy(stack_name, yaml_template, regn, dry_run=False, session=None):
         # Disable buffering, from http://stackoverflow.com/questions/107705/disable-output-buffering
         sys.stdout = Unbuffered(sys.__stdout__)
         REDIRECTED = True
-    template_doc = aws_infra_util.yaml_to_dict(yaml_template)
+    template_doc = aws_infra_util.cached_yaml_to_dict(yaml_template)
     ami_id, ami_name, ami_created = resolve_ami(template_doc, session=session)
 
     log("**** Deploying stack '" + stack_name + "' with template '" +
@@ -291,7 +416,7 @@ def deploy(stack_name, yaml_template, regn, dry_run=False, session=None):
     json_small = aws_infra_util.json_save_small(template_doc)
 
     log("**** Final template ****")
-    log_data(template_doc, output_format="json")
+    log_data(template_doc, output_format="json", formatted=json_small)
 
     # Create/update stack
     params_doc = []
@@ -310,7 +435,8 @@ def deploy(stack_name, yaml_template, regn, dry_run=False, session=None):
         if not (status == "CREATE_COMPLETE" or status == "UPDATE_COMPLETE"):
             sys.exit("Stack operation failed: end state " + status)
     elif get_stack_operation(stack_name).__name__ == "update_stack":
-        update_stack(stack_name, json_small, params_doc, dry_run=True, session=session, tags=tags)
+        update_stack(stack_name, json_small, params_doc, dry_run=True, session=session, tags=tags,
+                     keep_change_set=keep_change_set)
     log("Done!")
 
 
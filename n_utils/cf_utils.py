@@ -37,6 +37,7 @@ import six
 from collections import deque, OrderedDict
 from os.path import expanduser
 from threading import Event, Lock, Thread
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 
 import boto3
@@ -47,9 +48,13 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from n_vault import Vault
 from n_utils.mfa_utils import mfa_read_token, mfa_generate_code
+from n_utils.waiter import Waiter
 
 NoneType = type(None)
 ACCOUNT_ID = None
+ACCOUNT_LOCK = Lock()
+# creating boto3 clients from the default session is not thread safe
+CLIENT_LOCK = Lock()
 ROLE_NAME = None
 INSTANCE_IDENTITY_URL = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
 USER_DATA_URL = 'http://169.254.169.254/latest/user-data'
@@ -505,14 +510,24 @@ def assume_role(role_arn, mfa_token_name=None, duration_minutes=60):
     return response['Credentials']
 
 
+def locked_client(service, **kwargs):
+    """ Create a boto3 client from the default session. Used by everything
+    that parallel parameter loads call
+    """
+    with CLIENT_LOCK:
+        return boto3.client(service, **kwargs)
+
+
 def resolve_account():
     global ACCOUNT_ID
     if not ACCOUNT_ID:
-        try:
-            sts = boto3.client("sts")
-            ACCOUNT_ID = sts.get_caller_identity()['Account']
-        except BaseException:
-            pass
+        with ACCOUNT_LOCK:
+            if not ACCOUNT_ID:
+                try:
+                    sts = locked_client("sts")
+                    ACCOUNT_ID = sts.get_caller_identity()['Account']
+                except BaseException:
+                    pass
     return ACCOUNT_ID
 
 def assumed_role_name():
@@ -589,7 +604,7 @@ def regions():
 def stacks():
     """Get list of stack names for the currently default region"""
     set_region()
-    pages = boto3.client("cloudformation").get_paginator('describe_stacks')
+    pages = locked_client("cloudformation").get_paginator('describe_stacks')
     for page in pages.paginate():
         for stack in page.get('Stacks', []):
             yield stack['StackName']
@@ -605,7 +620,7 @@ def stack_params_and_outputs(regn, stack_name):
 def stack_params_and_outputs_and_stack(regn, stack_name):
     """ Get parameters and outputs from a stack as a single dict and the full stack
     """
-    cloudformation = boto3.client("cloudformation", region_name=regn)
+    cloudformation = locked_client("cloudformation", region_name=regn)
     retry = 0
     stack = {}
     resources = {}
@@ -664,15 +679,12 @@ def share_to_another_region(ami_id, regn, ami_name, account_ids, timeout_sec=900
         resp = ec2.copy_image(SourceRegion=region(), SourceImageId=ami_id,
                               Name=ami_name)
         ami_id = resp['ImageId']
-    status = "initial"
-    start = time.time()
-    while status != 'available':
-        time.sleep(2)
-        if time.time() - start > timeout_sec:
-            raise Exception("Failed waiting for status 'available' for " +
-                            ami_id + " (timeout: " + str(timeout_sec) + ")")
-        images_resp = ec2.describe_images(ImageIds=[ami_id])
-        status = images_resp['Images'][0]['State']
+    Waiter("image", delay=2, max_delay=30, timeout=timeout_sec,
+           timeout_message="Failed waiting for status 'available' for " +
+           ami_id + " (timeout: " + str(timeout_sec) + ")",
+           pending_codes=["InvalidAMIID.NotFound"])\
+        .wait(lambda: ec2.describe_images(ImageIds=[ami_id])['Images'][0]['State'],
+              done=lambda status: status == 'available')
     perms = {"Add": []}
     my_acco = resolve_account()
     for acco in account_ids:
@@ -689,7 +701,7 @@ def _has_job_tag(image, image_name_prefix):
 
 def get_images(image_name_prefix, job_tag_function=_has_job_tag):
     image_name_prefix = re.sub(r'\W', '_', image_name_prefix)
-    ec2 = boto3.client('ec2')
+    ec2 = locked_client('ec2')
     ami_data = ec2.describe_images(Filters=[{'Name': 'tag-value',
                                              'Values': [image_name_prefix + "_*"]}])
     if len(ami_data['Images']) > 0:
@@ -750,17 +762,58 @@ def register_private_dns(dns_name, hosted_zone):
         ]})
 
 
+INTERPOLATE_CHUNK_SIZE = 1024 * 1024
+VAULT_PREFETCH_THREADS = 8
+
+
+class VaultSecrets(object):
+    """ Vault keys and the values looked up during one run. Works both as the
+    vault and as the vault_keys argument of the expansion functions.
+    """
+    def __init__(self, vault=None, threads=VAULT_PREFETCH_THREADS):
+        self.vault = vault if vault else Vault()
+        self.keys = set(self.vault.list_all())
+        self.values = {}
+        self.threads = threads
+
+    def __contains__(self, name):
+        return name in self.keys
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, name):
+        if name not in self.values:
+            self.values[name] = self.vault.lookup(name)
+        return self.values[name]
+
+    def prefetch(self, names):
+        """ Look up all not yet fetched vault keys in names, in parallel if
+        there are several of them
+        """
+        missing = sorted(set([name for name in names if name in self.keys and name not in self.values]))
+        if len(missing) > 1 and self.threads > 1:
+            pool = ThreadPool(min(self.threads, len(missing)))
+            try:
+                values = pool.map(self.vault.lookup, missing)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            values = [self.vault.lookup(name) for name in missing]
+        self.values.update(zip(missing, values))
+
+
 def interpolate_file(file_name, destination=None, stack_name=None,
-                     use_vault=False, encoding='utf-8'):
+                     use_vault=False, encoding='utf-8', chunk_size=INTERPOLATE_CHUNK_SIZE,
+                     vault_threads=VAULT_PREFETCH_THREADS):
     if not destination:
         destination = file_name
-        dstfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(file_name),
-                                              prefix=os.path.basename(file_name),
-                                              delete=False)
-    else:
-        dstfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(destination),
-                                              prefix=os.path.basename(destination),
-                                              delete=False)
+    # write through symlinks instead of replacing them
+    destination = os.path.realpath(destination)
     if not stack_name:
         info = InstanceInfo()
         params = info.stack_data_dict()
@@ -769,23 +822,214 @@ def interpolate_file(file_name, destination=None, stack_name=None,
     vault = None
     vault_keys = []
     if use_vault:
-        vault = Vault()
-        vault_keys = vault.list_all()
-    with io.open(file_name, "r", encoding=encoding) as _infile:
-        with dstfile as _outfile:
-            for line in _infile:
-                line = _process_line(line, params, vault, vault_keys)
-                _outfile.write(line.encode(encoding))
-    shutil.copy(dstfile.name, destination)
-    os.unlink(dstfile.name)
+        vault = VaultSecrets(threads=vault_threads)
+        vault_keys = vault
+    dstfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(destination),
+                                          prefix=os.path.basename(destination),
+                                          delete=False)
+    try:
+        with io.open(file_name, "r", encoding=encoding) as _infile:
+            with dstfile as _outfile:
+                rest = ""
+                resolved = {}
+                while True:
+                    chunk = _infile.read(chunk_size)
+                    if not chunk:
+                        break
+                    chunk = rest + chunk
+                    # only process complete lines, references do not span lines
+                    end = chunk.rfind("\n") + 1
+                    rest = chunk[end:]
+                    _outfile.write(_interpolate_chunk(chunk[:end], params, vault, vault_keys,
+                                                      resolved).encode(encoding))
+                _outfile.write(_interpolate_chunk(rest, params, vault, vault_keys,
+                                                  resolved).encode(encoding))
+        if os.path.exists(destination):
+            dst_stat = os.stat(destination)
+            shutil.copymode(destination, dstfile.name)
+            if (dst_stat.st_uid, dst_stat.st_gid) != (os.geteuid(), os.getegid()):
+                try:
+                    os.chown(dstfile.name, dst_stat.st_uid, dst_stat.st_gid)
+                except OSError:
+                    # not allowed to give the file away, overwrite the
+                    # destination in place to keep its owner
+                    shutil.copyfile(dstfile.name, destination)
+                    os.unlink(dstfile.name)
+                    return
+        _replace_file(dstfile.name, destination)
+    except Exception:
+        if os.path.exists(dstfile.name):
+            os.unlink(dstfile.name)
+        raise
+
+
+def _interpolate_chunk(chunk, params, vault, vault_keys, resolved):
+    """ Expand all references in a chunk of complete lines with one plan. If
+    a substituted value needs scanning again, fall back to expanding the lines
+    with references one at a time.
+    """
+    plan = _compile_param_plan(CHUNK_PARAM_RE, chunk)
+    if not plan[1]:
+        return chunk
+    if isinstance(vault, VaultSecrets):
+        vault.prefetch([reference[0] for reference in plan[1]])
+    ret = _expand_plan(plan, lambda reference: _resolve_param(reference, params, vault, vault_keys),
+                       resolved)
+    if ret is not RESCAN:
+        return ret
+    marker = MARKERS[PARAM_RE.pattern]
+    ret = []
+    pos = 0
+    start = chunk.find(marker)
+    while start >= 0:
+        line_start = chunk.rfind("\n", 0, start) + 1
+        line_end = chunk.find("\n", start) + 1
+        if not line_end:
+            line_end = len(chunk)
+        ret.append(chunk[pos:line_start])
+        ret.append(_process_line(chunk[line_start:line_end], params, vault, vault_keys, resolved))
+        pos = line_end
+        start = chunk.find(marker, pos)
+    ret.append(chunk[pos:])
+    return "".join(ret)
+
+
+def _replace_file(source, destination):
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    else:
+        os.rename(source, destination)
 
 
 PARAM_RE = re.compile(r"\$\{([^\$\{\}]*)\}", re.M)
 SIMPLE_PARAM_RE = re.compile(r"\$([a-zA-Z0-9_]*)", re.M)
 DOUBLE_PARANTHESIS_RE = re.compile(r'\(\(([^)]+)\)\)', re.M)
+# PARAM_RE for text with many lines, a reference never spans lines
+CHUNK_PARAM_RE = re.compile(r"\$\{([^\$\{\}\n]*)\}", re.M)
+# Substituted values with these characters may form new references with
+# the surrounding text and need the expression to be scanned again
+# Strings without the marker can not contain references and skip the plans
+MARKERS = {
+    PARAM_RE.pattern: "${",
+    SIMPLE_PARAM_RE.pattern: "$",
+    DOUBLE_PARANTHESIS_RE.pattern: "(("
+}
+# The text around the name of a reference
+REFERENCE_TEXT = {
+    PARAM_RE.pattern: ("${", "}"),
+    CHUNK_PARAM_RE.pattern: ("${", "}"),
+    SIMPLE_PARAM_RE.pattern: ("$", ""),
+    DOUBLE_PARANTHESIS_RE.pattern: ("((", "))")
+}
+RESCAN_RE = {
+    PARAM_RE.pattern: re.compile(r"[\$\{\}]"),
+    SIMPLE_PARAM_RE.pattern: re.compile(r"\$"),
+    DOUBLE_PARANTHESIS_RE.pattern: re.compile(r"[\(\)]")
+}
+SUBSTITUTION_PLAN_CACHE_SIZE = 4096
+
+
+class SubstitutionPlans(object):
+    """ Least recently used cache of strings split into literal segments and
+    parameter references for one of the parameter expressions
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.plans = OrderedDict()
+
+    def get(self, RE, line, compile_plan):
+        key = (RE.pattern, line)
+        plan = self.plans.pop(key, None)
+        if plan is None:
+            plan = compile_plan(RE, line)
+            if len(self.plans) >= self.max_size:
+                self.plans.popitem(last=False)
+        self.plans[key] = plan
+        return plan
+
+SUBSTITUTION_PLANS = SubstitutionPlans(SUBSTITUTION_PLAN_CACHE_SIZE)
+
+
+def _compile_plan(RE, line, reference):
+    """ Split line into literal segments and the references between them.
+    There is always one literal more than there are references.
+    """
+    parts = RE.split(line)
+    prefix, suffix = REFERENCE_TEXT[RE.pattern]
+    seen = {}
+    references = []
+    for name in parts[1::2]:
+        if name not in seen:
+            seen[name] = reference(name, prefix + name + suffix)
+        references.append(seen[name])
+    return tuple(parts[0::2]), tuple(references)
+
+
+def _compile_simple_plan(RE, line):
+    return _compile_plan(RE, line, lambda param_name, raw: (param_name, raw))
+
+
+def _compile_param_plan(RE, line):
+    def reference(param_name, raw):
+        for transform in list(VAR_OPERATIONS.keys()):
+            if transform in param_name:
+                name_arg = param_name.split(transform, 1)
+                return (name_arg[0], transform, name_arg[1], raw)
+        return (param_name, None, None, raw)
+    return _compile_plan(RE, line, reference)
+
+
+# Marks a substituted value that needs the whole expression to be scanned again
+RESCAN = object()
+
+
+def _expand_plan(plan, resolve, resolved):
+    literals, references = plan
+    ret = [literals[0]]
+    for i in range(0, len(references)):
+        reference = references[i]
+        if resolved is not None and reference in resolved:
+            value = resolved[reference]
+        else:
+            value = resolve(reference)
+            if resolved is not None:
+                resolved[reference] = value
+        if value is RESCAN or isinstance(value, OrderedDict):
+            return value
+        ret.append(value)
+        ret.append(literals[i + 1])
+    return "".join(ret)
 
 
 def _apply_simple_regex(RE, line, params, vault, vault_keys):
+    if MARKERS[RE.pattern] not in line:
+        return line
+    plan = SUBSTITUTION_PLANS.get(RE, line, _compile_simple_plan)
+    if not plan[1]:
+        return line
+    rescan = RESCAN_RE[RE.pattern]
+    def resolve(reference):
+        param_name, raw = reference
+        param_value = None
+        if param_name in vault_keys:
+            param_value = vault.lookup(param_name)
+        elif param_name in params:
+            param_value = params[param_name]
+        if isinstance(param_value, NoneType):
+            return raw
+        if isinstance(param_value, OrderedDict):
+            return param_value
+        param_value = str(param_value)
+        if rescan.search(param_value):
+            return RESCAN
+        return param_value
+    ret = _expand_plan(plan, resolve, None)
+    if ret is RESCAN:
+        return _rescan_simple_regex(RE, line, params, vault, vault_keys)
+    return ret
+
+
+def _rescan_simple_regex(RE, line, params, vault, vault_keys):
     ret = line
     next_start = 0
     match = RE.search(line)
@@ -809,18 +1053,11 @@ def _apply_simple_regex(RE, line, params, vault, vault_keys):
 
 def expand_vars(line, params, vault, vault_keys):
     if isinstance(line, OrderedDict) or isinstance(line, dict):
-        ret = OrderedDict(list(line.items()))
-        if "Fn::" in [x[:4] for x in list(ret.keys())]:
-            return expand_only_double_paranthesis_params(ret, params, vault, vault_keys)
-        for key, value in list(line.items()):
-            if key.startswith("Fn::"):
-                new_value = expand_only_double_paranthesis_params(value, params, vault, vault_keys)
-                ret = OrderedDict([(key, new_value) if k == key else (k, v) for k, v in list(ret.items())])
-            else:
-                new_key = expand_vars(key, params, vault, vault_keys)
-                new_value = expand_vars(value, params, vault, vault_keys)
-                ret = OrderedDict([(new_key, new_value) if k == key else (k, v) for k, v in list(ret.items())])
-        return ret
+        if "Fn::" in [x[:4] for x in list(line.keys())]:
+            return expand_only_double_paranthesis_params(line, params, vault, vault_keys)
+        return OrderedDict([(expand_vars(key, params, vault, vault_keys),
+                             expand_vars(value, params, vault, vault_keys))
+                            for key, value in list(line.items())])
     if isinstance(line, list):
         return [expand_vars(x, params, vault, vault_keys) for x in line]
     if isinstance(line, six.string_types):
@@ -835,12 +1072,9 @@ def expand_vars(line, params, vault, vault_keys):
 
 def expand_only_double_paranthesis_params(line, params, vault, vault_keys):
     if isinstance(line, OrderedDict) or isinstance(line, dict):
-        ret = OrderedDict(list(line.items()))
-        for key, value in list(line.items()):
-            new_key = expand_only_double_paranthesis_params(key, params, vault, vault_keys)
-            new_value = expand_only_double_paranthesis_params(value, params, vault, vault_keys)
-            ret = OrderedDict([(new_key, new_value) if k == key else (k, v) for k, v in list(ret.items())])
-        return ret
+        return OrderedDict([(expand_only_double_paranthesis_params(key, params, vault, vault_keys),
+                             expand_only_double_paranthesis_params(value, params, vault, vault_keys))
+                            for key, value in list(line.items())])
     if isinstance(line, list):
         return [expand_only_double_paranthesis_params(x, params, vault, vault_keys) for x in line]
     if isinstance(line, six.string_types):
@@ -850,7 +1084,94 @@ def expand_only_double_paranthesis_params(line, params, vault, vault_keys):
         return ret
     return line
 
-def _process_line(line, params, vault, vault_keys):
+def expand_vars_in_place(data, params, vault, vault_keys):
+    """ Expand variables like expand_vars, but rewrite mappings and lists in
+    place in a single walk. Returns the expanded value (data itself for ordered
+    mappings and lists) and a flag telling whether anything changed, so that
+    callers iterating to a fixpoint need not compare whole trees.
+    """
+    return _expand_in_place(data, params, vault, vault_keys, False)
+
+def _expand_in_place(data, params, vault, vault_keys, only_double_paranthesis):
+    if isinstance(data, dict):
+        if not isinstance(data, OrderedDict):
+            # like expand_vars, hand out ordered mappings for plain dicts
+            data = OrderedDict(list(data.items()))
+        if not only_double_paranthesis and "Fn::" in [x[:4] for x in list(data.keys())]:
+            only_double_paranthesis = True
+        changed = False
+        keys_changed = False
+        items = []
+        for key, value in list(data.items()):
+            new_key, key_changed = _expand_in_place(key, params, vault, vault_keys,
+                                                    only_double_paranthesis)
+            new_value, value_changed = _expand_in_place(value, params, vault, vault_keys,
+                                                        only_double_paranthesis)
+            items.append((new_key, new_value))
+            if key_changed:
+                keys_changed = True
+            elif new_value is not value:
+                data[key] = new_value
+            changed = changed or key_changed or value_changed
+        if keys_changed:
+            # one rebuild keeps the key order without copying the mapping per key
+            data.clear()
+            data.update(items)
+        return data, changed
+    if isinstance(data, list):
+        changed = False
+        for i in range(0, len(data)):
+            new_value, value_changed = _expand_in_place(data[i], params, vault, vault_keys,
+                                                        only_double_paranthesis)
+            if new_value is not data[i]:
+                data[i] = new_value
+            changed = changed or value_changed
+        return data, changed
+    if isinstance(data, six.string_types):
+        if only_double_paranthesis:
+            ret = expand_only_double_paranthesis_params(data, params, vault, vault_keys)
+        else:
+            ret = expand_vars(data, params, vault, vault_keys)
+        return ret, not isinstance(ret, six.string_types) or ret != data
+    return data, False
+
+def _process_line(line, params, vault, vault_keys, resolved=None):
+    """ Expand ${...} references in line. Callers that expand many lines with
+    the same parameters can pass in a dict as resolved to reuse the value of
+    each distinct reference.
+    """
+    if MARKERS[PARAM_RE.pattern] not in line:
+        return line
+    plan = SUBSTITUTION_PLANS.get(PARAM_RE, line, _compile_param_plan)
+    if not plan[1]:
+        return line
+    ret = _expand_plan(plan, lambda reference: _resolve_param(reference, params, vault, vault_keys),
+                       resolved)
+    if ret is RESCAN:
+        return _rescan_line(line, params, vault, vault_keys)
+    return ret
+
+
+def _resolve_param(reference, params, vault, vault_keys):
+    param_name, transform, arg, raw = reference
+    param_value = None
+    if param_name in vault_keys:
+        param_value = vault.lookup(param_name)
+    elif param_name in params:
+        param_value = params[param_name]
+    if transform:
+        if param_value and (PARAM_RE.search(param_value) or SIMPLE_PARAM_RE.search(param_value)):
+            param_value = None
+        else:
+            param_value = VAR_OPERATIONS[transform](param_value, arg)
+    if isinstance(param_value, NoneType) or isinstance(param_value, ParamNotAvailable):
+        return raw
+    if not isinstance(param_value, six.string_types) or RESCAN_RE[PARAM_RE.pattern].search(param_value):
+        return RESCAN
+    return param_value
+
+
+def _rescan_line(line, params, vault, vault_keys):
     ret = line
     next_start = 0
     match = PARAM_RE.search(line)
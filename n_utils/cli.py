@@ -27,39 +27,11 @@ import time
 import re
 import inspect
 from datetime import datetime, timedelta
-from dateutil.parser import parse
-from dateutil.tz import tzutc
-from inspect import trace, getframeinfo
-from subprocess import PIPE, Popen
 import argcomplete
-import yaml
 from argcomplete.completers import ChoicesCompleter, FilesCompleter
-from pygments import highlight, lexers, formatters
-from pygments.styles import get_style_by_name
-from . import aws_infra_util
-from . import cf_bootstrap
-from . import cf_deploy
-from . import cf_utils
-from . import volumes
-from .cf_utils import InstanceInfo, is_ec2, region, regions, stacks, \
-    stack_params_and_outputs, get_images, promote_image, \
-    share_to_another_region, set_region, register_private_dns, interpolate_file, \
-    assumed_role_name
-from .cloudfront_utils import distributions, distribution_comments, \
-    upsert_cloudfront_records
-from n_utils.ecr_utils import ensure_repo, repo_uri
-from n_utils.log_events import CloudWatchLogsGroups, CloudFormationEvents, CloudWatchLogsThread
-from n_utils.maven_utils import add_server
-from n_utils.mfa_utils import mfa_add_token, mfa_delete_token, mfa_generate_code, \
-    mfa_generate_code_with_secret, list_mfa_tokens, mfa_backup_tokens, mfa_decrypt_backup_tokens, \
-    mfa_to_qrcode
-from n_utils.account_utils import list_created_accounts, create_account
-from n_utils.aws_infra_util import load_parameters
+from n_utils.completion_cache import complete_branches, complete_components, components, \
+    subcomponents
 from n_utils.ndt import find_include, find_all_includes, include_dirs
-from n_utils.profile_util import update_profile, print_profile
-from n_utils.ndt_project import list_jobs, list_components
-from n_utils.git_utils import Git
-from n_utils.ndt_project import Project
 
 SYS_ENCODING = locale.getpreferredencoding()
 
@@ -102,6 +74,7 @@ def add_deployer_server():
     """Add a server into a maven configuration file. Password is taken from the
     environment variable 'DEPLOYER_PASSWORD'
     """
+    from n_utils.maven_utils import add_server
     parser = get_parser()
     parser.add_argument("file", help="The file to modify").completer = \
         FilesCompleter()
@@ -124,6 +97,7 @@ def add_deployer_server():
 def get_userdata():
     """Get userdata defined for an instance into a file
     """
+    from n_utils import cf_utils
     parser = get_parser()
     parser.add_argument("file", help="File to write userdata into").completer =\
         FilesCompleter()
@@ -143,6 +117,7 @@ def get_account_id():
     """Get current account id. Either from instance metadata or current cli
     configuration.
     """
+    from n_utils import cf_utils
     parser = get_parser()
     parser.parse_args()
     print(cf_utils.resolve_account())
@@ -151,6 +126,8 @@ def get_account_id():
 def colorprint(data, output_format="yaml"):
     """ Colorized print for either a yaml or a json document given as argument
     """
+    from pygments import formatters, highlight, lexers
+    from pygments.styles import get_style_by_name
     lexer = lexers.get_lexer_by_name(output_format)
     formatter = formatters.get_formatter_by_name("256")
     formatter.__init__(style=get_style_by_name('emacs'))
@@ -162,16 +139,24 @@ def yaml_to_json():
     """Convert Nitor CloudFormation yaml to CloudFormation json with some
     preprosessing
     """
+    from n_utils import aws_infra_util
     parser = get_parser()
     parser.add_argument("--colorize", "-c", help="Colorize output", action="store_true")
     parser.add_argument("--merge", "-m", help="Merge other yaml files to the main file", nargs="*")
     parser.add_argument("--small", "-s", help="Compact representration of json", action="store_true")
+    parser.add_argument("--import-stats", help="Print Fn::ImportYaml and Fn::ImportFile cache hits and " +
+                        "misses to stderr", action="store_true")
+    parser.add_argument("--no-cache", help="Do not use or update the compiled template cache in " +
+                        "~/.ndt/cache", action="store_true")
     parser.add_argument("file", help="File to parse").completer = FilesCompleter()
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
     if not os.path.isfile(args.file):
         parser.error(args.file + " not found")
-    doc = aws_infra_util.yaml_to_dict(args.file, merge=args.merge)
+    if args.no_cache:
+        doc = aws_infra_util.yaml_to_dict(args.file, merge=args.merge)
+    else:
+        doc = aws_infra_util.cached_yaml_to_dict(args.file, merge=args.merge)
     if args.small:
         dump = lambda out_doc: json.dumps(out_doc)
     else:
@@ -180,11 +165,14 @@ def yaml_to_json():
         colorprint(dump(doc), output_format="json")
     else:
         print(dump(doc))
+    if args.import_stats:
+        sys.stderr.write(aws_infra_util.PARSED_FILES.stats() + "\n")
 
 
 def yaml_to_yaml():
     """ Do ndt preprocessing for a yaml file
     """
+    from n_utils import aws_infra_util
     parser = get_parser()
     parser.add_argument("--colorize", "-c", help="Colorize output", action="store_true")
     parser.add_argument("file", help="File to parse").completer = FilesCompleter()
@@ -203,6 +191,7 @@ def json_to_yaml():
     """Convert CloudFormation json to an approximation of a Nitor CloudFormation
     yaml with for example scripts externalized
     """
+    from n_utils import aws_infra_util
     parser = get_parser()
     parser.add_argument("--colorize", "-c", help="Colorize output",
                         action="store_true")
@@ -221,6 +210,7 @@ def json_to_yaml():
 def read_and_follow():
     """Read and print a file and keep following the end for new data
     """
+    from n_utils import cf_utils
     parser = get_parser()
     parser.add_argument("file", help="File to follow").completer = FilesCompleter()
     argcomplete.autocomplete(parser)
@@ -235,6 +225,7 @@ def logs_to_cloudwatch():
     The log group will be the stack name that created instance and the logstream
     will be the instance id and filename.
     """
+    from n_utils import cf_utils
     parser = get_parser()
     parser.add_argument("file", help="File to follow").completer = FilesCompleter()
     argcomplete.autocomplete(parser)
@@ -249,6 +240,7 @@ def signal_cf_status():
     that is either given on the command line or resolved from CloudFormation
     tags
     """
+    from n_utils import cf_utils
     parser = get_parser()
     parser.add_argument("status",
                         help="Status to indicate: SUCCESS | FAILURE").completer\
@@ -267,6 +259,7 @@ def signal_cf_status():
 def associate_eip():
     """Associate an Elastic IP for the instance that this script runs on
     """
+    from n_utils import cf_utils
     parser = get_parser()
     parser.add_argument("-i", "--ip", help="Elastic IP to allocate - default" +
                                            " is to get paramEip from the stack" +
@@ -299,6 +292,7 @@ def associate_eip():
 def instance_id():
     """ Get id for instance
     """
+    from n_utils.cf_utils import InstanceInfo, is_ec2
     parser = get_parser()
     argcomplete.autocomplete(parser)
     parser.parse_args()
@@ -312,6 +306,7 @@ def instance_id():
 def ec2_region():
     """ Get default region - the region of the instance if run in an EC2 instance
     """
+    from n_utils.cf_utils import region
     parser = get_parser()
     argcomplete.autocomplete(parser)
     parser.parse_args()
@@ -321,6 +316,7 @@ def ec2_region():
 def tag():
     """ Get the value of a tag for an ec2 instance
     """
+    from n_utils.cf_utils import InstanceInfo, is_ec2
     parser = get_parser()
     parser.add_argument("name", help="The name of the tag to get")
     args = parser.parse_args()
@@ -339,6 +335,7 @@ def tag():
 def stack_name():
     """ Get name of the stack that created this instance
     """
+    from n_utils.cf_utils import InstanceInfo, is_ec2
     parser = get_parser()
     argcomplete.autocomplete(parser)
     parser.parse_args()
@@ -352,6 +349,7 @@ def stack_name():
 def stack_id():
     """ Get id of the stack the creted this instance
     """
+    from n_utils.cf_utils import InstanceInfo, is_ec2
     parser = get_parser()
     argcomplete.autocomplete(parser)
     parser.parse_args()
@@ -365,6 +363,7 @@ def stack_id():
 def logical_id():
     """ Get the logical id that is expecting a signal from this instance
     """
+    from n_utils.cf_utils import InstanceInfo, is_ec2
     parser = get_parser()
     argcomplete.autocomplete(parser)
     parser.parse_args()
@@ -378,6 +377,7 @@ def logical_id():
 def cf_region():
     """ Get region of the stack that created this instance
     """
+    from n_utils.cf_utils import InstanceInfo, is_ec2
     parser = get_parser()
     argcomplete.autocomplete(parser)
     parser.parse_args()
@@ -391,6 +391,7 @@ def cf_region():
 def update_stack():
     """ Create or update existing CloudFormation stack
     """
+    from n_utils import cf_deploy
     parser = argparse.ArgumentParser(description="Create or update existing " +
                                                  "CloudFormation stack")
     parser.add_argument("stack_name", help="Name of the stack to create or " +
@@ -401,17 +402,27 @@ def update_stack():
     parser.add_argument("-d", "--dry-run", action="store_true",
                         help="Do not actually deploy anything, but just " +
                              "assemble the json and associated parameters")
+    parser.add_argument("-k", "--keep-change-set", action="store_true",
+                        help="Keep the change set of a dry run. A later deploy " +
+                             "with the same template and parameters executes it")
+    parser.add_argument("-o", "--output", choices=cf_deploy.OUTPUT_MODES,
+                        help="How to print the template and the change set. " +
+                             "Default is $NDT_DEPLOY_OUTPUT or auto, which " +
+                             "highlights them when stdout is a terminal")
     args = parser.parse_args()
+    if args.output:
+        os.environ[cf_deploy.OUTPUT_ENV] = args.output
     if not os.path.isfile(args.yaml_template):
         parser.error(args.yaml_template + " not found")
     cf_deploy.deploy(args.stack_name, args.yaml_template, args.region,
-                     args.dry_run)
+                     args.dry_run, keep_change_set=args.keep_change_set)
     return
 
 
 def delete_stack():
     """Delete an existing CloudFormation stack
     """
+    from n_utils import cf_deploy
     parser = get_parser()
     parser.add_argument("stack_name", help="Name of the stack to delete")
     parser.add_argument("region", help="The region to delete the stack from")
@@ -423,16 +434,21 @@ def delete_stack():
 def tail_stack_logs():
     """Tail logs from the log group of a cloudformation stack
     """
+    from n_utils.log_events import Checkpoint, CloudFormationEvents, CloudWatchLogsThread
     parser = get_parser()
     parser.add_argument("stack_name", help="Name of the stack to watch logs " +
                                            "for")
     parser.add_argument("-s", "--start", help="Start time in seconds since " +
                                               "epoc")
+    parser.add_argument("-c", "--checkpoint", help="File to save the position of the " +
+                        "logs in. A restart continues after the last event printed")
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
-    cwlogs = CloudWatchLogsThread(args.stack_name, start_time=args.start)
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+    cwlogs = CloudWatchLogsThread(args.stack_name, start_time=args.start, checkpoint=checkpoint)
     cwlogs.start()
-    cfevents = CloudFormationEvents(args.stack_name, start_time=args.start)
+    cfevents = CloudFormationEvents(args.stack_name, start_time=args.start,
+                                    checkpoint=checkpoint)
     cfevents.start()
     while True:
         try:
@@ -447,13 +463,42 @@ def tail_stack_logs():
 def get_logs():
     """Get logs from multiple CloudWatch log groups and possibly filter them.
     """
+    from n_utils.log_events import BACKENDS, MAX_BUFFERED, MAX_LATENESS, OUTPUTS, \
+        Checkpoint, CloudWatchLogsGroups
     parser = get_parser()
     parser.add_argument("log_group_pattern", help="Regular expression to filter log groups with")
     parser.add_argument("-f", "--filter", help="CloudWatch filter pattern")
     parser.add_argument("-s", "--start", help="Start time (x m|h|d|w ago | now | <seconds since epoc>)", nargs="+")
     parser.add_argument("-e", "--end", help="End time (x m|h|d|w ago | now | <seconds since epoc>)", nargs="+")
-    parser.add_argument("-o", "--order", help="Best effort ordering of log entries", action="store_true")
-    parser.usage = "ndt logs log_group_pattern [-h] [-f FILTER] [-s START [START ...]] [-e END [END ...]] [-o]"
+    parser.add_argument("-o", "--order", help="Order log entries by timestamp. Entries wait for " +
+                        "slower log groups at most MAX_LATENESS seconds", action="store_true")
+    parser.add_argument("-l", "--max-lateness", type=float, default=MAX_LATENESS,
+                        help="Seconds that ordered entries wait for slower log groups. " +
+                        "Default is " + str(MAX_LATENESS))
+    parser.add_argument("-m", "--max-buffered", type=int, default=MAX_BUFFERED,
+                        help="Maximum number of entries to hold back for ordering. " +
+                        "Default is " + str(MAX_BUFFERED))
+    parser.add_argument("-r", "--rate", type=float, help="Maximum log queries per second. Lowered " +
+                        "automatically when throttled. Default is $NDT_LOGS_RATE or 5")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, default="filter",
+                        help="filter reads each group separately. insights reads the " +
+                        "time range before following with Logs Insights queries of up to " +
+                        "50 groups each. Insights is billed by the data scanned and " +
+                        "matches filter terms as substrings instead of whole terms. auto " +
+                        "uses insights for ranges with an end time in more than one group. " +
+                        "Default is filter")
+    parser.add_argument("--output", choices=OUTPUTS, default="text",
+                        help="text prints coloured lines, jsonl a json object per event and " +
+                        "raw just the messages. Default is text")
+    parser.add_argument("--out-file", help="Write the events to this file instead of stdout. " +
+                        "Compressed if the name ends with .gz or .bz2")
+    parser.add_argument("-c", "--checkpoint", help="File to save the position of each log " +
+                        "group in. A restart continues after the last event written. Log " +
+                        "groups are read with the filter backend")
+    parser.usage = "ndt logs log_group_pattern [-h] [-f FILTER] [-s START [START ...]] " + \
+        "[-e END [END ...]] [-o] [-l MAX_LATENESS] [-m MAX_BUFFERED] [-r RATE] " + \
+        "[-b {auto,filter,insights}] [--output {text,jsonl,raw}] [--out-file OUT_FILE] " + \
+        "[-c CHECKPOINT]"
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
     cwlogs_groups = CloudWatchLogsGroups(
@@ -461,7 +506,14 @@ def get_logs():
         log_filter=args.filter,
         start_time=' '.join(args.start) if args.start else None,
         end_time=' '.join(args.end) if args.end else None,
-        sort=args.order
+        sort=args.order,
+        max_lateness=args.max_lateness,
+        max_buffered=args.max_buffered,
+        rate=args.rate,
+        backend=args.backend,
+        output=args.output,
+        out_file=args.out_file,
+        checkpoint=Checkpoint(args.checkpoint) if args.checkpoint else None
     )
     cwlogs_groups.get_logs()
 
@@ -500,6 +552,8 @@ def assume_role():
     to be eval'd to current context for use:
     eval $(ndt assume-role 'arn:aws:iam::43243246645:role/DeployRole')
     """
+    from n_utils import cf_utils
+    from n_utils.profile_util import update_profile
     parser = get_parser()
     parser.add_argument("role_arn", help="The ARN of the role to assume")
     parser.add_argument("-t", "--mfa-token", metavar="TOKEN_NAME",
@@ -527,6 +581,7 @@ def assume_role():
 def get_parameter():
     """Get a parameter value from the stack
     """
+    from n_utils.cf_utils import InstanceInfo
     parser = get_parser()
     parser.add_argument("parameter", help="The name of the parameter to print")
     argcomplete.autocomplete(parser)
@@ -540,6 +595,8 @@ def volume_from_snapshot():
     path. The snapshot is identified by a tag key and value. If no tag is
     found, an empty volume is created, attached, formatted and mounted.
     """
+    from n_utils import volumes
+    from n_utils.cf_utils import is_ec2
     parser = get_parser()
     parser.add_argument("tag_key", help="Key of the tag to find volume with")
     parser.add_argument("tag_value", help="Value of the tag to find volume with")
@@ -576,6 +633,8 @@ def volume_from_snapshot():
 def snapshot_from_volume():
     """ Create a snapshot of a volume identified by it's mount path
     """
+    from n_utils import volumes
+    from n_utils.cf_utils import is_ec2
     parser = get_parser()
     parser.add_argument("-w", "--wait", help="Wait for the snapshot to finish" +
                         " before returning",
@@ -605,6 +664,8 @@ def snapshot_from_volume():
 def detach_volume():
     """ Create a snapshot of a volume identified by it's mount path
     """
+    from n_utils import volumes
+    from n_utils.cf_utils import is_ec2
     parser = get_parser()
     parser.add_argument("mount_path", help="Where to mount the volume")
     argcomplete.autocomplete(parser)
@@ -619,6 +680,7 @@ def clean_snapshots():
     """Clean snapshots that are older than a number of days (30 by default) and
     have one of specified tag values
     """
+    from n_utils import volumes
     parser = get_parser()
     parser.add_argument("-r", "--region", help="The region to delete " +
                                                "snapshots from. Can also be " +
@@ -643,6 +705,7 @@ def setup_cli():
     the given name and credentials. If an identically named profile exists,
     it will not be overwritten.
     """
+    from n_utils import cf_bootstrap
     parser = get_parser()
     parser.add_argument("-n", "--name", help="Name for the profile to create")
     parser.add_argument("-k", "--key-id", help="Key id for the profile")
@@ -656,6 +719,7 @@ def setup_cli():
 def show_stack_params_and_outputs():
     """ Show stack parameters and outputs as a single json documents
     """
+    from n_utils.cf_utils import region, regions, stack_params_and_outputs, stacks
     parser = get_parser()
     parser.add_argument("-r", "--region", help="Region for the stack to show",
                         default=region()).completer = ChoicesCompleter(regions())
@@ -678,6 +742,7 @@ def show_stack_params_and_outputs():
 def cli_get_images():
     """ Gets a list of images given a bake job name
     """
+    from n_utils.cf_utils import get_images, set_region
     parser = get_parser()
     parser.add_argument("job_name", help="The job name to look for")
     argcomplete.autocomplete(parser)
@@ -691,6 +756,7 @@ def cli_get_images():
 def cli_promote_image():
     """  Promotes an image for use in another branch
     """
+    from n_utils.cf_utils import promote_image
     parser = get_parser()
     parser.add_argument("image_id", help="The image to promote")
     parser.add_argument("target_job", help="The job name to promote the image to")
@@ -704,6 +770,7 @@ def cli_promote_image():
 def cli_share_to_another_region():
     """ Shares an image to another region for potentially another account
     """
+    from n_utils.cf_utils import regions, share_to_another_region
     parser = get_parser()
     parser.add_argument("ami_id", help="The ami to share")
     parser.add_argument("to_region", help="The region to share to").completer =\
@@ -721,6 +788,7 @@ def cli_register_private_dns():
     """ Register local private IP in route53 hosted zone usually for internal
     use.
     """
+    from n_utils.cf_utils import register_private_dns
     parser = get_parser()
     parser.add_argument("dns_name", help="The name to update in route 53")
     parser.add_argument("hosted_zone", help="The name of the hosted zone to update")
@@ -733,6 +801,7 @@ def cli_interpolate_file():
     """ Replace placeholders in file with parameter values from stack and
     optionally from vault
     """
+    from n_utils.cf_utils import interpolate_file
     parser = get_parser()
     parser.add_argument("-s", "--stack", help="Stack name for values. " +
                                               "Automatically resolved on ec2" +
@@ -756,6 +825,7 @@ def cli_interpolate_file():
 def cli_ecr_ensure_repo():
     """ Ensure that an ECR repository exists and get the uri and login token for
     it """
+    from n_utils.ecr_utils import ensure_repo
     parser = get_parser()
     parser.add_argument("name", help="The name of the ecr repository to verify")
     argcomplete.autocomplete(parser)
@@ -765,6 +835,7 @@ def cli_ecr_ensure_repo():
 
 def cli_ecr_repo_uri():
     """ Get the repo uri for a named docker """
+    from n_utils.ecr_utils import repo_uri
     parser = get_parser()
     parser.add_argument("name", help="The name of the ecr repository")
     argcomplete.autocomplete(parser)
@@ -778,6 +849,8 @@ def cli_ecr_repo_uri():
 
 def cli_upsert_cloudfront_records():
     """ Upsert Route53 records for all aliases of a CloudFront distribution """
+    from n_utils.cloudfront_utils import distributions, distribution_comments, \
+        upsert_cloudfront_records
     parser = get_parser()
     stack_select = parser.add_mutually_exclusive_group(required=True)
     stack_select.add_argument("-i", "--distribution_id", help="Id for the " +
@@ -798,6 +871,7 @@ def cli_mfa_add_token():
     """ Adds an MFA token to be used with role assumption.
         Tokens will be saved in a .ndt subdirectory in the user's home directory.
         If a token with the same name already exists, it will not be overwritten."""
+    from n_utils.mfa_utils import mfa_add_token, mfa_generate_code_with_secret
     parser = get_parser()
     parser.add_argument("token_name",
                         help="Name for the token. Use this to refer to the token later with " +
@@ -832,6 +906,7 @@ def cli_mfa_add_token():
 def cli_mfa_delete_token():
     """ Deletes an MFA token file from the .ndt subdirectory in the user's
         home directory """
+    from n_utils.mfa_utils import list_mfa_tokens, mfa_delete_token
     parser = get_parser()
     parser.add_argument("token_name",
                         help="Name of the token to delete.").completer = \
@@ -843,6 +918,7 @@ def cli_mfa_delete_token():
 
 def cli_mfa_code():
     """ Generates a TOTP code using an MFA token. """
+    from n_utils.mfa_utils import list_mfa_tokens, mfa_generate_code
     parser = get_parser()
     parser.add_argument("token_name",
                         help="Name of the token to use.").completer = \
@@ -854,6 +930,7 @@ def cli_mfa_code():
 
 def cli_mfa_to_qrcode():
     """ Generates a QR code to import a token to other devices. """
+    from n_utils.mfa_utils import list_mfa_tokens, mfa_to_qrcode
     parser = get_parser()
     parser.add_argument("token_name",
                         help="Name of the token to use.").completer = \
@@ -870,6 +947,7 @@ def cli_mfa_backup_tokens():
 
         To decrypt an existing backup, use --decrypt <file>.
     """
+    from n_utils.mfa_utils import mfa_backup_tokens, mfa_decrypt_backup_tokens
     parser = get_parser()
     parser.add_argument("backup_secret",
                         help="Secret to use for encrypting or decrypts the backup.")
@@ -888,6 +966,7 @@ def cli_mfa_backup_tokens():
 
 def cli_create_account():
     """ Creates a subaccount. """
+    from n_utils.account_utils import create_account, list_created_accounts
     parser = get_parser()
     parser.add_argument("email", help="Email for account root")
     parser.add_argument("account_name", help="Organization unique account name")
@@ -941,11 +1020,13 @@ def cli_load_parameters():
     See https://www.tldp.org/LDP/Bash-Beginners-Guide/html/sect_10_03.html
     (arrays not supported)
     """
+    import yaml
+    from n_utils.aws_infra_util import load_parameters
     parser = get_parser(formatter=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("component", nargs="?", help="Compenent to descend into").completer = \
-        ChoicesCompleter([c.name for c in Project().get_components()])
+        complete_components
     parser.add_argument("--branch", "-b", help="Branch to get active parameters for").completer = \
-        ChoicesCompleter(Git().get_branches())
+        complete_branches
     parser.add_argument("--resolve-images", "-r", action="store_true", help="Also resolve subcomponent AMI IDs and docker repo urls")
     subcomponent_group = parser.add_mutually_exclusive_group()
     subcomponent_group.add_argument("--stack", "-s", help="CloudFormation subcomponent to descent into").completer = \
@@ -987,14 +1068,8 @@ def cli_load_parameters():
     print(transform(load_parameters(**vars(args))), end="")
 
 def component_typed_subcomponents(sc_type, prefix, parsed_args, **kwargs):
-    p_args = {}
-    if parsed_args.branch:
-        p_args["branch"] = parsed_args.branch
-    if parsed_args.component:
-        return [sc.name for sc in Project(**p_args).get_component(parsed_args.component).get_subcomponents() if sc.type == sc_type and sc.name.startswith(prefix)]
-    else:
-        return [sc.name for sc in Project(**p_args).get_all_subcomponents() if sc.type == sc_type]
-    return None
+    return [name for name in subcomponents(sc_type, parsed_args.component, parsed_args.branch)
+            if name.startswith(prefix)]
 
 def map_to_exports(map):
     """ Prints the map as eval-able set of environment variables. Keys
@@ -1022,6 +1097,8 @@ def map_to_properties(map):
 def wait_for_metadata():
     """ Waits for metadata service to be available. All errors are ignored until
     time expires or a socket can be established to the metadata service """
+    from dateutil.tz import tzutc
+    from n_utils import cf_utils
     parser = get_parser()
     parser.add_argument('--timeout', '-t', type=int, help="Maximum time to wait in seconds for the metadata service to be available", default=300)
     argcomplete.autocomplete(parser)
@@ -1043,6 +1120,7 @@ def wait_for_metadata():
 
 def cli_assumed_role_name():
     """ Read the name of the assumed role if currently defined """
+    from n_utils.cf_utils import assumed_role_name
     parser = get_parser()
     argcomplete.autocomplete(parser)
     _ = parser.parse_args()
@@ -1051,15 +1129,18 @@ def cli_assumed_role_name():
 def cli_list_jobs():
     """ Prints a line for every runnable job in this git repository, in all branches and
     optionally exports the properties for each under '$root/job-properties/"""
+    from n_utils.ndt_project import list_jobs
     parser = get_parser()
     parser.add_argument("-e", "--export-job-properties", action="store_true",
                         help="Set if you want the properties of all jobs into files under job-properties/")
     parser.add_argument("-j", "--json", action="store_true", help="Print in json format. Optionally " \
                                                                   "exported parameters will be in the json document")
     parser.add_argument("-b", "--branch", help="The branch to process. Default is to process all branches").completer = \
-        ChoicesCompleter(Git().get_branches())
+        complete_branches
     parser.add_argument("-c", "--component", help="Component to process. Default is to process all components").completer = \
         branch_components
+    parser.add_argument("--jobs", type=int, default=1, help="Number of branch exports and parameter loads " +
+                        "to run in parallel. Default is 1")
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
     ret = list_jobs(**vars(args))
@@ -1068,18 +1149,53 @@ def cli_list_jobs():
     else:
         print("\n".join(ret))
 
+def cli_deploy_all():
+    """ Deploys all stacks of the project, or the stacks in the given components,
+    in the order that the StackRef references in their properties and templates
+    imply. Stacks that do not depend on each other are deployed in parallel
+    with ndt deploy-stack. Stacks that reference stacks outside the deployed set
+    expect those to exist already. After a failure or a rollback no new stacks
+    are started."""
+    from n_utils.deploy_all import project_stacks, deploy_order, DeployRunner
+    parser = get_parser()
+    parser.add_argument("component", nargs="*",
+                        help="Components to deploy. Default is all components").completer = \
+        complete_components
+    parser.add_argument("-d", "--dryrun", action="store_true",
+                        help="dry-run - show only the change sets without actually deploying them")
+    parser.add_argument("-k", "--keep", action="store_true",
+                        help="Keep the change sets of a dry-run for a later deploy with the " +
+                        "same templates and parameters")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="Print the stacks in deployment order with their dependencies and exit")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of stacks to deploy in parallel. Default is 4")
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    stacks = project_stacks(components=args.component, jobs=args.jobs)
+    if args.list:
+        for level, level_stacks in enumerate(deploy_order(stacks)):
+            for stack in level_stacks:
+                print(str(level) + " " + stack.label() + " " + str(stack.stack_name) +
+                      "".join([" <- " + dep.label() for dep in stack.depends]))
+        return
+    runner = DeployRunner(stacks, jobs=args.jobs, dry_run=args.dryrun, keep_change_sets=args.keep)
+    ok = runner.run()
+    for stack in stacks:
+        print(stack.label() + ": " + stack.result)
+    if not ok:
+        sys.exit(1)
+
 def branch_components(prefix, parsed_args, **kwargs):
-    if parsed_args.branch:
-        return [c.name for c in Project(branch=parsed_args.branch).get_components()]
-    else:
-        return [c.name for c in Project().get_components()]
+    return components(parsed_args.branch)
 
 def cli_list_components():
     """ Prints the components in a branch, by default the current branch """
+    from n_utils.ndt_project import list_components
     parser = get_parser()
     parser.add_argument("-j", "--json", action="store_true", help="Print in json format.")
     parser.add_argument("-b", "--branch", help="The branch to get components from. Default is to process current branch").completer = \
-        ChoicesCompleter(Git().get_branches())
+        complete_branches
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
     ret = list_components(**vars(args))
@@ -15,8 +15,8 @@
 # limitations under the License
 from __future__ import print_function
 from builtins import str
-import time
 import boto3
+from n_utils.waiter import Waiter
 
 
 def distributions():
@@ -90,17 +90,17 @@ def upsert_cloudfront_records(args):
                                                                 'Changes': changes[req]
                                                             })['ChangeInfo'])
     if args.wait:
-        not_synced_count = 1
-        while not_synced_count > 0:
-            not_synced_count = 0
-            for req in requests:
-                if not route53.get_change(Id=req['Id'])['ChangeInfo']['Status'] == 'INSYNC':
-                    not_synced_count = not_synced_count + 1
-            if not_synced_count > 0:
-                print("Waiting for requests to sync - " + str(not_synced_count) + " not synced")
-                time.sleep(2)
-            else:
-                print(str(len(requests)) + " requests INSYNC")
+        pending = list(requests)
+
+        def poll_pending():
+            for req in list(pending):
+                if route53.get_change(Id=req['Id'])['ChangeInfo']['Status'] == 'INSYNC':
+                    pending.remove(req)
+            if pending:
+                print("Waiting for requests to sync - " + str(len(pending)) + " not synced")
+            return not pending
+        Waiter("route53-change", delay=2, max_delay=15).wait(poll_pending)
+        print(str(len(requests)) + " requests INSYNC")
 
 
 def longest_matching_zone(alias, hosted_zones):
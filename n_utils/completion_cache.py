@@ -0,0 +1,279 @@
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Cached candidates for bash completion. Entries are stamped with the
+modification times of the git refs or project directories they were computed
+from and are recomputed when those change. The cache lives in the git
+directory of the project or in ~/.ndt outside of git repositories.
+"""
+from builtins import object
+import json
+import os
+import tempfile
+from os.path import expanduser, isdir, isfile, join
+
+CACHE_FILE = "completion.json"
+SUBCOMPONENT_TYPES = ["stack", "serverless", "docker", "image", "cdk", "terraform"]
+BRANCH_OPTIONS = {"-b": "branches", "--branch": "branches"}
+# value options and positional arguments of the commands that complete from the cache
+FAST_COMPLETIONS = {
+    "load-parameters": {
+        "options": dict(BRANCH_OPTIONS, **{
+            "-s": "stack", "--stack": "stack", "-l": "serverless", "--serverless": "serverless",
+            "-d": "docker", "--docker": "docker", "-i": "image", "--image": "image",
+            "-c": "cdk", "--cdk": "cdk", "-t": "terraform", "--terraform": "terraform"
+        }),
+        "positionals": ["components"]
+    },
+    "list-jobs": {
+        "options": dict(BRANCH_OPTIONS, **{"-c": "components", "--component": "components",
+                                          "--jobs": None}),
+        "positionals": []
+    },
+    "list-components": {"options": BRANCH_OPTIONS, "positionals": []},
+    "enable-profile": {"options": {}, "positionals": ["profiles"]},
+    "profile-to-env": {"options": {"-r": None, "--role-arn": None}, "positionals": ["profiles"]},
+    "profile-expiry-to-env": {"options": {}, "positionals": ["expiring_profiles"]},
+    "read-profile-expiry": {"options": {}, "positionals": ["expiring_profiles"]}
+}
+
+
+def find_git_dir(start="."):
+    directory = os.path.abspath(start)
+    while True:
+        candidate = join(directory, ".git")
+        if isdir(candidate):
+            return candidate
+        if isfile(candidate):
+            with open(candidate) as git_file:
+                line = git_file.readline().strip()
+            if line.startswith("gitdir:"):
+                return os.path.normpath(join(directory, line[7:].strip()))
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _refs_stamp(git_dir):
+    stamp = [_mtime(join(git_dir, "HEAD")), _mtime(join(git_dir, "packed-refs"))]
+    for directory, _, _ in os.walk(join(git_dir, "refs")):
+        stamp.append([directory, _mtime(directory)])
+    return sorted(stamp, key=str)
+
+
+def _tree_stamp(root):
+    stamp = [_mtime(root)]
+    for name in sorted(os.listdir(root)):
+        if not name.startswith(".") and isdir(join(root, name)):
+            stamp.append([name, _mtime(join(root, name))])
+    return stamp
+
+
+def current_branch(git_dir):
+    """ The branch name like Git.get_current_branch() returns it, but without
+    running git
+    """
+    if os.environ.get("GIT_BRANCH"):
+        return os.environ["GIT_BRANCH"].split("/")[-1]
+    with open(join(git_dir, "HEAD")) as head:
+        ref = head.read().strip()
+    if ref.startswith("ref: refs/heads/"):
+        return ref[16:].split("/")[-1]
+    return "HEAD"
+
+
+class CompletionCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = {}
+            if isfile(self.filename):
+                try:
+                    with open(self.filename) as cache_file:
+                        self.entries = json.load(cache_file)
+                except ValueError:
+                    pass
+        return self.entries
+
+    def _save(self):
+        directory = os.path.dirname(self.filename)
+        if not isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_file = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "w") as out_file:
+                json.dump(self.entries, out_file)
+            os.rename(tmp_file, self.filename)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    def get(self, name, stamp, compute):
+        """ Returns the cached values for name if they were computed with the
+        same stamp. Otherwise computes, stores and returns new values.
+        """
+        entries = self._load()
+        stamp = json.loads(json.dumps(stamp))
+        if name in entries and entries[name]["stamp"] == stamp:
+            return entries[name]["values"]
+        values = compute()
+        entries[name] = {"stamp": stamp, "values": values}
+        try:
+            self._save()
+        except (IOError, OSError):
+            # completion works without the cache
+            pass
+        return values
+
+
+def _home_cache():
+    return CompletionCache(join(expanduser("~"), ".ndt", "completion", CACHE_FILE))
+
+
+def _project_cache(git_dir):
+    return CompletionCache(join(git_dir, "ndt-completion", CACHE_FILE))
+
+
+def _git_branches():
+    from n_utils.git_utils import Git
+    return Git().get_branches()
+
+
+def _project_tree(branch):
+    from n_utils.git_utils import Git
+    from n_utils.ndt_project import Project
+    with Git() as git:
+        if branch and branch != git.get_current_branch():
+            project = Project(root=git.export_branch(branch), branch=branch)
+        else:
+            project = Project(root=".", branch=git.get_current_branch())
+        return [[component.name, [[sc.type, sc.name] for sc in component.get_subcomponents()]]
+                for component in project.get_components()]
+
+
+def branches():
+    git_dir = find_git_dir()
+    if not git_dir:
+        return []
+    return _project_cache(git_dir).get("branches", _refs_stamp(git_dir), _git_branches)
+
+
+def project_tree(branch=None):
+    """ Components and their (type, name) subcomponents in a branch. The working
+    tree is used for the current branch.
+    """
+    git_dir = find_git_dir()
+    if not git_dir:
+        return _project_tree(branch)
+    if not branch or branch == current_branch(git_dir):
+        name = "tree:" + os.getcwd()
+        stamp = _tree_stamp(".") + [current_branch(git_dir)]
+        return _project_cache(git_dir).get(name, stamp, lambda: _project_tree(None))
+    return _project_cache(git_dir).get("tree:" + branch, _refs_stamp(git_dir),
+                                       lambda: _project_tree(branch))
+
+
+def components(branch=None):
+    return [component for component, _ in project_tree(branch)]
+
+
+def subcomponents(sc_type, component=None, branch=None):
+    return [name for c_name, entries in project_tree(branch) if not component or c_name == component
+            for c_type, name in entries if c_type == sc_type]
+
+
+def _credentials_stamp():
+    return [_mtime(join(expanduser("~"), ".aws", name)) for name in ["credentials", "config"]]
+
+
+def profiles(expiring=False):
+    def read():
+        from n_utils.profile_util import read_profiles, read_expiring_profiles
+        return read_expiring_profiles() if expiring else read_profiles()
+    name = "expiring_profiles" if expiring else "profiles"
+    return _home_cache().get(name, _credentials_stamp(), read)
+
+
+def _candidates(kind, positionals, values):
+    branch = values.get("branches")
+    if kind == "branches":
+        return branches()
+    if kind == "components":
+        return components(branch)
+    if kind in SUBCOMPONENT_TYPES:
+        return subcomponents(kind, positionals[0] if positionals else values.get("components"),
+                             branch)
+    if kind == "profiles":
+        return profiles()
+    if kind == "expiring_profiles":
+        return profiles(expiring=True)
+    return None
+
+
+def fast_complete(command, words, current, prev):
+    """ Completion candidates for the word being completed, or None if the
+    parser of the command needs to be built to complete it
+    """
+    if command not in FAST_COMPLETIONS or "=" in current:
+        return None
+    spec = FAST_COMPLETIONS[command]
+    options = spec["options"]
+    positionals = []
+    values = {}
+    args = words[2:]
+    index = 0
+    while index < len(args):
+        word = args[index]
+        if word in options:
+            if index + 1 < len(args):
+                values[options[word]] = args[index + 1]
+            index += 2
+            continue
+        if not word.startswith("-"):
+            positionals.append(word)
+        index += 1
+    if args and args[-1] in options and prev == args[-1]:
+        kind = options[prev]
+    elif current.startswith("-"):
+        return None
+    elif len(positionals) < len(spec["positionals"]):
+        kind = spec["positionals"][len(positionals)]
+    else:
+        return None
+    if not kind:
+        return None
+    candidates = _candidates(kind, positionals, values)
+    if candidates is None:
+        return None
+    return [candidate for candidate in candidates if candidate and candidate.startswith(current)]
+
+
+def complete_branches(prefix, **kwargs):
+    return branches()
+
+
+def complete_components(prefix, parsed_args, **kwargs):
+    return components(getattr(parsed_args, "branch", None))
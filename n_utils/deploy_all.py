@@ -0,0 +1,237 @@
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Deploys the stacks of a project in the order that their StackRef
+references imply. Stacks that do not depend on each other are deployed in
+parallel, each by `ndt deploy-stack` in a process of its own.
+"""
+from __future__ import print_function
+from builtins import object
+import os
+import re
+import subprocess
+import sys
+from collections import OrderedDict
+from threading import Lock, Thread
+import six
+from termcolor import colored
+from n_utils.aws_infra_util import load_parameters, resolve_file, yaml_load
+from n_utils.cf_utils import expand_vars
+from n_utils.git_utils import Git
+from n_utils.ndt_project import Project, _map
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*m")
+ROLLBACK_STATUSES = ["ROLLBACK_IN_PROGRESS", "UPDATE_ROLLBACK_IN_PROGRESS",
+                     "ROLLBACK_COMPLETE", "ROLLBACK_FAILED", "CREATE_FAILED"]
+
+
+class StackDeploy(object):
+    def __init__(self, component, name, params, stackrefs):
+        self.component = component
+        self.name = name
+        self.stack_name = params.get("STACK_NAME")
+        self.region = params.get("REGION")
+        self.params = params
+        self.stackrefs = stackrefs
+        self.depends = []
+        self.result = None
+
+    def label(self):
+        return self.component + "/stack-" + self.name
+
+    def template(self):
+        return os.path.join(self.component, "stack-" + self.name, "template.yaml")
+
+
+def _load_yaml(filename):
+    with open(filename) as yaml_file:
+        return yaml_load(yaml_file)
+
+
+def _template_stackrefs(data, params, basefile, seen):
+    """ StackRef definitions in a template and the yaml files that it imports
+    """
+    refs = []
+    if isinstance(data, dict):
+        if isinstance(data.get('StackRef'), dict):
+            refs.append(expand_vars(data['StackRef'], params, None, []))
+        if isinstance(data.get('Fn::ImportYaml'), six.string_types):
+            yaml_file = resolve_file(expand_vars(data['Fn::ImportYaml'], params, None, []),
+                                     basefile)
+            if yaml_file and yaml_file not in seen:
+                seen.add(yaml_file)
+                local_params = dict(params)
+                local_params.update([(key, value) for key, value in data.items()
+                                     if isinstance(value, six.string_types)])
+                refs.extend(_template_stackrefs(_load_yaml(yaml_file), local_params,
+                                                yaml_file, seen))
+        for value in data.values():
+            refs.extend(_template_stackrefs(value, params, basefile, seen))
+    elif isinstance(data, list):
+        for value in data:
+            refs.extend(_template_stackrefs(value, params, basefile, seen))
+    return refs
+
+
+def _ref_value(value, params):
+    if isinstance(value, dict) and 'Ref' in value:
+        if value['Ref'] == "AWS::Region":
+            return params.get("REGION")
+        return params.get(value['Ref'])
+    return value
+
+
+def _load_stack(args):
+    component, name = args
+    stackrefs = []
+    params = load_parameters(component=component, stack=name, environ=dict(os.environ),
+                             stackrefs=stackrefs)
+    return StackDeploy(component, name, params, stackrefs)
+
+
+def project_stacks(components=None, jobs=1):
+    """ The stacks in the components, or all components, of the project in the
+    current directory with their dependencies on each other resolved
+    """
+    project = Project(root=".", branch=Git().get_current_branch())
+    subcomponents = [sc for sc in project.get_all_subcomponents("stack")
+                     if not components or sc.component.name in components]
+    stacks = _map(jobs, _load_stack, [(sc.component.name, sc.name) for sc in subcomponents])
+    by_name = dict([((stack.region, stack.stack_name), stack) for stack in stacks])
+    for stack in stacks:
+        template_doc = _load_yaml(stack.template())
+        params = OrderedDict()
+        for key, value in template_doc.get("Parameters", {}).items():
+            if isinstance(value, dict) and "Default" in value:
+                params[key] = value["Default"]
+        params.update(stack.params)
+        refs = stack.stackrefs + _template_stackrefs(template_doc, params, stack.template(), set())
+        for ref in refs:
+            region = _ref_value(ref.get("region"), params) or stack.region
+            target = by_name.get((region, _ref_value(ref.get("stackName"), params)))
+            if target and target is not stack and target not in stack.depends:
+                stack.depends.append(target)
+    return stacks
+
+
+def deploy_order(stacks):
+    """ Lists of stacks that can be deployed in parallel in the order that they
+    need to be deployed
+    """
+    levels = []
+    done = set()
+    remaining = list(stacks)
+    while remaining:
+        level = [stack for stack in remaining
+                 if all(dep in done or dep not in stacks for dep in stack.depends)]
+        if not level:
+            raise Exception("StackRef dependencies form a cycle between " +
+                            ", ".join([stack.label() for stack in remaining]))
+        levels.append(level)
+        done.update(level)
+        remaining = [stack for stack in remaining if stack not in done]
+    return levels
+
+
+def _rollback_started(stack, line):
+    fields = ANSI_ESCAPE_RE.sub("", line).split()
+    return len(fields) > 2 and fields[1] == "AWS::CloudFormation::Stack:" + str(stack.stack_name) \
+        and fields[2] in ROLLBACK_STATUSES
+
+
+class DeployRunner(object):
+    """ Runs `ndt deploy-stack` for at most jobs stacks at a time. A stack starts
+    when the stacks it depends on are deployed. Output lines are prefixed with
+    the stack they came from. After the first failure or rollback no new stacks
+    are started and the ones running are let finish.
+    """
+    def __init__(self, stacks, jobs=4, dry_run=False, keep_change_sets=False, out=None):
+        self.stacks = stacks
+        self.jobs = max(jobs, 1)
+        self.dry_run = dry_run
+        self.keep_change_sets = keep_change_sets
+        self.out = out or sys.stdout
+        self.out_lock = Lock()
+        self.events = queue.Queue()
+        self.failed = False
+
+    def command(self, stack):
+        command = ["ndt", "deploy-stack"]
+        if self.dry_run:
+            command.append("-d")
+            if self.keep_change_sets:
+                command.append("-k")
+        return command + [stack.component, stack.name]
+
+    def write(self, stack, line):
+        with self.out_lock:
+            self.out.write(colored("[" + stack.label() + "] ", "cyan") + line.rstrip("\n") + "\n")
+            self.out.flush()
+
+    def _deploy(self, stack):
+        try:
+            proc = subprocess.Popen(self.command(stack), stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            for line in iter(proc.stdout.readline, b""):
+                line = line.decode("utf-8", "replace")
+                self.write(stack, line)
+                if _rollback_started(stack, line):
+                    self.events.put((stack, "rollback"))
+            proc.stdout.close()
+            result = "deployed" if proc.wait() == 0 else "failed"
+        except Exception as err:
+            self.write(stack, "Failed to run deploy: " + str(err))
+            result = "failed"
+        self.events.put((stack, result))
+
+    def _ready(self, stack):
+        return stack.result is None and \
+            all(dep.result == "deployed" or dep not in self.stacks for dep in stack.depends)
+
+    def run(self):
+        """ Returns true if all stacks were deployed
+        """
+        deploy_order(self.stacks)
+        running = []
+        while True:
+            if not self.failed:
+                for stack in self.stacks:
+                    if len(running) >= self.jobs:
+                        break
+                    if self._ready(stack):
+                        stack.result = "running"
+                        running.append(stack)
+                        thread = Thread(target=self._deploy, args=(stack,))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            stack, event = self.events.get()
+            if event == "rollback":
+                if not self.failed:
+                    self.write(stack, colored("Rollback started, not starting new stacks", "red"))
+                self.failed = True
+                continue
+            stack.result = event
+            running.remove(stack)
+            if event == "failed":
+                self.failed = True
+        for stack in self.stacks:
+            if stack.result is None:
+                stack.result = "skipped"
+        return all(stack.result == "deployed" for stack in self.stacks)
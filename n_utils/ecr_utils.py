@@ -23,7 +23,7 @@ import boto3
 
 from botocore.exceptions import ClientError
 
-from .cf_utils import region
+from .cf_utils import locked_client, region
 
 
 def ensure_repo(name):
@@ -50,7 +50,7 @@ def ensure_repo(name):
 
 
 def repo_uri(name):
-    ecr = boto3.client("ecr", region_name=region())
+    ecr = locked_client("ecr", region_name=region())
     repo_resp = ecr.describe_repositories(repositoryNames=[name])
     if 'repositories' in repo_resp and len(repo_resp['repositories']) > 0 and \
        'repositoryUri' in repo_resp['repositories'][0]:
@@ -1,13 +1,18 @@
 from builtins import object
+import os
 import re
 import shutil
-import tarfile
 import tempfile
 from os import environ, devnull, linesep
 from subprocess import Popen, PIPE
+from threading import Lock
 from locale import getpreferredencoding
 
 SYS_ENCODING = getpreferredencoding()
+# Exports of other branches only contain what projects and parameters are
+# resolved from: the component and subcomponent directories and property files
+EXPORT_DIR_DEPTH = 2
+EXPORT_FILE_RE = re.compile(r"(^|/)infra[^/]*\.properties$")
 
 class Git(object):
 
@@ -17,24 +22,39 @@ class Git(object):
         self.current_branch = None
         self.branches = []
         self.root = None
+        # guards the counters and maps above when used from several threads
+        self.lock = Lock()
+        self.export_locks = {}
+        self.cat_file = None
+        self.cat_file_lock = Lock()
 
     def __enter__(self):
-        self.entered += 1
+        with self.lock:
+            self.entered += 1
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
-        self.entered -= 1
-        if self.entered == 0:
+        with self.lock:
+            self.entered -= 1
+            delete = self.entered == 0
+        if delete:
             self.delete_exports()
         return None
 
     def _get_export_directory(self, branch):
-        if branch in self.export_directories:
-            return self.export_directories[branch], True
-        else:
-            co_dir = tempfile.mkdtemp()
-            self.export_directories[branch] = co_dir
-            return co_dir, False
+        with self.lock:
+            if branch in self.export_directories:
+                return self.export_directories[branch], True
+            else:
+                co_dir = tempfile.mkdtemp()
+                self.export_directories[branch] = co_dir
+                return co_dir, False
+
+    def _get_export_lock(self, branch):
+        with self.lock:
+            if branch not in self.export_locks:
+                self.export_locks[branch] = Lock()
+            return self.export_locks[branch]
     
     def _resolve_branch(self, branch):
         proc = Popen(["git", "branch", "-a"], stdout=PIPE)
@@ -49,28 +69,87 @@ class Git(object):
         return None
 
     def delete_exports(self):
-        for dir in list(self.export_directories.values()):
+        with self.lock:
+            directories = list(self.export_directories.values())
+            self.export_directories = {}
+        for dir in directories:
             try:
                 shutil.rmtree(dir)
             except:
                 # Best effport deleting only - not fatal
                 pass
+        with self.cat_file_lock:
+            if self.cat_file:
+                self.cat_file.stdin.close()
+                self.cat_file.wait()
+                self.cat_file = None
+
+    def _list_tree(self, revision):
+        """ Lists (mode, type, object, path) of all entries in the tree of a
+        revision
+        """
+        proc = Popen(["git", "ls-tree", "-r", "-t", "-z", "--full-tree", revision], stdout=PIPE,
+                     stderr=open(devnull, 'w'))
+        output, _ = proc.communicate()
+        if proc.returncode:
+            raise CheckoutException("Failed to list tree of " + revision)
+        entries = []
+        for entry in output.split(b"\0"):
+            if entry:
+                info, path = entry.split(b"\t", 1)
+                mode, obj_type, obj = info.decode("ascii").split(" ")
+                entries.append((mode, obj_type, obj, path.decode("utf-8")))
+        return entries
+
+    def read_object(self, obj):
+        """ Reads the contents of an object from the object database through one
+        long-lived git cat-file process
+        """
+        with self.cat_file_lock:
+            if not self.cat_file:
+                self.cat_file = Popen(["git", "cat-file", "--batch"], stdin=PIPE, stdout=PIPE,
+                                      stderr=open(devnull, 'w'))
+            self.cat_file.stdin.write(obj.encode("ascii") + b"\n")
+            self.cat_file.stdin.flush()
+            header = self.cat_file.stdout.readline().decode("ascii").split()
+            if len(header) != 3:
+                raise CheckoutException("Failed to read object " + obj)
+            contents = self.cat_file.stdout.read(int(header[2]))
+            self.cat_file.stdout.read(1)
+            return contents
+
+    def _export_tree(self, revision, checkout_dir):
+        for mode, obj_type, obj, path in self._list_tree(revision):
+            target = os.path.join(checkout_dir, *path.split("/"))
+            if obj_type == "tree":
+                if path.count("/") < EXPORT_DIR_DEPTH:
+                    os.mkdir(target)
+            elif obj_type == "blob" and EXPORT_FILE_RE.search(path):
+                parent = os.path.dirname(target)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                contents = self.read_object(obj)
+                if mode == "120000":
+                    os.symlink(contents.decode("utf-8"), target)
+                else:
+                    with open(target, "wb") as out_file:
+                        out_file.write(contents)
 
     def export_branch(self, branch):
         checkout_dir = None
         if branch == self.get_current_branch():
             return self.get_git_root()
-        try:
-            checkout_dir, exported = self._get_export_directory(branch)
-            if not exported:
-                export_branch = self._resolve_branch(branch)
-                if not export_branch:
-                    raise CheckoutException("Failed to resolve branch " + branch + " for export")
-                proc = Popen(["git", "archive", "--format", "tar", export_branch], stdout=PIPE, stderr=open(devnull, 'w'))
-                tar = tarfile.open(mode="r|", fileobj=proc.stdout)
-                tar.extractall(path=checkout_dir)
-        except tarfile.ReadError:
-            raise CheckoutException("Failed to export branch " + branch)
+        # a concurrent export of the same branch waits for the extraction to finish
+        with self._get_export_lock(branch):
+            try:
+                checkout_dir, exported = self._get_export_directory(branch)
+                if not exported:
+                    export_branch = self._resolve_branch(branch)
+                    if not export_branch:
+                        raise CheckoutException("Failed to resolve branch " + branch + " for export")
+                    self._export_tree(export_branch, checkout_dir)
+            except (OSError, ValueError):
+                raise CheckoutException("Failed to export branch " + branch)
         return checkout_dir
 
     def get_git_root(self):
@@ -1,5 +1,43 @@
 #!/bin/bash
 
+# Completion output is cached under the git directory, or ~/.ndt outside of git
+completion_cache_dir() {
+  local GIT_DIR_PATH="$(git rev-parse --git-dir 2> /dev/null)"
+  if [ "$GIT_DIR_PATH" ]; then
+    echo "$GIT_DIR_PATH/ndt-completion"
+  else
+    echo "$HOME/.ndt/completion"
+  fi
+}
+# Prints the output of the given command from the cache if it is younger than the
+# given number of minutes, otherwise runs the command and caches its output
+cached_output() {
+  local MINUTES=$1
+  local KEY="$(echo "$2" | tr -c 'a-zA-Z0-9_.\n-' '_')"
+  shift 2
+  local CACHE_DIR="$(completion_cache_dir)"
+  local CACHE_FILE="$CACHE_DIR/$KEY"
+  if [ -n "$(find "$CACHE_FILE" -mmin -$MINUTES 2> /dev/null)" ]; then
+    cat "$CACHE_FILE"
+  else
+    mkdir -p "$CACHE_DIR"
+    "$@" > "$CACHE_FILE.$$" && mv "$CACHE_FILE.$$" "$CACHE_FILE" && cat "$CACHE_FILE"
+    rm -f "$CACHE_FILE.$$"
+  fi
+}
+# ndt load-parameters from the cache until HEAD or a properties file changes
+cached_parameters() {
+  local CACHE_DIR="$(completion_cache_dir)"
+  local CACHE_FILE="$CACHE_DIR/$(echo "parameters-$AWS_PROFILE-$*" | tr -c 'a-zA-Z0-9_.\n-' '_')"
+  if [ -r "$CACHE_FILE" ] && [ ! "$CACHE_DIR/../HEAD" -nt "$CACHE_FILE" ] && \
+     [ -z "$(find . -maxdepth 3 -name 'infra*.properties' -newer "$CACHE_FILE" 2> /dev/null)" ]; then
+    cat "$CACHE_FILE"
+  else
+    mkdir -p "$CACHE_DIR"
+    ndt load-parameters "$@" > "$CACHE_FILE.$$" && mv "$CACHE_FILE.$$" "$CACHE_FILE" && cat "$CACHE_FILE"
+    rm -f "$CACHE_FILE.$$"
+  fi
+}
 get_bakeable_images() {
   if [ -r infra.properties -o -r infra-master.properties ]; then
     echo $(find . -mindepth 2 -maxdepth 2 -name image -a -type d -o -name 'image-*' -a -type d | cut -d '/' -f 2)
@@ -20,7 +58,7 @@ get_imageids() {
     [ "$GIT_BRANCH" ] || GIT_BRANCH="$(git rev-parse --abbrev-ref HEAD)"
     GIT_BRANCH=${GIT_BRANCH##*/}
     if [ -d "$1/image" ] && [ -r "$1/infra.properties" -o -r "$1/infra-$GIT_BRANCH.properties" ]; then
-      ndt get-images $2 | cut -d: -f1
+      cached_output 10 "images-$AWS_PROFILE-$2" ndt get-images $2 | cut -d: -f1
     fi
   fi
 }
@@ -60,7 +98,7 @@ checkout_branch() {
   fi
 }
 job_properties() {
-  ndt load-parameters $2 $3 $4 -p -b $1
+  cached_parameters $2 $3 $4 -p -b $1
 }
 
 current_branch_job_properties() {
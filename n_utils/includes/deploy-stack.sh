@@ -19,7 +19,11 @@ if [ "$_ARGCOMPLETE" ]; then
   source $(n-include autocomplete-helpers.sh)
   # Handle command completion executions
   COMP_WORDS=( $COMP_LINE )
-  if [ "${COMP_WORDS[2]}" = "-d" ]; then 
+  if [ "${COMP_WORDS[2]}" = "-d" ] && [ "${COMP_WORDS[3]}" = "-k" ]; then
+    COMP_INDEX=$(($COMP_CWORD - 2))
+    IMAGE_DIR=${COMP_WORDS[4]}
+    STACK=${COMP_WORDS[5]}
+  elif [ "${COMP_WORDS[2]}" = "-d" ]; then 
     COMP_INDEX=$(($COMP_CWORD - 1))
     IMAGE_DIR=${COMP_WORDS[3]}
     STACK=${COMP_WORDS[4]}
@@ -33,6 +37,8 @@ if [ "$_ARGCOMPLETE" ]; then
     2)
       if [ "$COMP_INDEX" = "$COMP_CWORD" ]; then
         DRY="-d "
+      elif [ "${COMP_WORDS[2]}" = "-d" ] && [ "$COMP_INDEX" = "$(($COMP_CWORD - 1))" ]; then
+        DRY="-k "
       fi
       compgen -W "-h $DRY$(get_stack_dirs)" -- $COMP_CUR
       ;;
@@ -40,13 +46,13 @@ if [ "$_ARGCOMPLETE" ]; then
       compgen -W "$(get_stacks "$IMAGE_DIR")" -- $COMP_CUR
       ;;
     4)
-      eval "$(ndt load-parameters "$IMAGE_DIR" -s "$STACK" -e)"
+      eval "$(cached_parameters "$IMAGE_DIR" -s "$STACK" -e)"
       JOB_NAME="${JENKINS_JOB_PREFIX}_${IMAGE}_bake"
       IMAGE_IDS="$(get_imageids $IMAGE_DIR $JOB_NAME)"
       compgen -W "$IMAGE_IDS" -- $COMP_CUR
       ;;
     5)
-      eval "$(ndt load-parameters "$IMAGE_DIR" -s "$STACK" -e)"
+      eval "$(cached_parameters "$IMAGE_DIR" -s "$STACK" -e)"
       echo "${JENKINS_JOB_PREFIX}_${IMAGE}_bake"
       ;;
     *)
@@ -57,7 +63,7 @@ if [ "$_ARGCOMPLETE" ]; then
 fi
 
 usage() {
-  echo "usage: ndt deploy-stack [-d] [-h] component stack-name ami-id bake-job" >&2
+  echo "usage: ndt deploy-stack [-d [-k]] [-h] component stack-name ami-id bake-job" >&2
   echo "" >&2
   echo "Resolves potential ECR urls and AMI Ids and then deploys the given stack either updating or creating it." >&2
   echo "positional arguments:" >&2
@@ -72,7 +78,12 @@ usage() {
   echo "" >&2
   echo "optional arguments:" >&2
   echo "  -d, --dryrun  dry-run - show only the change set without actually deploying it" >&2
+  echo "  -k, --keep    keep the change set of the dry-run. A later deploy with the same" >&2
+  echo "                template and parameters executes it instead of creating a new one" >&2
   echo "  -h, --help  show this help message and exit" >&2
+  echo "" >&2
+  echo "Set NDT_DEPLOY_OUTPUT to highlighted, plain or summary to choose how the template" >&2
+  echo "and the change set are printed. By default they are highlighted on a terminal." >&2
   exit 1
 }
 if [ "$1" = "--help" -o "$1" = "-h" ]; then
@@ -83,9 +94,13 @@ source "$(n-include autocomplete-helpers.sh)"
 
 set -xe
 
-if [ "$1" = "-d" ]; then
+if [ "$1" = "-d" -o "$1" = "--dryrun" ]; then
   DRY_RUN="--dry-run"
   shift
+  if [ "$1" = "-k" -o "$1" = "--keep" ]; then
+    DRY_RUN="$DRY_RUN --keep-change-set"
+    shift
+  fi
 fi
 component="$1" ; shift
 stackName="$1" ; shift
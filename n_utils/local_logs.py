@@ -0,0 +1,144 @@
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A stand-in for the boto3 CloudWatch Logs client that serves events from
+memory, so that `ndt logs` can be run and tested without AWS. Point
+NDT_LOGS_LOCAL_FILE to a json file of the form
+{"group": [{"timestamp": millis, "logStreamName": "stream", "message": "..."}]}
+to have `ndt logs` read it instead of CloudWatch.
+"""
+from builtins import object
+import json
+import re
+from collections import Counter
+from datetime import datetime
+from itertools import count
+from threading import Lock
+from botocore.exceptions import ClientError
+
+LOCAL_FILE_ENV = "NDT_LOGS_LOCAL_FILE"
+ACCOUNT_ID = "000000000000"
+PATTERN_TERM_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+_QUERY_FILTER_RE = re.compile(r'filter @message like "((?:[^"\\]|\\.)*)"')
+_QUERY_LIMIT_RE = re.compile(r'\|\s*limit (\d+)')
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _pattern_terms(pattern):
+    return [_unescape(quoted) if quoted else plain
+            for quoted, plain in PATTERN_TERM_RE.findall(pattern or "")]
+
+
+def _insights_timestamp(millis):
+    return datetime.utcfromtimestamp(millis / 1000.0).strftime("%Y-%m-%d %H:%M:%S.%f")[:23]
+
+
+class LocalLogsClient(object):
+    """ Implements describe_log_groups, filter_log_events, start_query and
+    get_query_results over groups, a dict of log group names to lists of events.
+    Events get ids from their order in their group unless they have an eventId.
+    Filter patterns match events that contain all of their terms. Queries
+    understand the filters and limit that the Logs Insights backend of
+    `ndt logs` writes and report Running once before they are Complete. calls
+    counts the calls by method name.
+    """
+    def __init__(self, groups, page_size=100):
+        self.groups = groups
+        self.page_size = page_size
+        self.calls = Counter()
+        self.queries = {}
+        self._query_ids = count(1)
+        self._lock = Lock()
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename) as groups_file:
+            return cls(json.load(groups_file))
+
+    def _called(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _page(self, items, next_token):
+        start = int(next_token or 0)
+        end = start + self.page_size
+        return items[start:end], str(end) if end < len(items) else None
+
+    def describe_log_groups(self, nextToken=None):
+        self._called("describe_log_groups")
+        names, token = self._page(sorted(self.groups), nextToken)
+        response = {"logGroups": [{"logGroupName": name} for name in names]}
+        if token:
+            response["nextToken"] = token
+        return response
+
+    def _events(self, group, start, end, terms):
+        if group not in self.groups:
+            raise ClientError({"Error": {"Code": "ResourceNotFoundException",
+                                         "Message": "The specified log group does not exist."}},
+                              "FilterLogEvents")
+        events = []
+        for index, event in enumerate(sorted(self.groups[group],
+                                             key=lambda event: event["timestamp"])):
+            if (start is None or event["timestamp"] >= start) and \
+               (end is None or event["timestamp"] <= end) and \
+               all(term in event["message"] for term in terms):
+                event = dict(event)
+                event.setdefault("eventId", group + "/" + str(index))
+                events.append(event)
+        return events
+
+    def filter_log_events(self, logGroupName, startTime=None, endTime=None, filterPattern="",
+                          nextToken=None, **kwargs):
+        self._called("filter_log_events")
+        events = self._events(logGroupName, startTime, endTime, _pattern_terms(filterPattern))
+        page, token = self._page(events, nextToken)
+        response = {"events": page}
+        if token:
+            response["nextToken"] = token
+        return response
+
+    def start_query(self, logGroupNames, startTime, endTime, queryString, limit=None):
+        self._called("start_query")
+        terms = [_unescape(term) for term in _QUERY_FILTER_RE.findall(queryString)]
+        limit_match = _QUERY_LIMIT_RE.search(queryString)
+        limit = limit or (int(limit_match.group(1)) if limit_match else 1000)
+        events = []
+        for group in logGroupNames:
+            # startTime and endTime of queries are inclusive seconds
+            for event in self._events(group, startTime * 1000, endTime * 1000 + 999, terms):
+                events.append((event["timestamp"], group, event))
+        events.sort(key=lambda entry: entry[0])
+        rows = [[{"field": "@timestamp", "value": _insights_timestamp(timestamp)},
+                 {"field": "@message", "value": event["message"]},
+                 {"field": "@logStream", "value": event["logStreamName"]},
+                 {"field": "@log", "value": ACCOUNT_ID + ":" + group}]
+                for timestamp, group, event in events[:limit]]
+        query_id = "local-query-" + str(next(self._query_ids))
+        with self._lock:
+            self.queries[query_id] = {"polls": 0, "results": rows}
+        return {"queryId": query_id}
+
+    def get_query_results(self, queryId):
+        self._called("get_query_results")
+        with self._lock:
+            query = self.queries[queryId]
+            query["polls"] += 1
+            if query["polls"] < 2:
+                return {"status": "Running", "results": []}
+        return {"status": "Complete", "results": query["results"],
+                "statistics": {"recordsMatched": float(len(query["results"]))}}
@@ -58,20 +58,59 @@ from builtins import object
 from past.utils import old_div
 from botocore.exceptions import ClientError
 from collections import deque
+from heapq import heappop, heappush
 from datetime import datetime, timedelta
 from dateutil import tz
 from dateutil.parser import parse
 from dateutil.tz import tzutc
 from termcolor import colored
-from threading import Event, Thread, BoundedSemaphore
+from threading import Event, Lock, Thread
+from itertools import count
+from multiprocessing.pool import ThreadPool
 import boto3
+import bz2
+import gzip
+import json
 import locale
 import os
 import sys
 import time
 import re
+import tempfile
 from botocore.compat import total_seconds
 import queue
+from n_utils.local_logs import LOCAL_FILE_ENV, PATTERN_TERM_RE, LocalLogsClient
+from n_utils.waiter import Waiter, is_throttling
+
+RATE_ENV = "NDT_LOGS_RATE"
+# FilterLogEvents calls per second, the default quota of an account in a region
+DEFAULT_RATE = 5.0
+# groups without new events are polled with a delay that doubles up to the max
+IDLE_POLL_DELAY = 1.0
+MAX_IDLE_POLL_DELAY = 15.0
+_SEQUENCE = count()
+BACKENDS = ["auto", "filter", "insights"]
+# Logs Insights limits: log groups in a query and rows in its results
+QUERY_GROUPS = 50
+QUERY_LIMIT = 10000
+QUERY_JOBS = 4
+# seconds of a range that are queried and written before the next ones
+QUERY_WINDOW = 3600
+# events older than this many seconds are assumed to be ingested when a live
+# follow hands over from Logs Insights to tailing
+INGESTION_MARGIN = 30
+# ordered output waits at most this many seconds for slower groups and buffers
+# at most this many events
+MAX_LATENESS = 10.0
+MAX_BUFFERED = 100000
+OUTPUTS = ["text", "jsonl", "raw"]
+# writes are batched up to this many lines or seconds
+BATCH_LINES = 1000
+BATCH_SECONDS = 1.0
+_COMPRESSORS = {".gz": gzip.open, ".bz2": bz2.BZ2File}
+_EVENT_FIELDS = ["timestamp", "ingestionTime", "logGroupName", "logStreamName", "eventId",
+                 "message"]
+_QUERY_DONE = ["Complete", "Failed", "Cancelled", "Timeout", "Unknown"]
 
 
 def millis2iso(millis):
@@ -95,6 +134,133 @@ def uprint(message):
                          .encode(locale.getpreferredencoding()))
 
 
+def logs_client():
+    if os.environ.get(LOCAL_FILE_ENV):
+        return LocalLogsClient.from_file(os.environ[LOCAL_FILE_ENV])
+    return boto3.client('logs')
+
+
+def format_event(event):
+    return [colored(millis2iso(event['timestamp']), 'yellow'),
+            colored(event['logGroupName'], 'green'),
+            colored(event['logStreamName'], 'cyan'),
+            event['message']]
+
+
+class Checkpoint(object):
+    """ Positions of log groups and stacks saved in filename so that a restarted
+    follow continues right after the last event that it wrote. A position is
+    the timestamp of the last event written and the ids of the events written
+    with that timestamp. Reading resumes from that timestamp and skips those
+    ids.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.positions = {}
+        self.lock = Lock()
+        if os.path.isfile(filename):
+            with open(filename) as checkpoint_file:
+                self.positions = json.load(checkpoint_file).get("positions", {})
+
+    def start_time(self, key, default):
+        with self.lock:
+            if key in self.positions:
+                return self.positions[key]["timestamp"]
+        return default
+
+    def event_ids(self, key):
+        with self.lock:
+            return list(self.positions.get(key, {}).get("eventIds", []))
+
+    def seen(self, key, timestamp, event_id):
+        with self.lock:
+            position = self.positions.get(key)
+            return position is not None and timestamp == position["timestamp"] and \
+                event_id in position["eventIds"]
+
+    def record(self, key, timestamp, event_id):
+        with self.lock:
+            position = self.positions.get(key)
+            if not position or timestamp > position["timestamp"]:
+                self.positions[key] = {"timestamp": timestamp, "eventIds": [event_id]}
+            elif timestamp == position["timestamp"] and event_id not in position["eventIds"]:
+                position["eventIds"].append(event_id)
+
+    def save(self):
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, tmp_file = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, "w") as out_file:
+                    json.dump({"positions": self.positions}, out_file)
+                os.rename(tmp_file, self.filename)
+            except Exception:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+
+
+class LogWriter(object):
+    """ Writes events as coloured text, json lines or just their messages to
+    stdout or to out_file, compressed if its name ends with .gz or .bz2. Lines
+    are written in batches and text is coloured only on stdout. The events of
+    each batch are recorded in checkpoint once they are written.
+    """
+    def __init__(self, output="text", out_file=None, checkpoint=None):
+        if output not in OUTPUTS:
+            raise ValueError("Unknown output " + str(output))
+        self.output = output
+        self.out_file = None
+        if out_file:
+            opener = _COMPRESSORS.get(os.path.splitext(out_file)[1], open)
+            self.out_file = opener(out_file, "wb")
+        self.checkpoint = checkpoint
+        self.lines = []
+        self.events = []
+        self.batch_started = None
+
+    def format(self, event):
+        if self.output == "jsonl":
+            return json.dumps(dict([(field, event[field]) for field in _EVENT_FIELDS
+                                    if field in event]))
+        if self.output == "raw":
+            return event['message'].rstrip("\r\n")
+        if self.out_file:
+            return ' '.join([millis2iso(event['timestamp']), event['logGroupName'],
+                             event['logStreamName'], event['message']])
+        return ' '.join(format_event(event))
+
+    def write(self, event):
+        if not self.lines:
+            self.batch_started = time.time()
+        self.lines.append(self.format(event))
+        self.events.append(event)
+        if len(self.lines) >= BATCH_LINES or time.time() - self.batch_started >= BATCH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        if self.out_file:
+            self.out_file.write((os.linesep.join(self.lines) + os.linesep).encode("utf-8"))
+            self.out_file.flush()
+        else:
+            uprint(os.linesep.join(self.lines))
+            sys.stdout.flush()
+        if self.checkpoint:
+            for event in self.events:
+                self.checkpoint.record(event['logGroupName'], event['timestamp'],
+                                       event.get('eventId'))
+            self.checkpoint.save()
+        self.lines = []
+        self.events = []
+
+    def close(self):
+        self.flush()
+        if self.out_file:
+            self.out_file.close()
+
+
 def validatestarttime(start_time):
     return int(start_time) * 1000 if start_time else int((time.time() - 60) * 1000)
 
@@ -133,12 +299,13 @@ def parse_datetime(datetime_text):
 
 
 class CloudWatchLogsThread(Thread):
-    def __init__(self, log_group_name, start_time=None):
+    def __init__(self, log_group_name, start_time=None, checkpoint=None):
         Thread.__init__(self)
         self.setDaemon(True)
         self.log_group_name = log_group_name
         self.start_time = start_time
-        self.cwlogs = CloudWatchLogsGroups(log_group_filter=self.log_group_name, start_time=self.start_time)
+        self.cwlogs = CloudWatchLogsGroups(log_group_filter=self.log_group_name, start_time=self.start_time,
+                                           checkpoint=checkpoint)
 
     def stop(self):
         self.cwlogs._stopped.set()
@@ -147,14 +314,206 @@ class CloudWatchLogsThread(Thread):
         self.cwlogs.get_logs()
 
 
+def default_rate():
+    if os.environ.get(RATE_ENV):
+        return float(os.environ[RATE_ENV])
+    return DEFAULT_RATE
+
+
+def _schedule(work_queue, work_item, delay):
+    work_queue.put((time.time() + delay, next(_SEQUENCE), work_item))
+
+
+def insights_filter(log_filter):
+    """ Logs Insights filter commands that match the events that the filter
+    pattern log_filter matches, or None if the pattern has more than plain
+    terms and quoted phrases. Terms match as substrings in the query.
+    """
+    commands = []
+    for quoted, plain in PATTERN_TERM_RE.findall(log_filter or ""):
+        if plain and (plain[0] in "-?{[%" or '"' in plain):
+            return None
+        term = re.sub(r'\\(.)', r'\1', quoted) if quoted else plain
+        commands.append('filter @message like "' +
+                        term.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return commands
+
+
+def _insights_millis(value):
+    return int(round(timestamp(datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f"))))
+
+
+class CloudWatchLogsInsights(object):
+    """ Reads the events of groups between start_time and end_time in
+    milliseconds, both inclusive, with Logs Insights queries. Each query covers
+    up to QUERY_GROUPS groups and ranges with more than QUERY_LIMIT matches are
+    split in half until they fit. The range is read in windows of QUERY_WINDOW
+    seconds, so only the events of one window are held in memory.
+    """
+    def __init__(self, groups, log_filter=None, start_time=None, end_time=None, client=None):
+        self.client = client or logs_client()
+        self.groups = groups
+        self.filters = insights_filter(log_filter)
+        if self.filters is None:
+            raise ValueError("Filter pattern " + log_filter + " can not be run as a Logs " +
+                             "Insights query")
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def query_string(self):
+        return " | ".join(["fields @timestamp, @message, @logStream, @log"] + self.filters +
+                          ["sort @timestamp asc", "limit " + str(QUERY_LIMIT)])
+
+    def _query(self, groups, start_time, end_time):
+        query_id = Waiter("logs-insights-start", delay=1, max_delay=10,
+                          pending_codes=["LimitExceededException"]).wait(
+            lambda: self.client.start_query(logGroupNames=groups,
+                                            startTime=start_time // 1000,
+                                            endTime=end_time // 1000,
+                                            queryString=self.query_string(),
+                                            limit=QUERY_LIMIT))['queryId']
+        response = Waiter("logs-insights", delay=0.5, max_delay=5).wait(
+            lambda: self.client.get_query_results(queryId=query_id),
+            done=lambda response: response['status'] in _QUERY_DONE)
+        if response['status'] != "Complete":
+            raise Exception("Logs Insights query " + query_id + " ended with status " +
+                            response['status'])
+        events = []
+        for row in response['results']:
+            fields = dict([(field['field'], field.get('value')) for field in row])
+            event = {'timestamp': _insights_millis(fields['@timestamp']),
+                     'logGroupName': fields['@log'].split(":", 1)[-1],
+                     'logStreamName': fields['@logStream'],
+                     'message': fields['@message']}
+            if start_time <= event['timestamp'] <= end_time:
+                events.append(event)
+        return len(response['results']), events
+
+    def _query_range(self, groups, start_time, end_time):
+        rows, events = self._query(groups, start_time, end_time)
+        start_second, end_second = start_time // 1000, end_time // 1000
+        if rows < QUERY_LIMIT:
+            return events
+        if start_second == end_second:
+            sys.stderr.write("More than " + str(QUERY_LIMIT) + " events in one second, " +
+                             "showing the first ones\n")
+            return events
+        middle = (start_second + end_second) // 2
+        return self._query_range(groups, start_time, middle * 1000 + 999) + \
+            self._query_range(groups, (middle + 1) * 1000, end_time)
+
+    def events(self):
+        """ Yields the events of all groups ordered by timestamp, one window at
+        a time
+        """
+        batches = [self.groups[i:i + QUERY_GROUPS]
+                   for i in range(0, len(self.groups), QUERY_GROUPS)]
+        if not batches or self.start_time > self.end_time:
+            return
+        pool = ThreadPool(min(QUERY_JOBS, len(batches)))
+        try:
+            window_start = self.start_time
+            while window_start <= self.end_time:
+                window_end = min(self.end_time, (window_start // 1000 + QUERY_WINDOW) * 1000 - 1)
+                results = pool.map(lambda batch: self._query_range(batch, window_start,
+                                                                   window_end), batches)
+                for event in sorted([event for events in results for event in events],
+                                    key=lambda event: event['timestamp']):
+                    yield event
+                window_start = window_end + 1
+        finally:
+            pool.close()
+            pool.join()
+
+
+class OrderedMerge(object):
+    """ Merges the events of log groups into timestamp order. The watermark of
+    a group is the timestamp up to which it has delivered its events: the last
+    event seen or, as events are ingested a while after their timestamps, a
+    margin before the time that its last completed round of queries started.
+    Events are released once every group has a watermark past them, once they
+    have waited max_lateness seconds or when more than max_buffered events are
+    waiting. Events that arrive after later ones were released are printed
+    right away.
+    """
+    def __init__(self, groups, start_time, max_lateness=MAX_LATENESS, max_buffered=MAX_BUFFERED):
+        self.watermarks = dict([(group, start_time - 1) for group in groups])
+        self.max_lateness = max_lateness
+        self.max_buffered = max_buffered
+        self.buffered = []
+        self.arrivals = deque()
+        self.released_to = None
+
+    def add(self, group, timestamp, event, now=None):
+        sequence = next(_SEQUENCE)
+        heappush(self.buffered, (timestamp, sequence, event))
+        self.arrivals.append((time.time() if now is None else now, timestamp))
+        self.advance(group, timestamp)
+
+    def advance(self, group, timestamp):
+        self.watermarks[group] = max(self.watermarks.get(group, timestamp), timestamp)
+
+    def delivered(self, group, round_start):
+        """ Advances the watermark of a group that has completed a round of
+        queries. The margin is capped at max_lateness, after which events are
+        released anyway.
+        """
+        margin = min(INGESTION_MARGIN, self.max_lateness) * 1000
+        self.advance(group, int(round_start - margin))
+
+    def _release_to(self, timestamp):
+        if self.released_to is None or timestamp > self.released_to:
+            self.released_to = timestamp
+
+    def ready(self, now=None):
+        """ The events that can be released in timestamp order
+        """
+        deadline = (time.time() if now is None else now) - self.max_lateness
+        while self.arrivals and (self.arrivals[0][0] <= deadline or
+                                 len(self.arrivals) > self.max_buffered):
+            self._release_to(self.arrivals.popleft()[1])
+        if self.watermarks:
+            self._release_to(min(self.watermarks.values()))
+        events = []
+        while self.buffered and (self.buffered[0][0] <= self.released_to or
+                                 len(self.buffered) > self.max_buffered):
+            events.append(heappop(self.buffered)[2])
+        return events
+
+    def flush(self):
+        events = []
+        while self.buffered:
+            events.append(heappop(self.buffered)[2])
+        self.arrivals.clear()
+        return events
+
+
 class CloudWatchLogsGroups(object):
-    def __init__(self, log_filter='', log_group_filter='', start_time=None, end_time=None, sort=False):
-        self.client = boto3.client('logs')
+    """ Prints the events of the log groups that match log_group_filter. The
+    filter backend polls each group with FilterLogEvents. The insights backend
+    reads the time range before tailing starts with Logs Insights queries that
+    cover many groups each and only tails groups one by one to follow them. Its
+    queries are billed by the data scanned and match terms as substrings. auto
+    uses insights for ranges with an end time in more than one group when the
+    filter pattern can be run as a query. Groups with a position in checkpoint
+    are read from there with the filter backend.
+    """
+    def __init__(self, log_filter='', log_group_filter='', start_time=None, end_time=None, sort=False,
+                 rate=None, backend="filter", client=None, max_lateness=MAX_LATENESS,
+                 max_buffered=MAX_BUFFERED, output="text", out_file=None, checkpoint=None):
+        self.client = client or logs_client()
         self.log_filter = log_filter
         self.log_group_filter = log_group_filter
         self.start_time = validatestarttime(parse_datetime(start_time))
         self.end_time = parse_datetime(end_time) * 1000 if end_time else None
         self.sort = sort
+        self.max_lateness = max_lateness
+        self.max_buffered = max_buffered
+        self.rate = rate or default_rate()
+        self.backend = backend
+        self.output = output
+        self.out_file = out_file
+        self.checkpoint = checkpoint
         self._stopped = Event()
 
     def filter_groups(self, log_group_filter, groups):
@@ -173,86 +532,155 @@ class CloudWatchLogsGroups(object):
             filtered_group_names.extend(self.filter_groups(self.log_group_filter, resp['logGroups']))
         return filtered_group_names
 
+    def use_insights(self, groups):
+        if self.backend == "filter" or self.checkpoint or insights_filter(self.log_filter) is None:
+            return False
+        return self.backend == "insights" or (self.end_time is not None and len(groups) > 1)
+
     def get_logs(self):
+        writer = LogWriter(self.output, self.out_file, self.checkpoint)
+        try:
+            self._get_logs(writer)
+        finally:
+            writer.close()
+
+    def _get_logs(self, writer):
         groups = self.get_filtered_groups(self.log_group_filter)
+        start_time = self.start_time
+        if self.use_insights(groups):
+            end_time = self.end_time or int((time.time() - INGESTION_MARGIN) * 1000)
+            for event in CloudWatchLogsInsights(groups, self.log_filter, start_time, end_time,
+                                                client=self.client).events():
+                if self._stopped.is_set():
+                    return
+                writer.write(event)
+            if self.end_time:
+                return
+            start_time = max(start_time, end_time + 1)
+        elif self.backend == "insights":
+            reason = "a checkpoint" if self.checkpoint else "this filter pattern"
+            sys.stderr.write("Logs Insights can not be used with " + reason +
+                             ", reading groups one by one\n")
         log_threads = []
-        work_queue = queue.Queue()
-        semaphore = BoundedSemaphore(5)
-        output_queue = queue.PriorityQueue()
+        work_queue = queue.PriorityQueue()
+        rate_limiter = TokenBucket(self.rate)
+        output_queue = queue.Queue()
         work_items = []
 
         for group_name in groups:
             work_item = {'item': {'logGroupName': group_name,
                                   'interleaved': True,
-                                  'startTime': self.start_time,
+                                  'startTime': self.checkpoint.start_time(group_name, start_time)
+                                  if self.checkpoint else start_time,
                                   'filterPattern': self.log_filter if self.log_filter else ""
                                   },
-                         'meta': {'initialQueriesDone': Event()}
+                         'meta': {'initialQueriesDone': Event(), 'idleDelay': 0.0}
                          }
             if self.end_time:
                 work_item['item']['endTime'] = self.end_time
-            work_queue.put(work_item)
+            _schedule(work_queue, work_item, 0)
             work_items.append(work_item)
 
         for _ in range(10):
-            cwlogs_worker = CloudWatchLogsWorker(work_queue, semaphore, output_queue)
+            cwlogs_worker = CloudWatchLogsWorker(work_queue, rate_limiter, output_queue,
+                                                 client=self.client)
             log_threads.append(cwlogs_worker)
             cwlogs_worker.start()
 
-        speed_limiter = SpeedLimitThread(semaphore)
-        speed_limiter.start()
         all_initial_queries_done = False
         tailing = True if not self.end_time else False
-        wait_time = None if self.sort else 0.0
+        merge = OrderedMerge(groups, start_time, self.max_lateness, self.max_buffered) \
+            if self.sort else None
 
         while not self._stopped.isSet():
             try:
                 if not all_initial_queries_done:
-                    loop_queries_done = True
-                    for work_item in work_items:
-                        if not work_item['meta']['initialQueriesDone'].wait(wait_time):
-                            loop_queries_done = False
-                    all_initial_queries_done = loop_queries_done
-                elif self.sort:
-                    time.sleep(5.0)  # allow time to sort while tailing
-                self.print_output_if_any(output_queue)
+                    all_initial_queries_done = all([work_item['meta']['initialQueriesDone'].is_set()
+                                                    for work_item in work_items])
+                self.print_output_if_any(output_queue, writer, merge)
                 if all_initial_queries_done and not tailing:
+                    if merge:
+                        for event in merge.flush():
+                            writer.write(event)
                     raise KeyboardInterrupt
             except KeyboardInterrupt:
                 for thread in log_threads:
                     thread.stop()
-                speed_limiter.stop()
                 return
 
-    def print_output_if_any(self, output_queue):
+    def print_output_if_any(self, output_queue, writer, merge=None):
+        """ Writes the events that the workers have queued. Entries without an
+        event tell that a group has completed a round of queries that started
+        at their timestamp.
+        """
         while True:
             try:
-                uprint(' '.join(output_queue.get(timeout=1.0)[1]))
+                timestamp, _, group, event = output_queue.get(timeout=1.0)
             except queue.Empty:
                 break
-
-
-class SpeedLimitThread(Thread):
-    def __init__(self, semaphore):
-        Thread.__init__(self)
-        self.semaphore = semaphore
-        self._stopped = Event()
-        self.setDaemon(True)
-
-    def tick(self):
-        while not self._stopped.wait(1.1):
-            try:
-                for _ in range(5):
-                    self.semaphore.release()
-            except ValueError:
-                pass
-        return
-
-    def stop(self):
-        self._stopped.set()
-
-    def run(self):
-        self.tick()
+            if event and self.checkpoint and \
+               self.checkpoint.seen(group, timestamp, event.get('eventId')):
+                continue
+            if merge:
+                if event:
+                    merge.add(group, timestamp, event)
+                else:
+                    merge.delivered(group, timestamp)
+                for ready in merge.ready():
+                    writer.write(ready)
+            elif event:
+                writer.write(event)
+        if merge:
+            for ready in merge.ready():
+                writer.write(ready)
+        writer.flush()
+
+
+class TokenBucket(object):
+    """ Limits the rate of API calls shared by threads. Tokens are added rate
+    times a second up to burst. A throttled call halves the rate, down to
+    min_rate, and calls that go through raise it back towards the configured
+    rate.
+    """
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = burst or max(1.0, self.max_rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, stopped):
+        """ Takes a token, waiting for one if there are none. Returns False if
+        stopped is set while waiting
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if stopped.wait(wait):
+                return False
+
+    def throttled(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
 
 
 class LogWorkerThread(Thread):
@@ -272,12 +700,24 @@ class LogWorkerThread(Thread):
 
 
 class CloudWatchLogsWorker(LogWorkerThread):
-    def __init__(self, work_queue, semaphore, output_queue):
+    def __init__(self, work_queue, rate_limiter, output_queue, client=None):
         LogWorkerThread.__init__(self)
         self.work_queue = work_queue
-        self.semaphore = semaphore
+        self.rate_limiter = rate_limiter
         self.output_queue = output_queue
-        self.client = boto3.client('logs')
+        self.client = client or logs_client()
+
+    def _next_work_item(self):
+        """ The group that is due next, or None if it is not due yet
+        """
+        due, sequence, work_item = self.work_queue.get()
+        wait = due - time.time()
+        if wait > 0:
+            self.work_queue.put((due, sequence, work_item))
+            # check again soon in case a busy group gets scheduled in between
+            self._stopped.wait(min(wait, 0.5))
+            return None
+        return work_item
 
     def list_logs(self):
         do_wait = object()
@@ -285,15 +725,30 @@ class CloudWatchLogsWorker(LogWorkerThread):
         def generator():
             work_item = None
             last_timestamp = None
-            while True:
+            round_events = 0
+            round_start = None
+            while not self._stopped.is_set():
                 if not work_item:
-                    work_item = self.work_queue.get()
+                    work_item = self._next_work_item()
                     last_timestamp = None
-                self.semaphore.acquire()
-                response = self.client.filter_log_events(**work_item['item'])
+                    round_events = 0
+                    round_start = int(time.time() * 1000)
+                    if not work_item:
+                        continue
+                if not self.rate_limiter.acquire(self._stopped):
+                    return
+                try:
+                    response = self.client.filter_log_events(**work_item['item'])
+                except ClientError as err:
+                    if not is_throttling(err):
+                        raise
+                    self.rate_limiter.throttled()
+                    continue
+                self.rate_limiter.succeeded()
                 for event in response.get('events', []):
                     event['logGroupName'] = work_item['item']['logGroupName']
                     last_timestamp = event.get('timestamp', None)
+                    round_events += 1
                     yield event
 
                 if 'nextToken' in response:
@@ -303,8 +758,17 @@ class CloudWatchLogsWorker(LogWorkerThread):
                         work_item['item'].pop('nextToken')
                     if last_timestamp:
                         work_item['item']['startTime'] = last_timestamp + 1
+                    # the group has delivered the events ingested before the round started
+                    self.output_queue.put((round_start, next(_SEQUENCE),
+                                           work_item['item']['logGroupName'], None))
                     work_item['meta']['initialQueriesDone'].set()
-                    self.work_queue.put(work_item)
+                    meta = work_item['meta']
+                    if round_events:
+                        meta['idleDelay'] = 0.0
+                    else:
+                        meta['idleDelay'] = min(max(meta['idleDelay'] * 2, IDLE_POLL_DELAY),
+                                                MAX_IDLE_POLL_DELAY)
+                    _schedule(self.work_queue, work_item, meta['idleDelay'])
                     work_item = None
                     yield do_wait
 
@@ -314,24 +778,41 @@ class CloudWatchLogsWorker(LogWorkerThread):
             elif self._stopped.is_set():
                 return
 
-            output = []
-            output.append(colored(millis2iso(event['timestamp']), 'yellow'))
-            output.append(colored(event['logGroupName'], 'green'))
-            output.append(colored(event['logStreamName'], 'cyan'))
-            output.append(event['message'])
-            self.output_queue.put((event['timestamp'], output))  # sort by timestamp (first value in tuple)
+            self.output_queue.put((event['timestamp'], next(_SEQUENCE), event['logGroupName'],
+                                   event))
 
 
 class CloudFormationEvents(LogWorkerThread):
-    def __init__(self, log_group_name, start_time=None):
+    def __init__(self, log_group_name, start_time=None, session=None, checkpoint=None):
         LogWorkerThread.__init__(self)
         self.log_group_name = log_group_name
         self.start_time = validatestarttime(start_time)
-        self.client = boto3.client('cloudformation')
+        self.checkpoint = checkpoint
+        self.checkpoint_key = "cloudformation:" + log_group_name
+        if checkpoint:
+            self.start_time = checkpoint.start_time(self.checkpoint_key, self.start_time)
+        if session:
+            self.client = session.client('cloudformation')
+        else:
+            self.client = boto3.client('cloudformation')
+        self.stack_status = None
+        self._stack_end = Event()
+
+    def wait_stack_end(self, timeout):
+        """ Waits until an event of the stack itself reaches a status that is not
+        in progress or until timeout seconds pass. Returns that status or None
+        on timeout.
+        """
+        if not self._stack_end.wait(timeout):
+            return None
+        self._stack_end.clear()
+        return self.stack_status
 
     def list_logs(self):
         do_wait = object()
         dedup_queue = deque(maxlen=10000)
+        if self.checkpoint:
+            dedup_queue.extend(self.checkpoint.event_ids(self.checkpoint_key))
         kwargs = {'StackName': self.log_group_name}
 
         def generator():
@@ -394,3 +875,12 @@ class CloudFormationEvents(LogWorkerThread):
                 output.append(event['ResourceStatusReason'])
             uprint(' '.join(output))
             sys.stdout.flush()
+            if self.checkpoint:
+                self.checkpoint.record(self.checkpoint_key, timestamp(event['Timestamp']),
+                                       event['EventId'])
+                self.checkpoint.save()
+            if event['ResourceType'] == 'AWS::CloudFormation::Stack' and \
+               event['LogicalResourceId'] == event['StackName'] and \
+               not message.endswith('_IN_PROGRESS'):
+                self.stack_status = message
+                self._stack_end.set()
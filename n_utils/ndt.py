@@ -5,7 +5,8 @@ import sys
 import locale
 from subprocess import PIPE, Popen
 from argcomplete import USING_PYTHON2, ensure_str, split_line
-from n_utils import COMMAND_MAPPINGS
+from n_utils import COMMAND_MAPPINGS, SERVER_SOCKET_ENV
+from n_utils.completion_cache import fast_complete
 
 SYS_ENCODING = locale.getpreferredencoding()
 include_dirs = []
@@ -83,6 +84,11 @@ def do_command_completion():
             else:
                 sys.exit(1)
         else:
+            candidates = fast_complete(command, comp_words, current, prev)
+            if candidates is not None:
+                output_stream.write(ifs.join(candidates).encode(SYS_ENCODING))
+                output_stream.flush()
+                sys.exit(0)
             line = comp_line[3:].lstrip()
             os.environ['COMP_POINT'] = str(comp_point - (len(comp_line) -
                                                          len(line)))
@@ -117,6 +123,13 @@ def ndt():
            command_type == "ndtshell" or command_type == "ndtscript":
             sys.exit(Popen([command] + sys.argv[2:]).wait())
         else:
+            if os.environ.get(SERVER_SOCKET_ENV):
+                # only clients of ndt serve pay for importing the client
+                from n_utils.ndt_server import SERVED_COMMANDS, forward
+                if command in SERVED_COMMANDS:
+                    exit_code = forward(os.environ[SERVER_SOCKET_ENV], sys.argv[1:])
+                    if exit_code is not None:
+                        sys.exit(exit_code)
             parts = command_type.split(":")
             my_func = getattr(__import__(parts[0], fromlist=[parts[1]]),
                               parts[1])
@@ -3,7 +3,8 @@ from builtins import object
 import sys
 import inspect
 from operator import attrgetter
-from os import sep, path, mkdir
+from multiprocessing.pool import ThreadPool
+from os import sep, path, mkdir, environ
 import re
 try:
     from os import scandir, walk
@@ -149,7 +150,40 @@ def guess_project_root():
             else:
                 return path.abspath(guess)
 
-def list_jobs(export_job_properties=False, branch=None, json=False, component=None):
+def _map(jobs, func, items):
+    """ Like map, but runs func in a pool of jobs threads when jobs is more than
+    one. Results are in the order of items either way.
+    """
+    if jobs > 1 and len(items) > 1:
+        pool = ThreadPool(min(jobs, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+    return [func(item) for item in items]
+
+def _load_parameters(prop_args):
+    return load_parameters(**prop_args)
+
+def _load_all_parameters(jobs, prop_args_list):
+    if jobs <= 1 or len(prop_args_list) <= 1:
+        return [_load_parameters(prop_args) for prop_args in prop_args_list]
+    # load_parameters leaves ORIG_<TYPE>_NAME of every subcomponent it loads in the
+    # environment and later loads pick those up. Replay that to give each parallel
+    # load the environment it would see in a serial run.
+    run_environ = dict(environ)
+    loads = []
+    for prop_args in prop_args_list:
+        loads.append(dict(prop_args, environ=dict(run_environ)))
+        for sc_type in ["stack", "serverless", "cdk", "terraform", "docker", "image"]:
+            if prop_args.get(sc_type):
+                run_environ["ORIG_" + sc_type.upper() + "_NAME"] = prop_args[sc_type]
+    ret = _map(jobs, _load_parameters, loads)
+    environ.update(dict([(k, v) for k, v in list(run_environ.items()) if environ.get(k) != v]))
+    return ret
+
+def list_jobs(export_job_properties=False, branch=None, json=False, component=None, jobs=1):
     ret = {"branches":[]}
     arr = []
     param_files = {}
@@ -159,6 +193,9 @@ def list_jobs(export_job_properties=False, branch=None, json=False, component=No
             branches = [ branch ]
         else:
             branches = git.get_branches()
+        if jobs > 1:
+            # export the other branches up front so that the exports run in parallel
+            _map(jobs, git.export_branch, [b for b in branches if b != git.get_current_branch()])
         components = []
         for c_branch in branches:
             branch_obj = {"name": c_branch, "components": []}
@@ -192,9 +229,10 @@ def list_jobs(export_job_properties=False, branch=None, json=False, component=No
                 else:
                     raise err
         if json:
-            _collect_json(components, ret, export_job_properties ,git)
+            _collect_json(components, ret, export_job_properties ,git, jobs=jobs)
         else:
-            arr, param_files = _collect_prop_files(components, export_job_properties, current_project.root, git)
+            arr, param_files = _collect_prop_files(components, export_job_properties, current_project.root, git,
+                                                   jobs=jobs)
             if export_job_properties:
                 _write_prop_files(param_files)
     if json:
@@ -202,7 +240,8 @@ def list_jobs(export_job_properties=False, branch=None, json=False, component=No
     else:
         return arr
 
-def _collect_json(components, ret, export_job_properties, git):
+def _collect_json(components, ret, export_job_properties, git, jobs=1):
+    to_load = []
     with git:
         for component in components:
             subcomponents = component.get_subcomponents()
@@ -220,11 +259,15 @@ def _collect_json(components, ret, export_job_properties, git):
                         "branch": component.project.branch,
                         "git": git
                     }
-                    subc_elem["properties"] = load_parameters(**prop_args)
+                    to_load.append((subc_elem, prop_args))
+        loaded = _load_all_parameters(jobs, [prop_args for _, prop_args in to_load])
+        for (subc_elem, _), parameters in zip(to_load, loaded):
+            subc_elem["properties"] = parameters
 
-def _collect_prop_files(components, export_job_properties, root, git):
+def _collect_prop_files(components, export_job_properties, root, git, jobs=1):
     arr = []
     param_files = {}
+    to_load = []
     with git:
         for component in components:
             subcomponents = component.get_subcomponents()
@@ -239,8 +282,10 @@ def _collect_prop_files(components, export_job_properties, root, git):
                         "branch": component.project.branch,
                         "git": git
                     }
-                    parameters = load_parameters(**prop_args)
-                    param_files[filename] = parameters
+                    to_load.append((filename, prop_args))
+        loaded = _load_all_parameters(jobs, [prop_args for _, prop_args in to_load])
+        for (filename, _), parameters in zip(to_load, loaded):
+            param_files[filename] = parameters
     return arr, param_files
 
 def _write_prop_files(param_files):
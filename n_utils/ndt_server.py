@@ -0,0 +1,270 @@
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A long running process that runs ndt commands on behalf of `ndt` over a
+unix socket. Scripts that call ndt many times then share one interpreter, its
+imported modules, the default boto3 session and the account and stack caches.
+"""
+from __future__ import print_function
+from builtins import str
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from six import StringIO
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+from n_utils import COMMAND_MAPPINGS, SERVER_SOCKET_ENV
+
+SOCKET_ENV = SERVER_SOCKET_ENV
+# commands that do not read stdin or follow output and can run in the server
+SERVED_COMMANDS = [
+    "account-id",
+    "assumed-role-name",
+    "cf-get-parameter",
+    "cf-logical-id",
+    "cf-region",
+    "cf-stack-id",
+    "cf-stack-name",
+    "ec2-instance-id",
+    "ec2-region",
+    "ecr-repo-uri",
+    "get-images",
+    "interpolate-file",
+    "json-to-yaml",
+    "list-components",
+    "list-file-to-json",
+    "list-jobs",
+    "load-parameters",
+    "region",
+    "show-stack-params-and-outputs",
+    "yaml-to-json",
+    "yaml-to-yaml"
+]
+PRELOAD_MODULES = ["n_utils.cli", "n_utils.cf_utils", "n_utils.aws_infra_util",
+                   "n_utils.ndt_project"]
+# a change in any of these switches credentials or region and drops the boto3 session
+IDENTITY_ENV = ["AWS_PROFILE", "AWS_DEFAULT_PROFILE", "AWS_ACCESS_KEY_ID",
+                "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN", "AWS_DEFAULT_REGION",
+                "AWS_REGION", "AWS_CONFIG_FILE", "AWS_SHARED_CREDENTIALS_FILE"]
+
+
+def default_socket():
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    return os.path.join(os.path.expanduser("~"), ".ndt", "server.sock")
+
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def forward(socket_path, argv):
+    """ Runs the ndt command in argv in the server listening on socket_path and
+    copies its output to stdout and stderr. Returns the exit code of the
+    command or None if no server answered.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        client.sendall(json.dumps(request).encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        response = _read_all(client)
+    except socket.error:
+        return None
+    finally:
+        client.close()
+    if not response:
+        return None
+    response = json.loads(response.decode("utf-8"))
+    sys.stdout.write(response["stdout"])
+    sys.stdout.flush()
+    sys.stderr.write(response["stderr"])
+    sys.stderr.flush()
+    return response["exit"]
+
+
+def run_command(argv):
+    """ Runs an ndt command in this process and returns its exit code
+    """
+    command = argv[0]
+    if command not in SERVED_COMMANDS:
+        sys.stderr.write("ndt serve: " + command + " can not be run in the server\n")
+        return 1
+    module, func = COMMAND_MAPPINGS[command].split(":")
+    sys.argv = ["ndt " + command] + argv[1:]
+    try:
+        getattr(__import__(module, fromlist=[func]), func)()
+    except SystemExit as exit:
+        if exit.code is None:
+            return 0
+        if isinstance(exit.code, int):
+            return exit.code
+        sys.stderr.write(str(exit.code) + "\n")
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def reset_request_state():
+    """ Drops the parameters that templates source from their stack and the
+    dependencies of the template being converted. Both belong to the previous
+    command.
+    """
+    aws_infra_util = sys.modules.get("n_utils.aws_infra_util")
+    if aws_infra_util:
+        aws_infra_util.SOURCED_PARAMS = None
+        aws_infra_util.DEPENDENCIES = None
+
+
+def reset_caches(identity_changed):
+    """ Drops cached stack outputs, properties files that may have resolved
+    them and, if the credentials may have changed, the account, role and boto3
+    session. Modules that are not loaded yet have nothing cached.
+    """
+    aws_infra_util = sys.modules.get("n_utils.aws_infra_util")
+    if aws_infra_util:
+        aws_infra_util.stacks.clear()
+        aws_infra_util.PROPERTIES_FILES.clear()
+    if not identity_changed:
+        return
+    cf_utils = sys.modules.get("n_utils.cf_utils")
+    if cf_utils:
+        cf_utils.ACCOUNT_ID = None
+        cf_utils.ROLE_NAME = None
+    boto3 = sys.modules.get("boto3")
+    if boto3:
+        boto3.DEFAULT_SESSION = None
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.read().decode("utf-8"))
+        exit_code, out, err = self.server.run(request)
+        response = {"exit": exit_code, "stdout": out, "stderr": err}
+        self.wfile.write(json.dumps(response).encode("utf-8"))
+
+
+class CommandServer(socketserver.UnixStreamServer):
+    """ Runs one command at a time in the environment and working directory of
+    the client. Stack outputs are cached for at most cache_ttl seconds. The
+    server does not see stacks that commands run outside of it deploy, so their
+    outputs may be stale for that long.
+    """
+    def __init__(self, socket_path, idle_timeout=None, cache_ttl=0):
+        socketserver.UnixStreamServer.__init__(self, socket_path, CommandHandler)
+        self.timeout = idle_timeout or None
+        self.cache_ttl = cache_ttl
+        self.identity = None
+        self.cache_time = time.time()
+        self.idle = False
+
+    def handle_timeout(self):
+        self.idle = True
+
+    def refresh_caches(self, environ):
+        identity = [environ.get(name) for name in IDENTITY_ENV]
+        now = time.time()
+        if identity != self.identity or now - self.cache_time >= self.cache_ttl:
+            reset_caches(identity != self.identity)
+            self.identity = identity
+            self.cache_time = now
+
+    def run(self, request):
+        self.refresh_caches(request["env"])
+        reset_request_state()
+        saved_environ = dict(os.environ)
+        saved_cwd = os.getcwd()
+        saved_streams = (sys.argv, sys.stdin, sys.stdout, sys.stderr)
+        out, err = StringIO(), StringIO()
+        try:
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            sys.stdin, sys.stdout, sys.stderr = StringIO(), out, err
+            exit_code = run_command(request["argv"])
+        finally:
+            sys.argv, sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_environ)
+        return exit_code, out.getvalue(), err.getvalue()
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+
+def serve():
+    """ Run ndt commands for ndt clients that connect to a unix socket. ndt
+    forwards the commands that can run in the server when NDT_SERVER_SOCKET
+    points to the socket and runs them locally if the server is not there.
+    """
+    import argcomplete
+    from n_utils.cli import get_parser
+    parser = get_parser()
+    parser.add_argument("-s", "--socket", help="The socket to listen on. Default is " +
+                        "$NDT_SERVER_SOCKET or ~/.ndt/server.sock", default=default_socket())
+    parser.add_argument("-i", "--idle-timeout", type=int, default=900,
+                        help="Exit after this many seconds without requests. 0 " +
+                        "means never. Default is 900")
+    parser.add_argument("-t", "--cache-ttl", type=int, default=0,
+                        help="Seconds to keep stack outputs cached between commands. " +
+                        "Stacks deployed by commands that do not run in the server, " +
+                        "like deploy-stack, may be read stale for this long. Default " +
+                        "is 0, which reads stacks again for every command")
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(args.socket)
+            parser.error("A server is already listening on " + args.socket)
+        except socket.error:
+            os.remove(args.socket)
+        finally:
+            probe.close()
+    socket_dir = os.path.dirname(os.path.abspath(args.socket))
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    for module in PRELOAD_MODULES:
+        __import__(module)
+    umask = os.umask(0o077)
+    try:
+        server = CommandServer(args.socket, idle_timeout=args.idle_timeout,
+                               cache_ttl=args.cache_ttl)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, _terminate)
+    sys.stderr.write("ndt serve: listening on " + args.socket + "\n")
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -1,19 +1,75 @@
 from __future__ import print_function
+import json
+import os
 from os import linesep
 from os.path import expanduser, join, exists
 from sys import argv
-from n_utils.profile_util import enable_profile
+from time import time
+from n_utils.completion_cache import find_git_dir
 import locale
 import subprocess
 
+STAMP_FILE = "ndt-project-env.json"
+# seconds before a memoized prompt runs the hook again even if nothing changed
+STAMP_MAX_AGE = 60
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _project_env_stamp(git_dir):
+    files = [join(git_dir, "config"), join(expanduser("~"), ".aws", "credentials"),
+             join(expanduser("~"), ".aws", "config")]
+    return {
+        "git_dir": git_dir,
+        "mtimes": [_mtime(name) for name in files],
+        "env": sorted([key, value] for key, value in os.environ.items() if key.startswith("AWS_"))
+    }
+
+def _stamp_unchanged(stamp_file, stamp):
+    try:
+        with open(stamp_file) as in_file:
+            stored = json.load(in_file)
+    except (IOError, OSError, ValueError):
+        return False
+    return stored["stamp"] == stamp and time() < stored["valid_until"]
+
+def _write_stamp(stamp_file, stamp):
+    # expiring sessions need the hook to run again when they expire
+    valid_until = time() + STAMP_MAX_AGE
+    for key, value in os.environ.items():
+        if key.startswith("AWS_SESSION_EXPIRATION_EPOC_") and value.isdigit():
+            valid_until = min(valid_until, int(value))
+    try:
+        with open(stamp_file, "w") as out_file:
+            json.dump({"stamp": stamp, "valid_until": valid_until}, out_file)
+    except (IOError, OSError):
+        pass
+
 def load_project_env():
-    """ Print parameters set by git config variables to setup project environment with region and aws credentials
+    """ Print parameters set by git config variables to setup project environment with region and aws credentials.
+    With --memoize nothing is done or printed if the git config, the aws credentials and config and the AWS_*
+    environment variables are the same as on the previous run.
     """
+    memoize = "--memoize" in argv[1:]
+    if memoize:
+        git_dir = find_git_dir()
+        if not git_dir:
+            return
+        stamp = json.loads(json.dumps(_project_env_stamp(git_dir)))
+        stamp_file = join(git_dir, STAMP_FILE)
+        if _stamp_unchanged(stamp_file, stamp):
+            return
+    from n_utils.profile_util import enable_profile
     proc = subprocess.Popen(["git", "config", "--list", "--local"], stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
     out = proc.communicate()
     if proc.returncode:
         return
+    if memoize:
+        _write_stamp(stamp_file, stamp)
     vars = {}
     for line in out[0].decode(locale.getpreferredencoding()).split("\n"):
         if line:
@@ -73,9 +129,12 @@ def ndt_register_complete():
 complete -o nospace -F _ndt_complete "ndt"
 """, end="")
     if len(argv) > 1 and argv[1] == "--project-env":
+        memoize = ""
+        if "--memoize" in argv[2:]:
+            memoize = " --memoize"
         print("""_projectenv_hook() {
   local previous_exit_status=$?;
-  eval "$(nitor-dt-load-project-env)";
+  eval "$(nitor-dt-load-project-env""" + memoize + """)";
   return $previous_exit_status;
 };
 if ! [[ "$PROMPT_COMMAND" =~ _projectenv_hook ]]; then
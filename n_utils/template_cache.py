@@ -0,0 +1,161 @@
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" On-disk cache for pre-processed templates. Entries are addressed by a hash
+of the template, the merged files and the resolved parameters and record every
+file and stack output the pre-processor used, so that a hit can be verified
+without running the pre-processor.
+"""
+from builtins import object
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from n_utils.mfa_utils import get_ndt_dir
+
+CACHE_FORMAT = "1"
+# entries that have not been used for this many seconds are removed when new
+# entries are written
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# changes to the pre-processor invalidate cached templates
+PREPROCESSOR_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), source)
+                        for source in ["aws_infra_util.py", "cf_utils.py"]]
+
+
+def file_digest(filename):
+    if not filename or not os.path.isfile(filename):
+        return None
+    sha = hashlib.sha256()
+    with open(filename, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_enabled():
+    return os.environ.get("NDT_TEMPLATE_CACHE", "true").lower() not in ["0", "false", "no", "off"]
+
+
+class TemplateDependencies(object):
+    """ Files, imports and stack outputs used while pre-processing a template
+    """
+    def __init__(self):
+        self.files = OrderedDict()
+        self.imports = []
+        self.stackrefs = []
+
+    def add_file(self, filename):
+        filename = os.path.abspath(filename)
+        if filename not in self.files:
+            self.files[filename] = file_digest(filename)
+
+    def add_import(self, filename, basefile, resolved):
+        entry = [filename, basefile, resolved]
+        if entry not in self.imports:
+            self.imports.append(entry)
+        if resolved:
+            self.add_file(resolved)
+
+    def add_stackref(self, region, stack_name, stack_param, value):
+        entry = [region, stack_name, stack_param, value]
+        if entry not in self.stackrefs:
+            self.stackrefs.append(entry)
+
+    def to_dict(self):
+        return OrderedDict([("files", self.files), ("imports", self.imports),
+                            ("stackrefs", self.stackrefs)])
+
+
+class TemplateCache(object):
+    def __init__(self, directory=None):
+        if not directory:
+            directory = os.environ.get("NDT_CACHE_DIR")
+        if not directory:
+            directory = os.path.join(get_ndt_dir(), "cache")
+        self.directory = os.path.join(directory, "templates")
+
+    def key(self, template, merge, params):
+        sha = hashlib.sha256()
+        parts = [CACHE_FORMAT, os.getcwd(), os.path.abspath(template), file_digest(template)]
+        for merge_file in merge or []:
+            parts.extend([os.path.abspath(merge_file), file_digest(merge_file)])
+        for source in PREPROCESSOR_SOURCES:
+            parts.append(file_digest(source))
+        parts.append(json.dumps(params, sort_keys=True, default=lambda value: None))
+        for part in parts:
+            sha.update(str(part).encode("utf-8"))
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    def _entry_file(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key, is_valid):
+        """ Returns the cached template for key if the callback accepts its
+        recorded dependencies
+        """
+        entry_file = self._entry_file(key)
+        if not os.path.isfile(entry_file):
+            return None
+        try:
+            with open(entry_file, "r") as in_file:
+                entry = json.load(in_file, object_pairs_hook=OrderedDict)
+            dependencies, template = entry["dependencies"], entry["template"]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not is_valid(dependencies):
+            return None
+        try:
+            # keeps the entry from being pruned
+            os.utime(entry_file, None)
+        except OSError:
+            pass
+        return template
+
+    def put(self, key, dependencies, template):
+        entry_file = self._entry_file(key)
+        entry_dir = os.path.dirname(entry_file)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        entry = OrderedDict([("dependencies", dependencies.to_dict()), ("template", template)])
+        fd, tmp_file = tempfile.mkstemp(dir=entry_dir)
+        try:
+            with os.fdopen(fd, "w") as out_file:
+                json.dump(entry, out_file)
+            os.rename(tmp_file, entry_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        self.prune()
+
+    def prune(self, max_age=CACHE_MAX_AGE):
+        """ Removes entries and leftover temporary files that have not been
+        used for max_age seconds
+        """
+        oldest = time.time() - max_age
+        for entry_dir in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, entry_dir)
+            if not os.path.isdir(entry_dir):
+                continue
+            for entry_file in os.listdir(entry_dir):
+                entry_file = os.path.join(entry_dir, entry_file)
+                try:
+                    if os.path.getmtime(entry_file) < oldest:
+                        os.remove(entry_file)
+                except OSError:
+                    # written or removed by another ndt at the same time
+                    pass
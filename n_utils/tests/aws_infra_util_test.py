@@ -1,4 +1,11 @@
-from n_utils.aws_infra_util import yaml_to_dict
+import os
+import time
+import n_utils.aws_infra_util
+from collections import OrderedDict
+from n_utils.aws_infra_util import yaml_to_dict, TemplateParams, PARAM_NOT_AVAILABLE, \
+    ParsedFileCache, import_script, cached_yaml_to_dict, PropertiesFileCache, \
+    import_parameter_file
+from n_utils.template_cache import TemplateCache, TemplateDependencies, CACHE_MAX_AGE
 
 def test_merge_import(mocker):
     result = yaml_to_dict('n_utils/tests/templates/test.yaml')
@@ -32,4 +39,112 @@ def test_just_import(mocker):
     assert result['Parameters']['paramTest6']['Default'] == 'TEST2'
     assert result['Parameters']['paramTest7']['Default'] == 'tEST2'
 
+def test_template_params_refresh(mocker):
+    mocker.patch('n_utils.aws_infra_util._run_params', return_value=OrderedDict([('REGION', 'eu-west-1')]))
+    root = OrderedDict([('Parameters', OrderedDict([('paramTest', OrderedDict([('Default', 'test')]))])),
+                        ('Resources', OrderedDict([('resTest', OrderedDict())]))])
+    params = TemplateParams(root, 'template.yaml')
+    assert params['paramTest'] == 'test'
+    assert params['REGION'] == 'eu-west-1'
+    assert params['resTest'] == PARAM_NOT_AVAILABLE
+    root['Parameters']['paramTest']['Default'] = 'test2'
+    params.touch('Resources_resTest_Properties_')
+    params.refresh()
+    assert params['paramTest'] == 'test'
+    assert params.rebuilds == 1
+    params.touch('Parameters_paramTest_')
+    params.refresh()
+    assert params['paramTest'] == 'test2'
+    assert params.rebuilds == 2
 
+def test_parsed_file_cache(tmpdir):
+    script = tmpdir.join("script.sh")
+    script.write("CF_paramTest=foo\n")
+    cache = ParsedFileCache()
+    first = cache.get(str(script), import_script)
+    first[1]['Ref'] = 'changed'
+    second = cache.get(str(script), import_script)
+    assert second[1]['Ref'] == 'paramTest'
+    assert (cache.hits, cache.misses) == (1, 1)
+    script.write("CF_paramOther=foo\n")
+    script.setmtime(script.mtime() + 10)
+    assert cache.get(str(script), import_script)[1]['Ref'] == 'paramOther'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_properties_file_cache(mocker, tmpdir):
+    props = tmpdir.join("infra.properties")
+    props.write("paramA=a-${paramEnvId}\nparamB=$paramA-${OWNER}\nOWNER=file\n")
+    cache = PropertiesFileCache()
+    mocker.patch('n_utils.aws_infra_util.PROPERTIES_FILES', cache)
+    params = {"paramEnvId": "dev"}
+    import_parameter_file(str(props), params, {"OWNER": "ops"})
+    assert params == {"paramEnvId": "dev", "paramA": "a-dev", "paramB": "a-dev-ops",
+                      "OWNER": "ops"}
+    params = {"paramEnvId": "dev", "COMPONENT": "other"}
+    import_parameter_file(str(props), params, {"OWNER": "ops", "UNUSED": "x"})
+    assert params["paramB"] == "a-dev-ops"
+    assert (cache.hits, cache.misses) == (1, 1)
+    params = {"paramEnvId": "prod"}
+    import_parameter_file(str(props), params, {"OWNER": "ops"})
+    assert params["paramB"] == "a-prod-ops"
+    params = {"paramEnvId": "prod"}
+    import_parameter_file(str(props), params, {})
+    assert params["paramB"] == "a-prod-${OWNER}" and params["OWNER"] == "file"
+    assert (cache.hits, cache.misses) == (1, 3)
+    props.write("paramA=b-${paramEnvId}\n")
+    props.setmtime(props.mtime() + 10)
+    params = {"paramEnvId": "prod"}
+    import_parameter_file(str(props), params, {})
+    assert params == {"paramEnvId": "prod", "paramA": "b-prod"}
+    assert (cache.hits, cache.misses) == (1, 4)
+
+def test_properties_file_cache_stackrefs(mocker, tmpdir):
+    props = tmpdir.join("infra.properties")
+    props.write("paramVpc=StackRef: {region: eu-west-1, stackName: vpc, paramName: VPC}\n")
+    cache = PropertiesFileCache()
+    mocker.patch('n_utils.aws_infra_util.PROPERTIES_FILES', cache)
+    mocker.patch('n_utils.aws_infra_util.stacks', {})
+    outputs = mocker.patch('n_utils.aws_infra_util.stack_params_and_outputs',
+                           return_value={"VPC": "vpc-1"})
+    params = {}
+    import_parameter_file(str(props), params, {})
+    assert params["paramVpc"] == "vpc-1"
+    outputs.return_value = {"VPC": "vpc-2"}
+    params = {}
+    import_parameter_file(str(props), params, {})
+    assert params["paramVpc"] == "vpc-1"
+    assert (cache.hits, cache.misses) == (1, 1)
+    n_utils.aws_infra_util.stacks.clear()
+    params = {}
+    import_parameter_file(str(props), params, {})
+    assert params["paramVpc"] == "vpc-2"
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_cached_yaml_to_dict(mocker, tmpdir, monkeypatch):
+    monkeypatch.setenv('NDT_CACHE_DIR', str(tmpdir.join('cache')))
+    mocker.patch('n_utils.aws_infra_util._run_params', return_value=OrderedDict([('REGION', 'eu-west-1')]))
+    snippet = tmpdir.join('snippet.yaml')
+    snippet.write("Type: AWS::SNS::Topic\n")
+    template = tmpdir.join('template.yaml')
+    template.write("Resources:\n  resTopic:\n    Fn::ImportYaml: snippet.yaml\n")
+    preprocess = mocker.spy(n_utils.aws_infra_util, 'yaml_to_dict')
+    assert cached_yaml_to_dict(str(template))['Resources']['resTopic']['Type'] == 'AWS::SNS::Topic'
+    assert cached_yaml_to_dict(str(template))['Resources']['resTopic']['Type'] == 'AWS::SNS::Topic'
+    assert preprocess.call_count == 1
+    snippet.write("Type: AWS::SQS::Queue\n")
+    assert cached_yaml_to_dict(str(template))['Resources']['resTopic']['Type'] == 'AWS::SQS::Queue'
+    assert preprocess.call_count == 2
+
+def test_template_cache_entries(tmpdir):
+    cache = TemplateCache(str(tmpdir))
+    cache.put("aa01", TemplateDependencies(), {"Resources": {}})
+    assert cache.get("aa01", lambda dependencies: True) == {"Resources": {}}
+    for key, content in [("aa02", "{\"template\": {}}"), ("aa03", "[]"), ("aa04", "{")]:
+        tmpdir.join("templates", "aa", key + ".json").write(content)
+        assert cache.get(key, lambda dependencies: True) is None
+    old = time.time() - CACHE_MAX_AGE - 60
+    os.utime(str(tmpdir.join("templates", "aa", "aa01.json")), (old, old))
+    cache.put("bb01", TemplateDependencies(), {"Resources": {}})
+    assert not tmpdir.join("templates", "aa", "aa01.json").exists()
+    assert tmpdir.join("templates", "aa", "aa02.json").exists()
+    assert cache.get("bb01", lambda dependencies: True) == {"Resources": {}}
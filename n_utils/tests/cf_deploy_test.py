@@ -0,0 +1,83 @@
+import time
+from datetime import datetime
+import n_utils.cf_deploy
+from botocore.exceptions import ClientError
+from n_utils.cf_deploy import get_end_status, log_data, update_stack, upload_template
+
+def stack_event(event_id, status):
+    return {"EventId": event_id, "StackName": "stack", "LogicalResourceId": "stack",
+            "ResourceType": "AWS::CloudFormation::Stack", "ResourceStatus": status,
+            "Timestamp": datetime.utcnow()}
+
+def test_get_end_status(mocker):
+    mocker.patch.object(n_utils.cf_deploy, "CloudWatchLogsThread")
+    session = mocker.MagicMock()
+    client = session.client.return_value
+    events = [stack_event("1", "UPDATE_IN_PROGRESS")]
+    statuses = ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE"]
+
+    def describe_stack_events(**kwargs):
+        ret = {"StackEvents": list(reversed(events))}
+        if len(events) == 1:
+            events.append(stack_event("2", "UPDATE_COMPLETE"))
+        return ret
+    client.describe_stack_events.side_effect = describe_stack_events
+    client.describe_stacks.side_effect = lambda **kwargs: {"Stacks": [{"StackStatus": statuses.pop(0)}]}
+    start = time.time()
+    assert get_end_status("stack", session=session) == "UPDATE_COMPLETE"
+    assert time.time() - start < n_utils.cf_deploy.STATUS_POLL_INTERVAL
+    assert client.describe_stacks.call_count == 2
+
+def test_keep_change_set(mocker, boto3_client):
+    mocker.patch.object(n_utils.cf_deploy, "log")
+    mocker.patch.object(n_utils.cf_deploy, "log_data")
+    mocker.patch.dict("os.environ", {"CF_BUCKET": ""})
+    summaries = []
+    boto3_client.get_paginator.return_value.paginate.side_effect = \
+        lambda **kwargs: [{"Summaries": list(summaries)}]
+    boto3_client.create_change_set.return_value = {"Id": "chset-1"}
+    boto3_client.describe_change_set.side_effect = \
+        lambda **kwargs: {"Status": "CREATE_COMPLETE", "CreationTime": datetime.utcnow()}
+    params = [{"ParameterKey": "paramEnvId", "ParameterValue": "dev"}]
+    update_stack("stack", "{}", params, dry_run=True, keep_change_set=True)
+    description = boto3_client.create_change_set.call_args[1]["Description"]
+    assert boto3_client.delete_change_set.call_count == 0
+    summaries.append({"ChangeSetId": "chset-1", "Description": description,
+                      "Status": "CREATE_COMPLETE", "ExecutionStatus": "AVAILABLE"})
+    update_stack("stack", "{}", [{"ParameterKey": "paramEnvId", "ParameterValue": "prod"}])
+    assert boto3_client.create_change_set.call_count == 2
+    update_stack("stack", "{}", params)
+    assert boto3_client.create_change_set.call_count == 2
+    boto3_client.execute_change_set.assert_called_with(ChangeSetName="chset-1")
+
+def test_upload_template(mocker):
+    mocker.patch.object(n_utils.cf_deploy, "log")
+    mocker.patch.object(n_utils.cf_deploy, "UPLOADED_TEMPLATES", set())
+    s3cli = mocker.MagicMock()
+    s3cli.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
+    key = upload_template(s3cli, "bucket", "{}")
+    assert key == "ndt-templates/99914b932bd37a50b983c5e7c90ae93b.json"
+    assert s3cli.upload_fileobj.call_args[0][1:] == ("bucket", key)
+    assert upload_template(s3cli, "bucket", "{}") == key
+    assert s3cli.head_object.call_count == 1
+    n_utils.cf_deploy.UPLOADED_TEMPLATES.clear()
+    s3cli.head_object.side_effect = None
+    upload_template(s3cli, "bucket", "{}")
+    assert s3cli.upload_fileobj.call_count == 1
+
+def test_log_data_modes(mocker, monkeypatch):
+    log = mocker.patch.object(n_utils.cf_deploy, "log")
+    template = {"Parameters": {"paramEnvId": {"Type": "String", "Default": "dev"}},
+                "Resources": {"Role": {"Type": "AWS::IAM::Role"}, "Bucket": {"Type": "AWS::S3::Bucket"},
+                              "Other": {"Type": "AWS::IAM::Role"}}}
+    monkeypatch.setenv("NDT_DEPLOY_OUTPUT", "summary")
+    log_data(template, output_format="json")
+    summary = log.call_args[0][0]
+    assert "Resources: 3" in summary and "   2 AWS::IAM::Role" in summary
+    assert "paramEnvId (String): dev" in summary
+    monkeypatch.setenv("NDT_DEPLOY_OUTPUT", "plain")
+    log_data(template, output_format="json", formatted="{}")
+    assert log.call_args[0][0].strip() == "{}"
+    monkeypatch.setenv("NDT_DEPLOY_OUTPUT", "highlighted")
+    log_data(template, output_format="json", formatted="{}")
+    assert "\033[" in log.call_args[0][0] and "AWS::S3::Bucket" in log.call_args[0][0]
@@ -1,4 +1,11 @@
-from n_utils.cf_utils import InstanceInfo, get_images, INSTANCE_IDENTITY_URL, resolve_account
+import os
+import stat
+from collections import OrderedDict
+import n_utils.cf_utils
+from multiprocessing.pool import ThreadPool
+from n_utils.cf_utils import CLIENT_LOCK, stack_params_and_outputs, InstanceInfo, get_images, INSTANCE_IDENTITY_URL, resolve_account, \
+    expand_vars, expand_vars_in_place, SubstitutionPlans, PARAM_RE, _compile_param_plan, _process_line, \
+    interpolate_file, VaultSecrets
 from n_utils.aws_infra_util import yaml_to_dict
 from dateutil.parser import parse
 
@@ -330,4 +337,113 @@ def test_stackref_order(mocker, boto3_client):
            "{\n  \"s3\": [{\n    \"path\": \"/${x-forwarded-for}/*\",\n    \"bucket\": \"dev-my-test-bucket\",\n    \"basePath\": \"\",\n    \"region\": \"${AWS::Region}\"\n  }]\n}\n"
     assert result["Resources"]["resBackendRole"]["Properties"]["Policies"][0]["PolicyDocument"]["Statement"][1]["Resource"] == \
            "arn:aws:s3:::dev-my-test-bucket/"
-    assert result["Resources"]["resInboxPolicy"]["Properties"]["Bucket"]["Fn::Sub"] == "${myBucket.Arn}/*"
\ No newline at end of file
+    assert result["Resources"]["resInboxPolicy"]["Properties"]["Bucket"]["Fn::Sub"] == "${myBucket.Arn}/*"
+
+def test_expand_vars_in_place():
+    params = {"paramEnvId": "dev", "paramName": "app"}
+    data = OrderedDict([("first", "$paramEnvId"), ("$paramName-key", "${paramName^^}"), ("last", "plain"),
+                        ("sub", {"Fn::Sub": "${paramEnvId}-((paramName))"}), ("list", ["$paramName"])])
+    expected = expand_vars(data, params, None, [])
+    result, changed = expand_vars_in_place(data, params, None, [])
+    assert result is data
+    assert changed
+    assert list(result.items()) == list(expected.items())
+    assert list(result.keys()) == ["first", "app-key", "last", "sub", "list"]
+    assert isinstance(result["sub"], OrderedDict)
+    assert result["sub"]["Fn::Sub"] == "${paramEnvId}-app"
+    assert expand_vars_in_place(data, params, None, []) == (data, False)
+
+def test_substitution_plans():
+    plans = SubstitutionPlans(2)
+    plan = plans.get(PARAM_RE, "a-${paramName^^}-${paramEnvId:-dev}-b", _compile_param_plan)
+    assert plan == (("a-", "-", "-b"), (("paramName", "^^", "", "${paramName^^}"),
+                                        ("paramEnvId", ":-", "dev", "${paramEnvId:-dev}")))
+    assert plans.get(PARAM_RE, "a-${paramName^^}-${paramEnvId:-dev}-b", None) is plan
+    plans.get(PARAM_RE, "${x}", _compile_param_plan)
+    plans.get(PARAM_RE, "${y}", _compile_param_plan)
+    assert list(plans.plans.keys()) == [(PARAM_RE.pattern, "${x}"), (PARAM_RE.pattern, "${y}")]
+    params = {"paramName": "app", "paramRef": "${paramName}"}
+    assert _process_line("a-${paramName^^}-${paramEnvId:-dev}-b", params, None, []) == "a-APP-dev-b"
+    assert _process_line("${paramRef}/${missing}", params, None, []) == "app/${missing}"
+
+def test_interpolate_file(mocker, tmpdir):
+    mocker.patch('n_utils.cf_utils.region', return_value='eu-west-1')
+    mocker.patch('n_utils.cf_utils.stack_params_and_outputs',
+                 return_value={"paramName": "app", "paramRef": "${paramName}"})
+    source = tmpdir.join("app.conf")
+    source.write("name=${paramName^^}\n" * 20 + "ref=${paramRef} ${missing}\nlast=${paramName}")
+    interpolate_file(str(source), destination=str(tmpdir.join("out.conf")), stack_name="stack", chunk_size=7)
+    assert tmpdir.join("out.conf").read() == "name=APP\n" * 20 + "ref=app ${missing}\nlast=app"
+    interpolate_file(str(source), stack_name="stack")
+    assert source.read() == tmpdir.join("out.conf").read()
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["app.conf", "out.conf"]
+    link = tmpdir.join("link.conf")
+    link.mksymlinkto(source)
+    source.write("name=${paramName}\n")
+    interpolate_file(str(link), stack_name="stack")
+    assert link.islink()
+    assert source.read() == "name=app\n"
+
+def test_interpolate_file_keeps_mode_and_owner(mocker, tmpdir):
+    mocker.patch('n_utils.cf_utils.region', return_value='eu-west-1')
+    mocker.patch('n_utils.cf_utils.stack_params_and_outputs', return_value={"paramName": "app"})
+    source = tmpdir.join("app.conf")
+    source.write("name=${paramName}\n")
+    os.chmod(str(source), 0o644)
+    before = os.stat(str(source))
+    chown = mocker.patch('n_utils.cf_utils.os.chown')
+    mocker.patch('n_utils.cf_utils.os.geteuid', return_value=before.st_uid + 1)
+    interpolate_file(str(source), stack_name="stack")
+    after = os.stat(str(source))
+    assert source.read() == "name=app\n"
+    assert stat.S_IMODE(after.st_mode) == 0o644
+    assert chown.call_args[0][1:] == (before.st_uid, before.st_gid)
+    chown.side_effect = OSError("Operation not permitted")
+    source.write("name=${paramName}\n")
+    interpolate_file(str(source), stack_name="stack")
+    assert source.read() == "name=app\n"
+    assert os.stat(str(source)).st_ino == after.st_ino
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["app.conf"]
+
+def test_interpolate_file_vault(mocker, tmpdir):
+    mocker.patch('n_utils.cf_utils.region', return_value='eu-west-1')
+    mocker.patch('n_utils.cf_utils.stack_params_and_outputs', return_value={"paramName": "app"})
+    vault = mocker.MagicMock()
+    vault.list_all.return_value = ["db.password", "api.key", "unused"]
+    vault.lookup.side_effect = lambda name: name.upper()
+    mocker.patch('n_utils.cf_utils.Vault', return_value=vault)
+    source = tmpdir.join("app.conf")
+    source.write("password=${db.password}\nkey=${api.key} ${paramName}\n" * 50)
+    interpolate_file(str(source), stack_name="stack", use_vault=True)
+    assert source.read() == "password=DB.PASSWORD\nkey=API.KEY app\n" * 50
+    assert sorted(call[0][0] for call in vault.lookup.call_args_list) == ["api.key", "db.password"]
+
+def test_vault_secrets(mocker):
+    vault = mocker.MagicMock()
+    vault.list_all.return_value = ["a", "b", "c"]
+    vault.lookup.side_effect = lambda name: name * 2
+    secrets = VaultSecrets(vault=vault, threads=2)
+    assert "a" in secrets and "d" not in secrets
+    secrets.prefetch(["a", "b", "a", "d"])
+    assert secrets.lookup("a") == "aa"
+    assert secrets.lookup("c") == "cc"
+    assert vault.lookup.call_count == 3
+
+def test_stack_params_clients_in_threads(boto3_client):
+    locked = []
+
+    def client(*args, **kwargs):
+        locked.append(CLIENT_LOCK.locked())
+        return boto3_client
+    n_utils.cf_utils.boto3.client.side_effect = client
+    boto3_client.describe_stacks.return_value = {"Stacks": [{"StackName": "stack",
+        "Outputs": [{"OutputKey": "VPC", "OutputValue": "vpc-1"}]}]}
+    boto3_client.describe_stack_resources.return_value = {"StackResources": []}
+    pool = ThreadPool(4)
+    try:
+        results = pool.map(lambda name: stack_params_and_outputs("eu-west-1", name), ["a", "b", "c"])
+    finally:
+        pool.close()
+        pool.join()
+    assert results == [{"VPC": "vpc-1"}] * 3
+    assert locked == [True] * 3
@@ -0,0 +1,84 @@
+import os
+import subprocess
+import sys
+from six import StringIO
+from n_utils.deploy_all import DeployRunner, deploy_order, project_stacks
+
+def _git(*args):
+    subprocess.check_call(["git"] + list(args), stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
+
+NETWORK_REF = "StackRef: {region: eu-west-1, stackName: network-vpc-${paramEnvId}, paramName: vpcId}"
+
+def _init_project(tmpdir):
+    _git("init", "-q", "-b", "master")
+    tmpdir.join("infra.properties").write("paramEnvId=test\nREGION=eu-west-1\n")
+    stacks = {
+        "network/stack-vpc": "Resources: {}\n",
+        "db/stack-rds": "Parameters:\n  paramVpc:\n    Type: String\n    Default:\n" +
+                        "      StackRef:\n        region: eu-west-1\n" +
+                        "        stackName: network-vpc-${paramEnvId}\n        paramName: vpcId\n",
+        "app/stack-api": "Resources:\n  Import:\n    Fn::ImportYaml: ../../common.yaml\n    " +
+                         "db: db-rds\n",
+        "app/stack-worker": "Resources: {}\n"
+    }
+    for path, template in stacks.items():
+        tmpdir.join(path, "template.yaml").write(template, ensure=True)
+        tmpdir.join(path, "infra.properties").write("", ensure=True)
+    for component in ["network", "db", "app"]:
+        tmpdir.join(component, "infra.properties").write("")
+    tmpdir.join("app", "stack-worker", "infra.properties").write("paramVpc=" + NETWORK_REF + "\n")
+    tmpdir.join("common.yaml").write("Output:\n  StackRef:\n    region: {Ref: 'AWS::Region'}\n" +
+                                     "    stackName: ${db}-${paramEnvId}\n    paramName: endpoint\n")
+
+def test_project_stacks(mocker, tmpdir, monkeypatch):
+    mocker.patch('n_utils.aws_infra_util.resolve_account', return_value='123456789012')
+    mocker.patch('n_utils.aws_infra_util.stack_params_and_outputs', return_value={})
+    monkeypatch.delenv('GIT_BRANCH', raising=False)
+    monkeypatch.chdir(tmpdir)
+    _init_project(tmpdir)
+    stacks = dict([(stack.label(), stack) for stack in project_stacks(jobs=2)])
+    deps = dict([(label, [dep.label() for dep in stack.depends]) for label, stack in stacks.items()])
+    assert deps == {"network/stack-vpc": [], "db/stack-rds": ["network/stack-vpc"],
+                    "app/stack-api": ["db/stack-rds"], "app/stack-worker": ["network/stack-vpc"]}
+    levels = [sorted(stack.label() for stack in level) for level in deploy_order(list(stacks.values()))]
+    assert levels == [["network/stack-vpc"], ["app/stack-worker", "db/stack-rds"], ["app/stack-api"]]
+    only_app = project_stacks(components=["app"])
+    assert [dep.label() for dep in only_app[0].depends + only_app[1].depends] == []
+
+class FakeStack(object):
+    def __init__(self, name, depends, exit_code=0, lines=None):
+        self.component = "c"
+        self.name = name
+        self.stack_name = "c-" + name
+        self.depends = depends
+        self.exit_code = exit_code
+        self.lines = lines or []
+        self.result = None
+
+    def label(self):
+        return self.name
+
+class FakeRunner(DeployRunner):
+    def command(self, stack):
+        script = "import sys\nfor line in sys.argv[2:]: print(line)\nsys.exit(int(sys.argv[1]))"
+        return [sys.executable, "-c", script, str(stack.exit_code)] + stack.lines
+
+def test_deploy_runner():
+    vpc = FakeStack("vpc", [], lines=["vpc done"])
+    rds = FakeStack("rds", [vpc], lines=["rds done"])
+    api = FakeStack("api", [rds])
+    out = StringIO()
+    assert FakeRunner([api, rds, vpc], jobs=2, out=out).run()
+    assert [stack.result for stack in [vpc, rds, api]] == ["deployed"] * 3
+    output = out.getvalue()
+    assert output.index("vpc done") < output.index("rds done")
+
+def test_deploy_runner_rollback():
+    rollback = "2020-01-01T00:00:00.000 AWS::CloudFormation::Stack:c-vpc UPDATE_ROLLBACK_IN_PROGRESS x"
+    vpc = FakeStack("vpc", [], exit_code=1, lines=[rollback])
+    rds = FakeStack("rds", [vpc])
+    other = FakeStack("other", [])
+    out = StringIO()
+    assert not FakeRunner([vpc, rds, other], jobs=1, out=out).run()
+    assert [stack.result for stack in [vpc, rds, other]] == ["failed", "skipped", "skipped"]
+    assert "Rollback started" in out.getvalue()
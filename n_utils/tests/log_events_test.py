@@ -0,0 +1,195 @@
+import gzip
+import json
+import time
+from threading import Event, Thread
+from botocore.exceptions import ClientError
+from six.moves import queue
+import n_utils.log_events
+import n_utils.waiter
+from n_utils.local_logs import LocalLogsClient
+from n_utils.log_events import Checkpoint, CloudWatchLogsGroups, CloudWatchLogsInsights, \
+    CloudWatchLogsWorker, LogWriter, OrderedMerge, TokenBucket, _schedule, insights_filter
+
+def test_token_bucket():
+    bucket = TokenBucket(10, burst=2)
+    stopped = Event()
+    start = time.time()
+    for _ in range(4):
+        assert bucket.acquire(stopped)
+    assert time.time() - start >= 0.15
+    bucket.throttled()
+    assert bucket.rate == 5
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 10
+    for _ in range(10):
+        bucket.throttled()
+    assert bucket.rate == 0.2
+    stopped.set()
+    assert not bucket.acquire(stopped)
+
+def test_worker_backoff(boto3_client):
+    responses = [ClientError({"Error": {"Code": "ThrottlingException"}}, "FilterLogEvents"),
+                 {"events": [{"timestamp": 1000, "logStreamName": "stream", "message": "hello"}]}]
+
+    def filter_log_events(**kwargs):
+        response = responses.pop(0) if responses else {"events": []}
+        if isinstance(response, Exception):
+            raise response
+        return response
+    boto3_client.filter_log_events.side_effect = filter_log_events
+    work_queue = queue.PriorityQueue()
+    output_queue = queue.PriorityQueue()
+    work_item = {"item": {"logGroupName": "group", "startTime": 0},
+                 "meta": {"initialQueriesDone": Event(), "idleDelay": 0.0}}
+    _schedule(work_queue, work_item, 0)
+    bucket = TokenBucket(100)
+    worker = CloudWatchLogsWorker(work_queue, bucket, output_queue)
+    worker.start()
+    deadline = time.time() + 5
+    while work_item["meta"]["idleDelay"] < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    worker.stop()
+    worker.join()
+    assert output_queue.get_nowait()[-1]["message"] == "hello"
+    assert work_item["item"]["startTime"] == 1001
+    assert work_item["meta"]["idleDelay"] == 2
+    # one throttled call, one with events and two idle rounds one and two seconds apart
+    assert boto3_client.filter_log_events.call_count == 4
+    assert bucket.rate < 100
+
+def test_insights_filter():
+    assert insights_filter(None) == []
+    assert insights_filter('ERROR "disk full"') == ['filter @message like "ERROR"',
+                                                    'filter @message like "disk full"']
+    assert insights_filter('{ $.level = "error" }') is None
+    assert insights_filter('ERROR -DEBUG') is None
+
+def test_insights_backend(monkeypatch, capsys):
+    monkeypatch.setattr(n_utils.log_events, "QUERY_GROUPS", 2)
+    monkeypatch.setattr(n_utils.log_events, "QUERY_LIMIT", 3)
+    groups = {}
+    for index in range(5):
+        groups["group-" + str(index)] = [{"timestamp": 1000000000000 + second * 1000 + index,
+                                          "logStreamName": "stream",
+                                          "message": "event " + str(second)}
+                                         for second in range(4)]
+    groups["other"] = [{"timestamp": 1000000000000, "logStreamName": "stream",
+                        "message": "not matched"}]
+    client = LocalLogsClient(groups)
+    monkeypatch.setattr(n_utils.waiter.time, "sleep", lambda seconds: None)
+    assert not CloudWatchLogsGroups(log_group_filter="^group-", start_time="1000000000",
+                                    end_time="1000000004", client=client).use_insights(groups)
+    cwlogs = CloudWatchLogsGroups(log_group_filter="^group-", start_time="1000000000",
+                                  end_time="1000000004", backend="auto", client=client)
+    cwlogs.get_logs()
+    lines = capsys.readouterr()[0].splitlines()
+    assert len(lines) == 20
+    assert [line.split(" ")[-1] for line in lines] == [str(second) for second in range(4)
+                                                       for _ in range(5)]
+    assert "group-4" in lines[4] and "group-0" in lines[5]
+    assert client.calls["filter_log_events"] == 0
+    # three batches of groups, split until no range has more than three events
+    assert client.calls["start_query"] > 3
+    assert client.calls["get_query_results"] == 2 * client.calls["start_query"]
+
+def test_insights_windows(monkeypatch):
+    monkeypatch.setattr(n_utils.log_events, "QUERY_WINDOW", 2)
+    monkeypatch.setattr(n_utils.waiter.time, "sleep", lambda seconds: None)
+    client = LocalLogsClient({"group-" + str(index): [
+        {"timestamp": 1000000000000 + second * 1000 + index, "logStreamName": "stream",
+         "message": "event " + str(second)} for second in range(6)] for index in range(2)})
+    events = CloudWatchLogsInsights(["group-0", "group-1"], None, 1000000000500, 1000000005999,
+                                    client=client).events()
+    first = next(events)
+    assert first["message"] == "event 1" and first["logGroupName"] == "group-0"
+    # only the first window of seconds 1000000000 and 1000000001 has been queried
+    assert client.calls["start_query"] == 1
+    assert [event["timestamp"] % 10000 for event in events] == [1001, 2000, 2001, 3000, 3001,
+                                                                4000, 4001, 5000, 5001]
+    assert client.calls["start_query"] == 3
+
+def test_ordered_merge():
+    merge = OrderedMerge(["a", "b"], 0, max_lateness=10, max_buffered=4)
+    merge.add("a", 5, "a5", now=0)
+    merge.add("a", 7, "a7", now=0)
+    assert merge.ready(now=0) == []
+    merge.add("b", 6, "b6", now=0)
+    assert merge.ready(now=0) == ["a5", "b6"]
+    merge.advance("b", 20)
+    assert merge.ready(now=0) == ["a7"]
+    merge.add("a", 30, "a30", now=1)
+    merge.add("a", 31, "a31", now=2)
+    assert merge.ready(now=5) == []
+    # b is late, a30 has waited max_lateness
+    assert merge.ready(now=11) == ["a30"]
+    merge.add("b", 25, "b25", now=11)
+    assert merge.ready(now=11) == ["b25"]
+    for timestamp in range(40, 45):
+        merge.add("a", timestamp, "a" + str(timestamp), now=12)
+    assert merge.ready(now=12) == ["a31", "a40"]
+    assert merge.flush() == ["a41", "a42", "a43", "a44"]
+
+def test_ordered_logs(capsys):
+    groups = {"fast": [{"timestamp": 1000000000000 + second * 1000, "logStreamName": "stream",
+                        "message": "fast " + str(second)} for second in range(0, 300, 2)],
+              "slow": [{"timestamp": 1000000000000 + second * 1000, "logStreamName": "stream",
+                        "message": "slow " + str(second)} for second in range(1, 300, 2)]}
+    client = LocalLogsClient(groups, page_size=10)
+    cwlogs = CloudWatchLogsGroups(log_group_filter=".", start_time="1000000000",
+                                  end_time="1000000300", sort=True, rate=100, backend="filter",
+                                  client=client)
+    cwlogs.get_logs()
+    lines = capsys.readouterr()[0].splitlines()
+    assert [int(line.split(" ")[-1]) for line in lines] == list(range(300))
+    # an event that is ingested after a round of its group is not overtaken
+    now = int(time.time() * 1000)
+    groups = {"fast": [{"timestamp": now - 500, "logStreamName": "stream", "message": "fast"}],
+              "slow": []}
+    client = LocalLogsClient(groups)
+    cwlogs = CloudWatchLogsGroups(log_group_filter=".", sort=True, rate=100, backend="filter",
+                                  client=client, max_lateness=2)
+    follow = Thread(target=cwlogs.get_logs)
+    follow.start()
+    while client.calls["filter_log_events"] < 2:
+        time.sleep(0.01)
+    groups["slow"].append({"timestamp": now - 1000, "logStreamName": "stream",
+                           "message": "slow"})
+    time.sleep(4)
+    cwlogs._stopped.set()
+    follow.join()
+    assert [line.split(" ")[-1] for line in capsys.readouterr()[0].splitlines()] == ["slow", "fast"]
+
+def test_log_writer(tmpdir, capsys):
+    event = {"timestamp": 1000000000000, "logGroupName": "group", "logStreamName": "stream",
+             "message": "hello\n", "eventId": "1"}
+    out_file = str(tmpdir.join("events.jsonl.gz"))
+    writer = LogWriter("jsonl", out_file)
+    for _ in range(3):
+        writer.write(event)
+    writer.close()
+    with gzip.open(out_file) as events:
+        assert [json.loads(line.decode("utf-8")) for line in events] == [event] * 3
+    writer = LogWriter("raw")
+    writer.write(event)
+    assert capsys.readouterr()[0] == ""
+    writer.flush()
+    assert capsys.readouterr()[0] == "hello\n"
+
+def test_checkpoint_resume(tmpdir, capsys):
+    checkpoint_file = str(tmpdir.join("checkpoint.json"))
+    events = [{"timestamp": 1000000000000 + second * 1000, "logStreamName": "stream",
+               "message": "event " + str(second)} for second in range(3)]
+    client = LocalLogsClient({"group": events})
+
+    def run():
+        CloudWatchLogsGroups(log_group_filter=".", start_time="1000000000", end_time="1000000100",
+                             client=client, checkpoint=Checkpoint(checkpoint_file)).get_logs()
+        return [line.split(" ", 3)[-1] for line in capsys.readouterr()[0].splitlines()]
+    assert run() == ["event 0", "event 1", "event 2"]
+    assert Checkpoint(checkpoint_file).positions == {
+        "group": {"timestamp": 1000000002000, "eventIds": ["group/2"]}}
+    events.append({"timestamp": 1000000002000, "logStreamName": "stream", "message": "late"})
+    events.append({"timestamp": 1000000003000, "logStreamName": "stream", "message": "event 3"})
+    assert run() == ["late", "event 3"]
+    assert run() == []
@@ -0,0 +1,79 @@
+import os
+import subprocess
+import n_utils.completion_cache
+from n_utils.completion_cache import fast_complete
+from n_utils.git_utils import Git
+from n_utils.ndt_project import list_jobs
+
+def _git(*args):
+    subprocess.check_call(["git"] + list(args), stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
+
+def _init_project(tmpdir):
+    _git("init", "-q", "-b", "master")
+    for name, value in [("user.name", "test"), ("user.email", "test@example.com")]:
+        _git("config", name, value)
+    tmpdir.join("infra.properties").write("paramEnvId=test\n")
+    for component in ["backend", "frontend"]:
+        tmpdir.join(component, "infra.properties").write("COMPONENT_VALUE=" + component + "\n", ensure=True)
+        for subcomponent in ["stack-api", "stack-db", "docker-app", "image"]:
+            properties = "SC_" + subcomponent.replace("-", "_") + "=yes\n"
+            tmpdir.join(component, subcomponent, "infra.properties").write(properties, ensure=True)
+    tmpdir.join("backend", "stack-api", "template.yaml").write("Resources: {}\n")
+    _git("add", "-A")
+    _git("commit", "-q", "-m", "initial")
+    for branch in ["dev", "prod"]:
+        _git("branch", branch)
+
+def test_list_jobs_parallel(mocker, tmpdir, monkeypatch):
+    mocker.patch('n_utils.aws_infra_util.resolve_account', return_value='123456789012')
+    mocker.patch('n_utils.aws_infra_util.region', return_value='eu-west-1')
+    monkeypatch.delenv('GIT_BRANCH', raising=False)
+    monkeypatch.chdir(tmpdir)
+    _init_project(tmpdir)
+    def run(**kwargs):
+        # load_parameters leaves subcomponent names in the environment
+        for key in [k for k in os.environ if k.startswith("ORIG_")]:
+            monkeypatch.delenv(key)
+        return list_jobs(**kwargs), dict(os.environ)
+    serial = run(export_job_properties=True, json=True)
+    parallel = run(export_job_properties=True, json=True, jobs=4)
+    assert [b["name"] for b in serial[0]["branches"]] == ["dev", "master", "prod"]
+    dev_backend = serial[0]["branches"][0]["components"][0]
+    assert [(sc["type"], sc.get("name")) for sc in dev_backend["subcomponents"]] == \
+        [("image", None), ("stack", "api"), ("docker", "app"), ("stack", "db")]
+    assert dev_backend["subcomponents"][3]["properties"]["SC_stack_db"] == "yes"
+    assert dev_backend["subcomponents"][0]["properties"]["COMPONENT_VALUE"] == "backend"
+    assert serial == parallel
+    assert run() == run(jobs=4)
+
+def test_export_branch(tmpdir, monkeypatch):
+    monkeypatch.delenv('GIT_BRANCH', raising=False)
+    monkeypatch.chdir(tmpdir)
+    _init_project(tmpdir)
+    with Git() as git:
+        export = git.export_branch("dev")
+        files = sorted(os.path.relpath(os.path.join(root, name), export)
+                       for root, dirs, names in os.walk(export) for name in names)
+        assert "backend/stack-api/infra.properties" in files
+        assert "backend/stack-api/template.yaml" not in files
+        assert os.path.isdir(os.path.join(export, "frontend", "docker-app"))
+    assert not os.path.exists(export)
+
+def test_completion_cache(mocker, tmpdir, monkeypatch):
+    monkeypatch.delenv('GIT_BRANCH', raising=False)
+    monkeypatch.chdir(tmpdir)
+    _init_project(tmpdir)
+    tree = mocker.spy(n_utils.completion_cache, "_project_tree")
+    assert fast_complete("load-parameters", ["ndt", "load-parameters"], "", "load-parameters") == \
+        ["backend", "frontend"]
+    assert fast_complete("load-parameters", ["ndt", "load-parameters", "backend", "-s"], "", "-s") == \
+        ["api", "db"]
+    assert fast_complete("load-parameters", ["ndt", "load-parameters", "-b"], "p", "-b") == ["prod"]
+    assert fast_complete("load-parameters", ["ndt", "load-parameters"], "-", "load-parameters") is None
+    assert tree.call_count == 1
+    assert fast_complete("list-jobs", ["ndt", "list-jobs", "-b", "dev", "-c"], "f", "-c") == ["frontend"]
+    assert tree.call_count == 2
+    tmpdir.join("database", "infra.properties").write("X=1\n", ensure=True)
+    assert fast_complete("load-parameters", ["ndt", "load-parameters"], "", "load-parameters") == \
+        ["backend", "database", "frontend"]
+    assert tree.call_count == 3
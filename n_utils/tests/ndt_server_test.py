@@ -0,0 +1,80 @@
+import json
+import subprocess
+import threading
+import n_utils.aws_infra_util
+import n_utils.cf_utils
+from n_utils.ndt_server import CommandServer, forward
+
+def test_forward(capsys, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("list.txt").write("a\nb\n")
+    socket_path = str(tmpdir.join("server.sock"))
+    server = CommandServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert forward(socket_path, ["list-file-to-json", "rows", "list.txt"]) == 0
+        out, _ = capsys.readouterr()
+        assert json.loads(out) == {"rows": ["a", "b"]}
+        assert forward(socket_path, ["list-file-to-json", "rows", "missing.txt"]) == 2
+        _, err = capsys.readouterr()
+        assert "missing.txt not found" in err
+        assert forward(socket_path, ["mfa-add-token", "token"]) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert forward(socket_path, ["list-file-to-json", "rows", "list.txt"]) is None
+
+def test_sourced_params(capsys, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv("REGION", "eu-west-1")
+    monkeypatch.setenv("ACCOUNT_ID", "123456789012")
+    subprocess.check_call(["git", "init", "-q"])
+    for component, stack in [("c1", "a"), ("c2", "b")]:
+        tmpdir.join(component, "infra.properties").write("paramFoo=" + component + "\n",
+                                                         ensure=True)
+        tmpdir.join(component, "stack-" + stack, "template.yaml").write(
+            "Parameters:\n  paramFoo:\n    Type: String\n    Default: x\n" +
+            "Outputs:\n  Foo:\n    Value: \"${paramFoo}\"\n", ensure=True)
+    socket_path = str(tmpdir.join("server.sock"))
+    server = CommandServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        for template, value in [("c1/stack-a/template.yaml", "c1"),
+                                ("c2/stack-b/template.yaml", "c2")]:
+            assert forward(socket_path, ["yaml-to-json", "-s", "--no-cache", template]) == 0
+            out, _ = capsys.readouterr()
+            assert json.loads(out)["Outputs"]["Foo"]["Value"] == value
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        n_utils.aws_infra_util.SOURCED_PARAMS = None
+
+def test_refresh_caches(monkeypatch, tmpdir):
+    server = CommandServer(str(tmpdir.join("server.sock")), cache_ttl=60)
+    try:
+        server.refresh_caches({"AWS_PROFILE": "dev"})
+        monkeypatch.setattr(n_utils.cf_utils, "ACCOUNT_ID", "123456789012")
+        cleared = []
+        monkeypatch.setattr(n_utils.aws_infra_util.PROPERTIES_FILES, "clear",
+                            lambda: cleared.append(True))
+        server.refresh_caches({"AWS_PROFILE": "dev", "PATH": "/bin"})
+        assert n_utils.cf_utils.ACCOUNT_ID == "123456789012"
+        assert not cleared
+        server.refresh_caches({"AWS_PROFILE": "prod"})
+        assert n_utils.cf_utils.ACCOUNT_ID is None
+        assert cleared
+    finally:
+        server.server_close()
+    # by default stacks are read again for every command
+    server = CommandServer(str(tmpdir.join("default.sock")))
+    try:
+        server.refresh_caches({"AWS_PROFILE": "dev"})
+        del cleared[:]
+        server.refresh_caches({"AWS_PROFILE": "dev"})
+        assert cleared
+    finally:
+        server.server_close()
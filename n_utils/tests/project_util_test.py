@@ -0,0 +1,22 @@
+import subprocess
+from n_utils.project_util import load_project_env
+
+def test_load_project_env_memoize(capsys, mocker, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    mocker.patch("n_utils.project_util.argv", ["nitor-dt-load-project-env", "--memoize"])
+    subprocess.check_call(["git", "init", "-q"])
+    subprocess.check_call(["git", "config", "ndt.aws.region", "eu-west-1"])
+    load_project_env()
+    assert "export AWS_REGION=eu-west-1" in capsys.readouterr()[0]
+    load_project_env()
+    assert capsys.readouterr()[0] == ""
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    load_project_env()
+    assert "export AWS_REGION=eu-west-1" in capsys.readouterr()[0]
+    load_project_env()
+    assert capsys.readouterr()[0] == ""
+    subprocess.check_call(["git", "config", "ndt.aws.region", "eu-central-1"])
+    tmpdir.join(".git", "config").setmtime(tmpdir.join(".git", "config").mtime() + 10)
+    load_project_env()
+    assert "export AWS_REGION=eu-central-1" in capsys.readouterr()[0]
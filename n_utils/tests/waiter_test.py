@@ -0,0 +1,66 @@
+import pytest
+from botocore.exceptions import ClientError
+from n_utils import waiter
+from n_utils.waiter import Waiter, WaitTimeout
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "Describe")
+
+def test_backoff(mocker):
+    sleeps = []
+    results = [False, False, False, False, False, True]
+    polls = Waiter("test-backoff", delay=1, max_delay=4, jitter=0, sleep=sleeps.append)
+    assert polls.wait(lambda: results.pop(0))
+    assert sleeps == [1, 2, 4, 4, 4]
+    assert polls.polls == 6
+    assert waiter.stats()["test-backoff"]["polls"] == 6
+
+def test_jitter(mocker):
+    sleeps = []
+    results = [False] * 20 + [True]
+    Waiter("test-jitter", delay=2, max_delay=2, jitter=0.5, sleep=sleeps.append)\
+        .wait(lambda: results.pop(0))
+    assert all(1 <= sleep <= 2 for sleep in sleeps)
+    assert len(set(sleeps)) > 1
+
+def test_throttling_and_pending(mocker):
+    sleeps = []
+    responses = [client_error("NotFound"), client_error("Throttling"), "ready"]
+
+    def poll():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    polls = Waiter("test-throttling", delay=1, max_delay=8, jitter=0,
+                   pending_codes=["NotFound"], sleep=sleeps.append)
+    assert polls.wait(poll) == "ready"
+    assert sleeps == [1, 4]
+    assert polls.throttled == 1
+    with pytest.raises(ClientError):
+        Waiter("test-throttling", sleep=sleeps.append).wait(poll_error)
+
+def test_throttled_delays(mocker):
+    sleeps = []
+    responses = [client_error("Throttling"), client_error("Throttling"),
+                 client_error("Throttling"), client_error("NotFound"), "ready"]
+
+    def poll():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    polls = Waiter("test-throttled-delays", delay=1, max_delay=30, jitter=0,
+                   pending_codes=["NotFound"], sleep=sleeps.append)
+    assert polls.wait(poll) == "ready"
+    # every throttled poll doubles the delay once
+    assert sleeps == [2, 4, 8, 8]
+    assert polls.throttled == 3
+
+def poll_error():
+    raise client_error("AccessDenied")
+
+def test_timeout(mocker):
+    with pytest.raises(WaitTimeout, match="took too long"):
+        Waiter("test-timeout", delay=0.01, timeout=0.05, timeout_message="took too long")\
+            .wait(lambda: False)
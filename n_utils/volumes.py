@@ -20,6 +20,7 @@ from botocore.exceptions import ClientError
 import psutil
 from n_utils.cf_utils import set_region, resolve_account, InstanceInfo
 from n_utils.ndt import find_include
+from n_utils.waiter import Waiter
 
 
 def letter_to_target_id(letter):
@@ -278,17 +279,18 @@ def create_empty_volume(size_gb, availability_zone=None):
 
 def wait_for_volume_status(volume_id, status, timeout_sec=300):
     set_region()
-    start = time.time()
     ec2 = boto3.client("ec2")
-    volume = None
-    while not match_volume_state(volume, status):
-        time.sleep(2)
-        if time.time() - start > timeout_sec:
-            raise Exception("Failed waiting for status '" + status + "' for " +
-                            volume_id + " (timeout: " + str(timeout_sec) + ")")
+
+    def poll_volume():
         resp = ec2.describe_volumes(VolumeIds=[volume_id])
         if "Volumes" in resp:
-            volume = resp['Volumes'][0]
+            return resp['Volumes'][0]
+        return None
+    Waiter("volume", delay=1, max_delay=15, timeout=timeout_sec,
+           timeout_message="Failed waiting for status '" + status + "' for " +
+           volume_id + " (timeout: " + str(timeout_sec) + ")",
+           pending_codes=["InvalidVolume.NotFound"])\
+        .wait(poll_volume, done=lambda volume: match_volume_state(volume, status))
 
 
 def match_volume_state(volume, status):
@@ -303,17 +305,18 @@ def match_volume_state(volume, status):
 
 def wait_for_snapshot_complete(snapshot_id, timeout_sec=900):
     set_region()
-    start = time.time()
     ec2 = boto3.client("ec2")
-    snapshot = None
-    while not is_snapshot_complete(snapshot):
-        time.sleep(2)
-        if time.time() - start > timeout_sec:
-            raise Exception("Failed waiting for status 'completed' for " +
-                            snapshot_id + " (timeout: " + str(timeout_sec) + ")")
+
+    def poll_snapshot():
         resp = ec2.describe_snapshots(SnapshotIds=[snapshot_id])
         if "Snapshots" in resp:
-            snapshot = resp['Snapshots'][0]
+            return resp['Snapshots'][0]
+        return None
+    Waiter("snapshot", delay=2, max_delay=30, timeout=timeout_sec,
+           timeout_message="Failed waiting for status 'completed' for " +
+           snapshot_id + " (timeout: " + str(timeout_sec) + ")",
+           pending_codes=["InvalidSnapshot.NotFound"])\
+        .wait(poll_snapshot, done=is_snapshot_complete)
 
 
 def is_snapshot_complete(snapshot):
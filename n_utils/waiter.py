@@ -0,0 +1,133 @@
+# Copyright 2016-2017 Nitor Creations Oy
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Polling for AWS resources to reach a state. The first poll is immediate,
+after that the delay grows exponentially up to a cap with random jitter so
+that parallel pipelines do not poll in step. Throttled polls back off further
+instead of failing.
+"""
+from builtins import object
+import os
+import random
+import sys
+import time
+from threading import Lock
+from botocore.exceptions import ClientError
+
+STATS_ENV = "NDT_WAITER_STATS"
+THROTTLING_CODES = ["Throttling", "ThrottlingException", "ThrottledException",
+                    "RequestLimitExceeded", "TooManyRequestsException",
+                    "RequestThrottled", "RequestThrottledException",
+                    "PriorRequestNotComplete", "SlowDown"]
+
+_STATS = {}
+_STATS_LOCK = Lock()
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+def is_throttling(err):
+    return isinstance(err, ClientError) and \
+        err.response.get('Error', {}).get('Code') in THROTTLING_CODES
+
+
+def stats():
+    """ Polls, throttled polls and seconds waited summed over all waits, by
+    waiter name
+    """
+    with _STATS_LOCK:
+        return dict([(name, dict(values)) for name, values in _STATS.items()])
+
+
+def _record(name, polls, throttled, waited):
+    with _STATS_LOCK:
+        totals = _STATS.setdefault(name, {"waits": 0, "polls": 0, "throttled": 0,
+                                          "waited": 0.0})
+        totals["waits"] += 1
+        totals["polls"] += polls
+        totals["throttled"] += throttled
+        totals["waited"] += waited
+    if os.environ.get(STATS_ENV):
+        sys.stderr.write("waiter %s: %d polls, %d throttled, %.1fs waited\n" %
+                         (name, polls, throttled, waited))
+
+
+class Waiter(object):
+    """ Calls poll until done returns true for its result. Delays start from
+    delay seconds and double up to max_delay. jitter is the fraction of each
+    delay that is randomized. Raises WaitTimeout with timeout_message if
+    timeout seconds pass. Errors with a code in pending_codes count as not done
+    yet, for resources that are not visible right after they are created. sleep
+    can be replaced with a function that returns early when something signals a
+    change.
+    """
+    def __init__(self, name, delay=1, max_delay=30, factor=2, jitter=0.5,
+                 timeout=None, timeout_message=None, pending_codes=None,
+                 sleep=time.sleep):
+        self.name = name
+        self.delay = delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.timeout_message = timeout_message
+        self.pending_codes = pending_codes or []
+        self.sleep = sleep
+        self.polls = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def _next_delay(self, delay):
+        return min(delay * self.factor, self.max_delay)
+
+    def _jittered(self, delay):
+        return delay * (1 - self.jitter * random.random())
+
+    def wait(self, poll, done=bool):
+        """ Returns the result of the poll that done accepted
+        """
+        start = time.time()
+        delay = self.delay
+        try:
+            while True:
+                self.polls += 1
+                throttled = False
+                try:
+                    result = poll()
+                    if done(result):
+                        return result
+                except ClientError as err:
+                    if is_throttling(err):
+                        # back off a step before sleeping instead of after it
+                        self.throttled += 1
+                        throttled = True
+                        delay = self._next_delay(delay)
+                    elif err.response.get('Error', {}).get('Code') not in self.pending_codes:
+                        raise
+                sleep_time = self._jittered(delay)
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise WaitTimeout(self.timeout_message or
+                                          "Timed out waiting for " + self.name)
+                    sleep_time = min(sleep_time, remaining)
+                slept_from = time.time()
+                self.sleep(sleep_time)
+                self.waited += time.time() - slept_from
+                if not throttled:
+                    delay = self._next_delay(delay)
+        finally:
+            _record(self.name, self.polls, self.throttled, self.waited)